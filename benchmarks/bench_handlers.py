@@ -0,0 +1,265 @@
+"""Benchmarks de los handlers principales contra un Google Sheets falso
+
+Uso:
+    python benchmarks/bench_handlers.py                  # compara con baseline.json
+    python benchmarks/bench_handlers.py --guardar-base   # regenera baseline.json
+    python benchmarks/bench_handlers.py --tamanos 1000 --latencia 0.05
+
+Para cada tamaño de datos (clientes y filas de historial) mide la latencia
+y las peticiones a Sheets por llamada de cada escenario. Sale con código 1
+si algún escenario empeora respecto a la línea base guardada.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import time
+import types
+from datetime import datetime
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+os.environ.setdefault('BACKEND_DATOS', 'sheets')
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import shishamgtabot as bot
+
+from benchmarks.datos_sinteticos import VENDEDORES, generar, id_cliente
+from benchmarks.hoja_falsa import LibroFalso
+
+RUTA_BASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+class MensajeFalso:
+    def __init__(self):
+        self.respuestas = []
+
+    async def reply_text(self, texto, **kwargs):
+        self.respuestas.append(texto)
+
+
+class BotFalso:
+    async def send_message(self, chat_id, text, **kwargs):
+        return types.SimpleNamespace(message_id=1)
+
+    async def send_photo(self, chat_id, photo, caption=None, **kwargs):
+        return types.SimpleNamespace(photo=[types.SimpleNamespace(file_id='bench')])
+
+
+def crear_update(user_id, texto=''):
+    usuario = types.SimpleNamespace(id=int(user_id), first_name='Bench', last_name='', username='bench')
+    mensaje = MensajeFalso()
+    mensaje.text = texto
+    return types.SimpleNamespace(effective_user=usuario, message=mensaje, callback_query=None, _bot=BotFalso())
+
+
+def crear_contexto(args=None):
+    return types.SimpleNamespace(args=args or [], bot=BotFalso(), bot_data={})
+
+
+def preparar(clientes, latencia, latencia_por_mil):
+    """Conecta el bot a un libro falso con datos sintéticos"""
+    registro, vendedores, historial = generar(clientes)
+    libro = LibroFalso(latencia, latencia_por_mil)
+    hojas = {
+        'registro': libro.agregar_hoja('registro_clientes', registro),
+        'vendedores': libro.agregar_hoja('Vendedores', vendedores),
+        'historial': libro.agregar_hoja('HistorialCompras', historial),
+        'estadisticas': libro.agregar_hoja('estadísticas', [bot.ENCABEZADOS_ESTADISTICAS]),
+        # El historial sintético es el archivo anterior a las particiones, ya resumido
+        'resumen': libro.agregar_hoja('ResumenHistorial', [bot.ENCABEZADOS_RESUMEN] + bot.resumir_particion(
+            bot.HISTORIAL_ARCHIVO, bot.compras_de_filas(historial))),
+    }
+    bot.sheet_registro = hojas['registro']
+    bot.sheet_vendedores = hojas['vendedores']
+    bot.sheet_historial = hojas['historial']
+    bot.sheet_estadisticas = hojas['estadisticas']
+    bot.sheet_resumen = hojas['resumen']
+    bot.hoja_registro = bot.HojaAsync(hojas['registro'], 'registro_clientes')
+    bot.hoja_vendedores = bot.HojaAsync(hojas['vendedores'], 'Vendedores')
+    bot.hoja_historial = bot.HojaAsync(hojas['historial'], 'HistorialCompras')
+    bot.hoja_estadisticas = bot.HojaAsync(hojas['estadisticas'], 'estadísticas')
+    bot.hoja_resumen = bot.HojaAsync(hojas['resumen'], 'ResumenHistorial')
+    bot.particiones = bot.ParticionesHistorial()
+    # A mitad de mes: la partición en curso ya existe (la rotación se paga una vez al mes)
+    mes = bot.mes_de(bot.obtener_fecha_hora_venezuela())
+    bot.particiones.enlazar({mes: libro.agregar_hoja(bot.nombre_particion(mes), [bot.ENCABEZADOS_HISTORIAL])})
+    bot.almacen = bot.almacen_sheets
+    bot.codigos_activos.limpiar()
+    # Sin límites de Telegram ni cuota de Sheets: se mide el bot, no el control de flujo
+    bot.despachador = bot.DespachadorSalida(global_por_seg=1e6, chat_por_seg=1e6, rafaga_chat=10**6)
+    bot.planificador_sheets = bot.PlanificadorSheets(por_minuto=1e9, rafaga=10**9)
+    bot.registro_vendedores.invalidar()
+    return libro
+
+
+async def escenario_start(i, clientes):
+    await bot.start(crear_update(id_cliente(i % clientes)), crear_contexto())
+
+
+async def escenario_solicitar_compra(i, clientes):
+    await bot.solicitar_compra(crear_update(id_cliente(i % clientes)), crear_contexto())
+
+
+async def escenario_procesar_compra_qr(i, clientes):
+    user_id = id_cliente(i % clientes)
+    codigo = f"compra_bench_{i}"
+    bot.codigos_activos.guardar(codigo, {
+        'user_id': user_id,
+        'timestamp': datetime.now(),
+        'nombre': 'Bench',
+        'vendedor': VENDEDORES[i % len(VENDEDORES)][1]
+    })
+    await bot.procesar_compra_qr(crear_update(user_id), user_id, codigo)
+
+
+async def escenario_historial_cliente(i, clientes):
+    await bot.historial_cliente(crear_update(id_cliente(i % clientes)), crear_contexto())
+
+
+async def escenario_ver_clientes_simultaneo(i, clientes):
+    # Todos los vendedores abren sus listados a la vez, justo después de una escritura
+    bot.hoja_registro.invalidar_lectura()
+    await asyncio.gather(*(
+        listado(crear_update(user_id), user_id)
+        for user_id, _, _ in VENDEDORES
+        for listado in (bot.mostrar_clientes_vendedor, bot.mostrar_mis_ventas)
+    ))
+
+
+async def escenario_clientes_admin_paginas(i, clientes):
+    # El admin recorre las primeras páginas de VER CLIENTES
+    await bot.construir_clientes_admin(i % 5)
+
+
+async def escenario_ranking(i, clientes):
+    await bot.generar_ranking_detallado()
+
+
+async def escenario_estadisticas(i, clientes):
+    await bot.obtener_estadisticas_completas()
+
+
+async def escenario_estadisticas_rango_anual(i, clientes):
+    # Un año entero del resumen diario (los datos sintéticos son de 2024)
+    ventana = bot.parsear_ventana(['rango', '2024-01-01', '2024-12-31'])
+    await bot.obtener_estadisticas_completas(await bot.tomar_instantanea(ventana))
+
+
+ESCENARIOS = {
+    'start': escenario_start,
+    'solicitar_compra': escenario_solicitar_compra,
+    'procesar_compra_qr': escenario_procesar_compra_qr,
+    'historial_cliente': escenario_historial_cliente,
+    'ver_clientes_simultaneo': escenario_ver_clientes_simultaneo,
+    'clientes_admin_paginas': escenario_clientes_admin_paginas,
+    'generar_ranking_detallado': escenario_ranking,
+    'obtener_estadisticas_completas': escenario_estadisticas,
+    'estadisticas_rango_anual': escenario_estadisticas_rango_anual,
+}
+
+
+async def medir(libro, funcion, repeticiones):
+    """Ejecuta una función varias veces y devuelve latencias y peticiones por llamada"""
+    libro.reiniciar_contadores()
+    latencias = []
+    for i in range(repeticiones):
+        inicio = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            await funcion(i)
+        latencias.append(time.perf_counter() - inicio)
+    latencias.sort()
+    return {
+        'p50_ms': round(statistics.median(latencias) * 1000, 2),
+        'p95_ms': round(latencias[min(len(latencias) - 1, int(len(latencias) * 0.95))] * 1000, 2),
+        'sheets_por_llamada': round(libro.total_llamadas() / repeticiones, 3),
+    }
+
+
+async def ejecutar(tamanos, latencia, latencia_por_mil, repeticiones, repeticiones_carga):
+    resultados = {}
+    for clientes in tamanos:
+        libro = preparar(clientes, latencia, latencia_por_mil)
+        # Varias cargas: con una sola muestra la mediana es una medición suelta y ruidosa
+        resultado = {'carga_inicial': await medir(libro, lambda i: bot.cargar_datos_en_memoria(), repeticiones_carga)}
+        for nombre, escenario in ESCENARIOS.items():
+            resultado[nombre] = await medir(libro, lambda i: escenario(i, clientes), repeticiones)
+        resultados[str(clientes)] = resultado
+        await bot.despachador.detener()
+        for nombre, datos in resultado.items():
+            print(f"{clientes:>7} {nombre:<32} p50 {datos['p50_ms']:>9.2f} ms  "
+                  f"p95 {datos['p95_ms']:>9.2f} ms  sheets/llamada {datos['sheets_por_llamada']:>6.2f}")
+    return resultados
+
+
+def comparar(resultados, base, tolerancia, margen_ms):
+    """Devuelve la lista de regresiones frente a la línea base"""
+    regresiones = []
+    for tamano, escenarios in resultados.items():
+        for nombre, actual in escenarios.items():
+            previo = base.get(tamano, {}).get(nombre)
+            if not previo:
+                continue
+            if actual['sheets_por_llamada'] > previo['sheets_por_llamada'] + 1e-9:
+                regresiones.append(f"{tamano}/{nombre}: sheets/llamada {previo['sheets_por_llamada']} -> {actual['sheets_por_llamada']}")
+            limite = previo['p50_ms'] * (1 + tolerancia) + margen_ms
+            if actual['p50_ms'] > limite:
+                regresiones.append(f"{tamano}/{nombre}: p50 {previo['p50_ms']} ms -> {actual['p50_ms']} ms (límite {limite:.2f})")
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tamanos', default='1000,10000,100000', help='clientes/filas de historial, separados por coma')
+    parser.add_argument('--latencia', type=float, default=0.02, help='segundos por petición a Sheets')
+    parser.add_argument('--latencia-por-mil', type=float, default=0.005, help='segundos extra por cada mil filas leídas')
+    parser.add_argument('--repeticiones', type=int, default=20)
+    parser.add_argument('--repeticiones-carga', type=int, default=5, help='repeticiones de la carga inicial')
+    parser.add_argument('--tolerancia', type=float, default=0.5, help='aumento relativo de p50 permitido')
+    parser.add_argument('--margen-ms', type=float, default=5.0, help='aumento absoluto de p50 permitido')
+    parser.add_argument('--base', default=RUTA_BASE)
+    parser.add_argument('--guardar-base', action='store_true')
+    args = parser.parse_args()
+
+    config = {
+        'latencia': args.latencia,
+        'latencia_por_mil': args.latencia_por_mil,
+        'repeticiones': args.repeticiones,
+        'repeticiones_carga': args.repeticiones_carga,
+    }
+    tamanos = [int(t) for t in args.tamanos.split(',') if t]
+    resultados = asyncio.run(ejecutar(tamanos, args.latencia, args.latencia_por_mil, args.repeticiones,
+                                     args.repeticiones_carga))
+
+    if args.guardar_base:
+        with open(args.base, 'w') as archivo:
+            json.dump({'config': config, 'resultados': resultados}, archivo, indent=2, ensure_ascii=False)
+            archivo.write('\n')
+        print(f"💾 Línea base guardada en {args.base}")
+        return 0
+
+    if not os.path.exists(args.base):
+        print("⚠️ No hay línea base; ejecuta con --guardar-base")
+        return 0
+    with open(args.base) as archivo:
+        base = json.load(archivo)
+    if base.get('config') != config:
+        print(f"⚠️ Configuración distinta a la línea base ({base.get('config')}); no se compara")
+        return 0
+
+    regresiones = comparar(resultados, base['resultados'], args.tolerancia, args.margen_ms)
+    if regresiones:
+        print("❌ Regresiones respecto a la línea base:")
+        for regresion in regresiones:
+            print(f"   • {regresion}")
+        return 1
+    print("✅ Sin regresiones respecto a la línea base")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,51 @@
+"""Datos sintéticos de clientes, vendedores e historial para los benchmarks"""
+import random
+from datetime import datetime, timedelta
+
+PRIMER_CLIENTE = 1_000_000_000
+VENDEDORES = [
+    (str(700000000 + i), f"Vendedor_{i}", 'premium' if i % 3 == 0 else 'normal')
+    for i in range(1, 11)
+]
+
+
+def id_cliente(i):
+    return str(PRIMER_CLIENTE + i)
+
+
+def generar(clientes, compras=None, semilla=42):
+    """Devuelve las filas (con encabezado) de registro, vendedores e historial"""
+    from shishamgtabot import ENCABEZADOS_REGISTRO, ENCABEZADOS_VENDEDORES, ENCABEZADOS_HISTORIAL
+
+    azar = random.Random(semilla)
+    compras = clientes if compras is None else compras
+    inicio = datetime(2024, 1, 1)
+
+    vendedores = [ENCABEZADOS_VENDEDORES] + [
+        [user_id, nombre, '2024-01-01', 'SI', privilegios]
+        for user_id, nombre, privilegios in VENDEDORES
+    ]
+
+    registro = [ENCABEZADOS_REGISTRO]
+    for i in range(clientes):
+        registro.append([
+            id_cliente(i),
+            f"@cliente{i}",
+            f"Cliente {i}",
+            (inicio + timedelta(days=azar.randrange(365))).strftime('%Y-%m-%d'),
+            str(azar.randrange(10)),
+            azar.choice(VENDEDORES)[1]
+        ])
+
+    historial = [ENCABEZADOS_HISTORIAL]
+    for _ in range(compras):
+        fecha = inicio + timedelta(minutes=azar.randrange(365 * 24 * 60))
+        historial.append([
+            id_cliente(azar.randrange(clientes)),
+            fecha.strftime('%Y-%m-%d %H:%M:%S'),
+            azar.choice(VENDEDORES)[1],
+            '1',
+            'compra'
+        ])
+
+    return registro, vendedores, historial
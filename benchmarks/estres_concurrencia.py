@@ -0,0 +1,182 @@
+"""Prueba de estrés: escaneos de QR concurrentes sin perder sellos
+
+Uso:
+    python benchmarks/estres_concurrencia.py
+    python benchmarks/estres_concurrencia.py --clientes 200 --escaneos 6 --latencia 0.02
+    python benchmarks/estres_concurrencia.py --sin-candados   # muestra los sellos perdidos
+
+Lanza a la vez, en orden aleatorio, varios escaneos por cliente (incluidos
+QR repetidos, primeras compras de clientes nuevos y bajas de otros clientes)
+contra la hoja falsa con latencia, y verifica que los sellos, el historial y
+las filas del índice coinciden con lo esperado. También comprueba que clientes
+distintos no se esperan entre sí. Sale con código 1 si algo no cuadra.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_handlers import bot, crear_update, preparar
+from benchmarks.datos_sinteticos import VENDEDORES, id_cliente
+
+
+def sellos_esperados(inicial, compras):
+    sellos = inicial
+    for _ in range(compras):
+        sellos += 1
+        if sellos >= 10:
+            sellos = 0
+    return sellos
+
+
+def filas_de_historial(libro):
+    # El archivo y las particiones mensuales
+    return sum(len(hoja.filas) for titulo, hoja in libro.hojas.items() if titulo.startswith('HistorialCompras'))
+
+
+async def escanear(user_id, codigo):
+    await bot.procesar_compra_qr(crear_update(user_id), user_id, codigo)
+
+
+async def dar_de_baja(user_id):
+    admin = crear_update(bot.ADMIN_ID, user_id)
+    bot.iniciar_flujo(bot.ADMIN_ID, 'eliminar_cliente')
+    await bot.procesar_eliminar_cliente(admin, None)
+
+
+def nuevo_codigo(codigo, user_id, vendedor):
+    bot.codigos_activos.guardar(codigo, {
+        'user_id': user_id,
+        'timestamp': datetime.now(),
+        'nombre': 'Estres',
+        'vendedor': vendedor
+    })
+
+
+async def ejecutar(args):
+    azar = random.Random(args.semilla)
+    total_clientes = args.clientes * 4
+    libro = preparar(total_clientes, args.latencia, 0.0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        await bot.cargar_datos_en_memoria()
+        await bot.registro_vendedores.asegurar()
+
+    registro = libro.hojas['registro_clientes']
+    iniciales = {fila[0]: int(fila[4]) for fila in registro.filas[1:]}
+    filas_historial = filas_de_historial(libro)
+
+    tareas = []
+    compras = {}
+    # Clientes existentes: varios escaneos simultáneos, alguno con el mismo QR dos veces
+    for i in range(args.clientes):
+        user_id = id_cliente(i)
+        compras[user_id] = args.escaneos
+        for k in range(args.escaneos):
+            codigo = f"compra_estres_{i}_{k}"
+            nuevo_codigo(codigo, user_id, azar.choice(VENDEDORES)[1])
+            tareas.append(escanear(user_id, codigo))
+            if k == 0:
+                tareas.append(escanear(user_id, codigo))
+    # Clientes nuevos: su primera compra llega varias veces a la vez
+    nuevos = [str(9_000_000_000 + i) for i in range(args.nuevos)]
+    for j, user_id in enumerate(nuevos):
+        compras[user_id] = 3
+        for k in range(3):
+            codigo = f"compra_nuevo_{j}_{k}"
+            nuevo_codigo(codigo, user_id, azar.choice(VENDEDORES)[1])
+            tareas.append(escanear(user_id, codigo))
+    # Bajas de clientes no involucrados mientras tanto
+    bajas = [id_cliente(total_clientes - 1 - i) for i in range(args.bajas)]
+    for user_id in bajas:
+        tareas.append(dar_de_baja(user_id))
+
+    azar.shuffle(tareas)
+    libro.reiniciar_contadores()
+    inicio = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        await asyncio.gather(*tareas)
+    duracion = time.perf_counter() - inicio
+    await bot.despachador.detener()
+
+    errores = []
+    filas = {}
+    for numero, fila in enumerate(registro.filas[1:], start=2):
+        if fila and fila[0]:
+            if fila[0] in filas:
+                errores.append(f"cliente {fila[0]} duplicado en filas {filas[fila[0]][0]} y {numero}")
+            filas[fila[0]] = (numero, fila)
+
+    for user_id, cantidad in compras.items():
+        if user_id not in filas:
+            errores.append(f"cliente {user_id} no está en la hoja")
+            continue
+        esperado = sellos_esperados(iniciales.get(user_id, 0), cantidad)
+        obtenido = int(filas[user_id][1][4])
+        if obtenido != esperado:
+            errores.append(f"cliente {user_id}: {obtenido} sellos, se esperaban {esperado}")
+
+    for user_id in bajas:
+        if user_id in filas:
+            errores.append(f"cliente {user_id} debía estar dado de baja")
+
+    compras_totales = sum(compras.values())
+    nuevas_filas = filas_de_historial(libro) - filas_historial
+    if nuevas_filas != compras_totales:
+        errores.append(f"historial: {nuevas_filas} filas nuevas, se esperaban {compras_totales}")
+
+    for user_id, (numero, _) in filas.items():
+        entrada = bot.indice_clientes._clientes.get(user_id)
+        if entrada and entrada[0] != numero:
+            errores.append(f"índice desfasado para {user_id}: fila {entrada[0]}, hoja {numero}")
+            break
+
+    if len(bot.candados):
+        errores.append(f"quedaron {len(bot.candados)} candados sin liberar")
+
+    # En serie cada escaneo esperaría su escritura; en paralelo solo la cadena de un mismo cliente
+    serie = compras_totales * args.latencia
+    if args.latencia and duracion > serie / 2:
+        errores.append(f"poca concurrencia: {duracion:.2f}s frente a {serie:.2f}s en serie")
+
+    print(f"⚡ {len(tareas)} operaciones ({compras_totales} compras válidas) en {duracion:.2f}s "
+          f"({compras_totales / duracion:.0f} compras/s; en serie ~{serie:.2f}s)")
+    print(f"📊 Peticiones a Sheets: {libro.total_llamadas()} {dict(libro.llamadas)}")
+    return errores
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clientes', type=int, default=100, help='clientes existentes con escaneos simultáneos')
+    parser.add_argument('--escaneos', type=int, default=5, help='escaneos distintos por cliente')
+    parser.add_argument('--nuevos', type=int, default=20, help='clientes nuevos con 3 escaneos simultáneos')
+    parser.add_argument('--bajas', type=int, default=3, help='bajas de otros clientes durante la prueba')
+    parser.add_argument('--latencia', type=float, default=0.02)
+    parser.add_argument('--semilla', type=int, default=7)
+    parser.add_argument('--sin-candados', action='store_true', help='desactiva los candados por cliente')
+    args = parser.parse_args()
+
+    if args.sin_candados:
+        @contextlib.asynccontextmanager
+        async def sin_candado(user_id):
+            yield
+        bot.bloquear_cliente = sin_candado
+
+    errores = asyncio.run(ejecutar(args))
+    if errores:
+        print(f"❌ {len(errores)} inconsistencias:")
+        for error in errores[:20]:
+            print(f"   • {error}")
+        return 1
+    print("✅ Ningún sello perdido ni duplicado")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
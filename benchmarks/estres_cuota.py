@@ -0,0 +1,125 @@
+"""Prueba de estrés: hora pico contra la cuota de Google Sheets
+
+Uso:
+    python benchmarks/estres_cuota.py
+    python benchmarks/estres_cuota.py --compras 120 --reportes 40 --cuota 40
+    python benchmarks/estres_cuota.py --sin-planificador   # muestra las compras fallidas
+
+La hoja falsa acepta como mucho --cuota peticiones por segundo y responde 429
+al resto, como la API real por minuto. Se lanzan a la vez compras por QR y
+lecturas completas de reportes. Con el planificador todas las compras deben
+guardarse (más lentas, no fallidas) y esperar menos que los reportes. Sale con
+código 1 si alguna compra falla o si las escrituras no van por delante.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import statistics
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_handlers import bot, crear_update, preparar
+from benchmarks.datos_sinteticos import VENDEDORES, id_cliente
+
+
+async def comprar(i, clientes, latencias):
+    user_id = id_cliente(i % clientes)
+    codigo = f"compra_cuota_{i}"
+    bot.codigos_activos.guardar(codigo, {
+        'user_id': user_id,
+        'timestamp': datetime.now(),
+        'nombre': 'Cuota',
+        'vendedor': VENDEDORES[i % len(VENDEDORES)][1]
+    })
+    update = crear_update(user_id)
+    inicio = time.perf_counter()
+    await bot.procesar_compra_qr(update, user_id, codigo)
+    latencias.append(time.perf_counter() - inicio)
+    return not any('Error' in respuesta for respuesta in update.message.respuestas)
+
+
+async def reporte(latencias):
+    inicio = time.perf_counter()
+    try:
+        # Directo a la worksheet, sin la lectura compartida: cada reporte es una petición
+        await bot.ejecutar_en_sheets(bot.hoja_registro.hoja.get_all_values)
+        return True
+    except Exception:
+        return False
+    finally:
+        latencias.append(time.perf_counter() - inicio)
+
+
+async def ejecutar(args):
+    libro = preparar(args.clientes, args.latencia, 0.0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        await bot.cargar_datos_en_memoria()
+        await bot.registro_vendedores.asegurar()
+
+    if args.sin_planificador:
+        bot.planificador_sheets = bot.PlanificadorSheets(por_minuto=1e9, rafaga=10**9, reintentos=0)
+    else:
+        # Algo por encima de la cuota real para provocar 429 y ejercitar los reintentos
+        bot.planificador_sheets = bot.PlanificadorSheets(
+            por_minuto=args.cuota * 60 * 1.2, rafaga=max(args.cuota // 4, 1),
+            espera_base=0.05, espera_maxima=1.0)
+    libro.limitar_cuota(args.cuota, 1.0)
+    libro.reiniciar_contadores()
+
+    lat_compras, lat_reportes = [], []
+    tareas = [comprar(i, args.clientes, lat_compras) for i in range(args.compras)]
+    tareas += [reporte(lat_reportes) for _ in range(args.reportes)]
+    # Los reportes llegan primero: aun así las compras deben pasar delante
+    tareas = tareas[args.compras:] + tareas[:args.compras]
+    inicio = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        resultados = await asyncio.gather(*tareas)
+    duracion = time.perf_counter() - inicio
+    await bot.despachador.detener()
+
+    compras_ok = sum(resultados[args.reportes:])
+    reportes_ok = sum(resultados[:args.reportes])
+    contadores = bot.planificador_sheets.contadores()
+    print(f"⚡ {args.compras} compras y {args.reportes} reportes en {duracion:.2f}s "
+          f"(cuota {args.cuota}/s, {libro.total_llamadas()} peticiones aceptadas, {libro.rechazadas} con 429)")
+    print(f"🛒 Compras: {compras_ok}/{args.compras} guardadas, "
+          f"p50 {statistics.median(lat_compras):.2f}s, máx {max(lat_compras):.2f}s")
+    print(f"📊 Reportes: {reportes_ok}/{args.reportes} completos, "
+          f"p50 {statistics.median(lat_reportes):.2f}s, máx {max(lat_reportes):.2f}s")
+    print(f"🚦 Planificador: {contadores}")
+
+    errores = []
+    if compras_ok < args.compras:
+        errores.append(f"{args.compras - compras_ok} compras fallidas")
+    if statistics.median(lat_compras) > statistics.median(lat_reportes):
+        errores.append("las compras esperaron más que los reportes")
+    return errores
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clientes', type=int, default=1000)
+    parser.add_argument('--compras', type=int, default=80)
+    parser.add_argument('--reportes', type=int, default=30)
+    parser.add_argument('--cuota', type=int, default=40, help='peticiones por segundo que acepta la hoja falsa')
+    parser.add_argument('--latencia', type=float, default=0.01)
+    parser.add_argument('--sin-planificador', action='store_true', help='sin cuota ni reintentos en el bot')
+    args = parser.parse_args()
+
+    errores = asyncio.run(ejecutar(args))
+    if errores:
+        print(f"❌ {len(errores)} problemas:")
+        for error in errores:
+            print(f"   • {error}")
+        return 1
+    print("✅ Ninguna compra fallida en la hora pico")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,236 @@
+"""Worksheet falso compatible con gspread para los benchmarks
+
+Guarda las filas en memoria, cuenta cada petición y puede simular la
+latencia de la API de Google Sheets (fija por petición más un costo por
+cada mil filas devueltas en las lecturas completas). Opcionalmente aplica
+una cuota de peticiones por ventana y responde 429 como la API real.
+"""
+import re
+import threading
+import time
+import types
+from collections import Counter, deque
+
+import gspread
+
+
+def columna_a_indice(letras):
+    """'A' -> 1, 'F' -> 6, 'AA' -> 27"""
+    indice = 0
+    for letra in letras:
+        indice = indice * 26 + ord(letra.upper()) - 64
+    return indice
+
+
+class Celda:
+    def __init__(self, row, col, value):
+        self.row = row
+        self.col = col
+        self.value = value
+
+
+def error_api(codigo, mensaje):
+    """APIError de gspread con el código HTTP indicado"""
+    respuesta = types.SimpleNamespace(
+        status_code=codigo,
+        text=mensaje,
+        json=lambda: {'error': {'code': codigo, 'message': mensaje}}
+    )
+    return gspread.exceptions.APIError(respuesta)
+
+
+class LibroFalso:
+    """Spreadsheet falso: agrupa las hojas y lleva la cuenta de peticiones"""
+
+    def __init__(self, latencia=0.0, latencia_por_mil_filas=0.0):
+        self.latencia = latencia
+        self.latencia_por_mil_filas = latencia_por_mil_filas
+        self.hojas = {}
+        self.llamadas = Counter()
+        self.rechazadas = 0
+        self.cuota = None
+        self._recientes = deque()
+        self._lock = threading.Lock()
+
+    def limitar_cuota(self, peticiones, ventana):
+        """Rechaza con 429 las peticiones que superen 'peticiones' por 'ventana' segundos"""
+        self.cuota = (peticiones, ventana)
+        self._recientes.clear()
+
+    def agregar_hoja(self, titulo, filas):
+        hoja = HojaFalsa(self, titulo, filas)
+        self.hojas[titulo] = hoja
+        return hoja
+
+    def worksheets(self):
+        return list(self.hojas.values())
+
+    def worksheet(self, title):
+        self.peticion('worksheet')
+        if title not in self.hojas:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self.hojas[title]
+
+    def add_worksheet(self, title, rows=1000, cols=26):
+        self.peticion('add_worksheet')
+        if title in self.hojas:
+            raise error_api(400, f'A sheet with the name "{title}" already exists.')
+        return self.agregar_hoja(title, [])
+
+    def peticion(self, operacion, filas=0):
+        """Registra una petición y espera la latencia simulada"""
+        with self._lock:
+            if self.cuota:
+                peticiones, ventana = self.cuota
+                ahora = time.monotonic()
+                while self._recientes and ahora - self._recientes[0] >= ventana:
+                    self._recientes.popleft()
+                if len(self._recientes) >= peticiones:
+                    self.rechazadas += 1
+                    raise error_api(429, 'Quota exceeded for quota metric Read/Write requests')
+                self._recientes.append(ahora)
+            self.llamadas[operacion] += 1
+        espera = self.latencia + self.latencia_por_mil_filas * filas / 1000
+        if espera:
+            time.sleep(espera)
+
+    def total_llamadas(self):
+        return sum(self.llamadas.values())
+
+    def reiniciar_contadores(self):
+        self.llamadas.clear()
+        self.rechazadas = 0
+
+    def _ubicar(self, rango):
+        coincidencia = re.match(r"'?([^'!]+)'?!([A-Z]+)(\d+)", rango)
+        hoja = self.hojas[coincidencia.group(1)]
+        return hoja, int(coincidencia.group(3)), columna_a_indice(coincidencia.group(2))
+
+    def values_batch_get(self, ranges, params=None):
+        """Lee varios rangos A1 ('Hoja', 'Hoja'!1:1, 'Hoja'!A5:F24) en una sola petición"""
+        rangos = []
+        for rango in ranges:
+            coincidencia = re.match(r"'?([^'!]+)'?(?:!([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?)?$", rango)
+            hoja = self.hojas[coincidencia.group(1)]
+            _, col_ini, fila_ini, col_fin, fila_fin = coincidencia.groups()
+            fila_ini = int(fila_ini) if fila_ini else 1
+            fila_fin = int(fila_fin) if fila_fin else (fila_ini if col_fin is None and col_ini else len(hoja.filas))
+            col_ini = columna_a_indice(col_ini) if col_ini else 1
+            col_fin = columna_a_indice(col_fin) if col_fin else None
+            valores = [list(fila[col_ini - 1:col_fin]) for fila in hoja.filas[fila_ini - 1:fila_fin]]
+            # Como la API: sin filas vacías al final ni celdas vacías al final de cada fila
+            for fila in valores:
+                while fila and not fila[-1]:
+                    fila.pop()
+            while valores and not valores[-1]:
+                valores.pop()
+            rangos.append({'range': rango, 'majorDimension': 'ROWS', **({'values': valores} if valores else {})})
+        self.peticion('values_batch_get', sum(len(r.get('values', [])) for r in rangos))
+        return {'valueRanges': rangos}
+
+    def values_batch_update(self, params=None, body=None):
+        self.peticion('values_batch_update')
+        for dato in body['data']:
+            hoja, fila, columna = self._ubicar(dato['range'])
+            hoja._escribir(fila, columna, dato['values'])
+        return {'totalUpdatedRanges': len(body['data'])}
+
+
+class HojaFalsa:
+    """Worksheet en memoria con la misma interfaz que usa el bot"""
+
+    def __init__(self, libro, titulo, filas):
+        self.spreadsheet = libro
+        self.title = titulo
+        self.filas = [[str(v) for v in fila] for fila in filas]
+        self._capacidad = max(len(self.filas) + 100, 1000)
+
+    @property
+    def row_count(self):
+        return max(self._capacidad, len(self.filas))
+
+    def _escribir(self, fila, columna, valores):
+        for desplazamiento, fila_valores in enumerate(valores):
+            numero = fila + desplazamiento
+            while len(self.filas) < numero:
+                self.filas.append([])
+            destino = self.filas[numero - 1]
+            for j, valor in enumerate(fila_valores):
+                if valor is None:
+                    # Como la API: las celdas con null no se tocan
+                    continue
+                while len(destino) < columna + j:
+                    destino.append("")
+                destino[columna + j - 1] = str(valor)
+
+    def get_all_values(self):
+        self.spreadsheet.peticion('get_all_values', len(self.filas))
+        return [list(fila) for fila in self.filas]
+
+    def find(self, query, in_row=None, in_column=None):
+        self.spreadsheet.peticion('find', len(self.filas))
+        for i, fila in enumerate(self.filas, start=1):
+            if in_row and i != in_row:
+                continue
+            for j, valor in enumerate(fila, start=1):
+                if in_column and j != in_column:
+                    continue
+                if valor == str(query):
+                    return Celda(i, j, valor)
+        return None
+
+    def row_values(self, row):
+        self.spreadsheet.peticion('row_values')
+        return list(self.filas[row - 1]) if row <= len(self.filas) else []
+
+    def col_values(self, col):
+        self.spreadsheet.peticion('col_values', len(self.filas))
+        valores = [fila[col - 1] if len(fila) >= col else "" for fila in self.filas]
+        while valores and not valores[-1]:
+            valores.pop()
+        return valores
+
+    def append_row(self, values, **kwargs):
+        self.spreadsheet.peticion('append_row')
+        self.filas.append([str(v) for v in values])
+        numero = len(self.filas)
+        return {'updates': {'updatedRange': f"'{self.title}'!A{numero}"}}
+
+    def append_rows(self, values, value_input_option=None, insert_data_option=None, table_range=None, **kwargs):
+        """values.append: inserta tras la última fila con datos y devuelve el rango escrito"""
+        self.spreadsheet.peticion('append_rows')
+        ultima = len(self.filas)
+        while ultima and not any(self.filas[ultima - 1]):
+            ultima -= 1
+        nuevas = [[str(v) for v in fila] for fila in values]
+        self.filas[ultima:ultima] = nuevas
+        columna = chr(64 + max(len(fila) for fila in nuevas))
+        return {'updates': {'updatedRange': f"'{self.title}'!A{ultima + 1}:{columna}{ultima + len(nuevas)}"}}
+
+    def update_cell(self, row, col, value):
+        self.spreadsheet.peticion('update_cell')
+        self._escribir(row, col, [[value]])
+
+    def update(self, range_name, values=None, include_values_in_response=None, **kwargs):
+        self.spreadsheet.peticion('update')
+        _, fila, columna = self.spreadsheet._ubicar(range_name)
+        self._escribir(fila, columna, values)
+        respuesta = {'updatedRange': range_name}
+        if include_values_in_response:
+            # updatedData: el rango pedido completo tal como quedó, incluidas las celdas no tocadas
+            ancho = max(len(fila_valores) for fila_valores in values)
+            escritas = [list(self.filas[fila + i - 1][columna - 1:columna - 1 + ancho]) for i in range(len(values))]
+            respuesta['updatedData'] = {'range': range_name, 'values': escritas}
+        return respuesta
+
+    def add_rows(self, rows):
+        self.spreadsheet.peticion('add_rows')
+        self._capacidad = self.row_count + rows
+
+    def delete_rows(self, start_index, end_index=None):
+        self.spreadsheet.peticion('delete_rows')
+        del self.filas[start_index - 1:end_index or start_index]
+
+    def clear(self):
+        self.spreadsheet.peticion('clear')
+        self.filas = []
@@ -0,0 +1,105 @@
+"""Memoria de los índices en memoria por cliente y por compra
+
+Uso:
+    python benchmarks/memoria_indices.py
+    python benchmarks/memoria_indices.py --clientes 100000 --maximo-por-cliente 350
+
+Carga el índice de clientes y el del historial con datos sintéticos y mide con
+tracemalloc los bytes que ocupan (sin contar las filas leídas de la hoja, que
+se descartan tras la carga). Como referencia mide también las mismas filas
+guardadas como diccionarios, la representación anterior a Cliente/Compra. Sale
+con código 1 si los bytes por cliente superan --maximo-por-cliente.
+"""
+import argparse
+import asyncio
+import contextlib
+import gc
+import io
+import os
+import sys
+import tracemalloc
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_handlers import bot, preparar
+
+
+def medir(construir):
+    """Bytes que siguen reservados tras construir (y conservar) una estructura"""
+    gc.collect()
+    tracemalloc.start()
+    antes = tracemalloc.get_traced_memory()[0]
+    estructura = construir()
+    gc.collect()
+    despues = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return despues - antes, estructura
+
+
+def clientes_como_dict(registro):
+    indice = OrderedDict()
+    for fila_num, fila in enumerate(registro[1:], start=2):
+        indice[fila[0]] = (fila_num, {
+            'user_id': fila[0], 'username': fila[1], 'nombre': fila[2],
+            'fecha_registro': fila[3], 'sellos': int(fila[4]), 'vendedor': fila[5],
+        })
+    return indice
+
+
+def historial_como_dict(historial):
+    compras = {}
+    for fila in historial[1:]:
+        compras.setdefault(fila[0], []).append(
+            {'fecha': fila[1], 'vendedor': fila[2], 'cantidad': int(fila[3]), 'tipo': fila[4]})
+    return compras
+
+
+def cargar_clientes(registro):
+    indice = bot.IndiceClientes(max_entradas=len(registro))
+    with contextlib.redirect_stdout(io.StringIO()):
+        asyncio.run(indice.cargar(registro))
+    return indice
+
+
+def cargar_historial(historial):
+    indice = bot.IndiceHistorial()
+    indice.cargar_particion(bot.HISTORIAL_ARCHIVO, historial)
+    return indice
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clientes', type=int, default=100000, help='clientes y filas de historial')
+    parser.add_argument('--maximo-por-cliente', type=float, default=350.0,
+                        help='bytes por cliente permitidos en el índice de clientes')
+    args = parser.parse_args()
+
+    libro = preparar(args.clientes, 0.0, 0.0)
+    registro = libro.hojas['registro_clientes'].filas
+    historial = libro.hojas['HistorialCompras'].filas
+
+    mediciones = [
+        ('clientes', 'Cliente', *medir(lambda: cargar_clientes(registro))),
+        ('clientes', 'dict', *medir(lambda: clientes_como_dict(registro))),
+        ('historial', 'Compra', *medir(lambda: cargar_historial(historial))),
+        ('historial', 'dict', *medir(lambda: historial_como_dict(historial))),
+    ]
+    por_cliente = None
+    for indice, modelo, total, _ in mediciones:
+        por_fila = total / args.clientes
+        if (indice, modelo) == ('clientes', 'Cliente'):
+            por_cliente = por_fila
+        print(f"🧠 {indice:<10} {modelo:<8} {total / 1024 / 1024:>8.1f} MiB  {por_fila:>7.0f} bytes/fila")
+
+    ahorro = 1 - mediciones[0][2] / mediciones[1][2]
+    print(f"📉 Índice de clientes: {ahorro:.0%} menos memoria que con diccionarios")
+    if por_cliente > args.maximo_por_cliente:
+        print(f"❌ {por_cliente:.0f} bytes por cliente (máximo {args.maximo_por_cliente:.0f})")
+        return 1
+    print(f"✅ {por_cliente:.0f} bytes por cliente con {args.clientes} clientes")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
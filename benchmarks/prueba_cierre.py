@@ -0,0 +1,157 @@
+"""Cierre del bot con envíos pendientes en la cola de salida
+
+Uso:
+    python benchmarks/prueba_cierre.py
+    python benchmarks/prueba_cierre.py --mensajes 30
+
+Arma la Application con crear_aplicacion() sobre un cliente HTTP falso que
+falla si se usa después de cerrarse, encola avisos en el despachador de
+salida a un ritmo más lento que el cierre y detiene el bot: por
+run_polling (el camino del polling largo) y por cerrar_aplicacion (el del
+webhook). Comprueba que todos los avisos salieron antes de cerrar el
+cliente. Como control, repite el cierre con la cola vaciada después de
+shutdown() y verifica que el cliente falso lo detecta. Sale con código 1 si
+algún caso falla.
+"""
+import argparse
+import asyncio
+import contextlib
+import functools
+import io
+import json
+import os
+import sys
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.request import BaseRequest
+
+from benchmarks.bench_handlers import bot
+
+TOKEN_PRUEBA = '123456:PRUEBA'
+USUARIO_BOT = {'id': 123456, 'is_bot': True, 'first_name': 'Prueba', 'username': 'prueba_bot'}
+
+
+class PeticionesFalsas(BaseRequest):
+    """Cliente HTTP de la Bot API en memoria: responde y anota cada sendMessage"""
+
+    def __init__(self):
+        self.abierto = False
+        self.enviados = []
+        self.tras_cierre = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        self.abierto = True
+
+    async def shutdown(self):
+        self.abierto = False
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        metodo = url.rsplit('/', 1)[-1]
+        if not self.abierto:
+            self.tras_cierre += 1
+            raise RuntimeError('cliente HTTP cerrado')
+        if metodo == 'getMe':
+            resultado = USUARIO_BOT
+        elif metodo == 'getUpdates':
+            await asyncio.sleep(0.05)
+            resultado = []
+        elif metodo == 'sendMessage':
+            parametros = request_data.parameters
+            self.enviados.append(parametros['text'])
+            resultado = {'message_id': len(self.enviados), 'date': 0, 'text': parametros['text'],
+                         'chat': {'id': int(parametros['chat_id']), 'type': 'private'}}
+        else:
+            resultado = True
+        return 200, json.dumps({'ok': True, 'result': resultado}).encode()
+
+
+def encolar_avisos(application, mensajes):
+    """Avisos fuera del camino crítico, como la notificación de venta al vendedor"""
+    for i in range(mensajes):
+        chat_id = 1000 + i % 5
+        bot.despachador.enviar(chat_id, functools.partial(
+            application.bot.send_message, chat_id=chat_id, text=f"aviso {i}"
+        ), bot.PRIORIDAD_NOTIFICACION, esperar=False)
+
+
+def preparar_despachador(mensajes):
+    # Más lento que el cierre: al detener el bot quedan avisos en la cola
+    bot.despachador = bot.DespachadorSalida(global_por_seg=max(mensajes / 3, 1), chat_por_seg=100,
+                                            rafaga_chat=100)
+
+
+def caso_polling(mensajes):
+    peticiones = PeticionesFalsas()
+    aplicacion = bot.crear_aplicacion(TOKEN_PRUEBA, peticiones)
+    preparar_despachador(mensajes)
+
+    async def iniciar(application):
+        encolar_avisos(application, mensajes)
+        asyncio.get_running_loop().call_later(0.2, application.stop_running)
+
+    aplicacion.post_init = iniciar
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    with warnings.catch_warnings(), contextlib.redirect_stdout(io.StringIO()):
+        warnings.simplefilter('ignore')
+        aplicacion.run_polling(stop_signals=None, close_loop=False, drop_pending_updates=True)
+    loop.close()
+    return peticiones
+
+
+async def caso_webhook(mensajes, cerrar):
+    peticiones = PeticionesFalsas()
+    aplicacion = bot.crear_aplicacion(TOKEN_PRUEBA, peticiones)
+    aplicacion.post_init = None
+    preparar_despachador(mensajes)
+    await aplicacion.initialize()
+    await aplicacion.start()
+    encolar_avisos(aplicacion, mensajes)
+    await asyncio.sleep(0.2)
+    with contextlib.redirect_stdout(io.StringIO()):
+        await cerrar(aplicacion)
+    return peticiones
+
+
+async def cierre_anterior(application):
+    """El orden de antes: la cola se vaciaba en post_shutdown, con el cliente ya cerrado"""
+    await application.stop()
+    await application.shutdown()
+    await bot.detener_servicios(application)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mensajes', type=int, default=20, help='avisos encolados antes del cierre')
+    args = parser.parse_args()
+
+    casos = [
+        ('polling', caso_polling(args.mensajes), True),
+        ('webhook', asyncio.run(caso_webhook(args.mensajes, bot.cerrar_aplicacion)), True),
+        ('control (vaciado tras shutdown)', asyncio.run(caso_webhook(args.mensajes, cierre_anterior)), False),
+    ]
+    fallos = 0
+    for nombre, peticiones, debe_entregar in casos:
+        entregados = len(peticiones.enviados)
+        completo = entregados == args.mensajes and peticiones.tras_cierre == 0
+        correcto = completo == debe_entregar
+        fallos += not correcto
+        print(f"{'✅' if correcto else '❌'} {nombre:<32} {entregados}/{args.mensajes} entregados, "
+              f"{peticiones.tras_cierre} intentos con el cliente cerrado")
+
+    if fallos:
+        print(f"❌ {fallos} caso(s) de cierre fallaron")
+        return 1
+    print("✅ La cola de salida se vacía antes de cerrar el bot")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
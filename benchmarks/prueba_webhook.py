@@ -0,0 +1,121 @@
+"""POSTs simulados contra el receptor del webhook
+
+Uso:
+    python benchmarks/prueba_webhook.py
+
+Llama a ReceptorWebhook.procesar() sin abrir sockets con un token válido, un
+token inválido, sin token, un método distinto de POST, una ruta equivocada y
+un cuerpo JSON mal formado, y comprueba el estado HTTP y que solo el update
+autenticado llega a la cola de la aplicación. Al final repite el POST válido
+por HTTP real en un puerto local. Sale con código 1 si algún caso falla.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_handlers import bot
+
+SECRETO = 'secreto-de-prueba'
+CABECERA = 'x-telegram-bot-api-secret-token'
+
+
+def cuerpo_update(update_id, user_id, texto):
+    return json.dumps({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': 0, 'text': texto,
+            'chat': {'id': int(user_id), 'type': 'private'},
+            'from': {'id': int(user_id), 'is_bot': False, 'first_name': 'Prueba'},
+        },
+    }).encode()
+
+
+def crear_receptor():
+    application = types.SimpleNamespace(update_queue=asyncio.Queue(), bot=None)
+    return bot.ReceptorWebhook(application, ruta='/telegram', secreto=SECRETO)
+
+
+async def casos_simulados():
+    receptor = crear_receptor()
+    cola = receptor.application.update_queue
+    valido = cuerpo_update(1, '123', '/start')
+    # Un atacante que conoce la URL se hace pasar por el admin sin firmar
+    falso_admin = cuerpo_update(2, bot.ADMIN_ID, '🚫 ELIMINAR CLIENTE')
+    casos = [
+        ('token válido', 'POST', '/telegram', {CABECERA: SECRETO}, valido, 200, 1),
+        ('token inválido', 'POST', '/telegram', {CABECERA: 'otro'}, falso_admin, 403, 0),
+        ('sin token', 'POST', '/telegram', {}, falso_admin, 403, 0),
+        ('método GET', 'GET', '/telegram', {CABECERA: SECRETO}, b'', 405, 0),
+        ('ruta equivocada', 'POST', '/otra', {CABECERA: SECRETO}, valido, 404, 0),
+        ('JSON mal formado', 'POST', '/telegram', {CABECERA: SECRETO}, b'{"update_id": ', 400, 0),
+        ('health', 'GET', '/health', {}, b'', 200, 0),
+    ]
+    fallos = 0
+    for nombre, metodo, ruta, cabeceras, cuerpo, esperado, encolados in casos:
+        antes = cola.qsize()
+        with contextlib.redirect_stdout(io.StringIO()):
+            estado, _ = await receptor.procesar(metodo, ruta, cabeceras, cuerpo)
+        nuevos = cola.qsize() - antes
+        correcto = estado == esperado and nuevos == encolados
+        fallos += not correcto
+        print(f"{'✅' if correcto else '❌'} {nombre:<18} HTTP {estado} (esperado {esperado}), "
+              f"{nuevos} update(s) encolados")
+
+    update = cola.get_nowait()
+    if update.effective_user.id != 123:
+        print(f"❌ Update encolado con usuario {update.effective_user.id}")
+        fallos += 1
+
+    try:
+        bot.ReceptorWebhook(receptor.application, secreto='')
+        print("❌ El receptor arrancó sin secreto")
+        fallos += 1
+    except ValueError:
+        print("✅ sin secreto       el receptor no arranca")
+    return fallos
+
+
+async def caso_http():
+    receptor = crear_receptor()
+    with contextlib.redirect_stdout(io.StringIO()):
+        await receptor.iniciar('127.0.0.1', 0)
+    puerto = receptor.servidor.sockets[0].getsockname()[1]
+    try:
+        cuerpo = cuerpo_update(3, '456', '/sellos')
+        reader, writer = await asyncio.open_connection('127.0.0.1', puerto)
+        writer.write(
+            f"POST /telegram HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+            f"X-Telegram-Bot-Api-Secret-Token: {SECRETO}\r\nContent-Length: {len(cuerpo)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + cuerpo
+        )
+        await writer.drain()
+        respuesta = await reader.read()
+        writer.close()
+    finally:
+        await receptor.detener()
+    estado = int(respuesta.split(b' ', 2)[1])
+    correcto = estado == 200 and receptor.application.update_queue.qsize() == 1
+    print(f"{'✅' if correcto else '❌'} HTTP real          HTTP {estado} en 127.0.0.1:{puerto}")
+    return 0 if correcto else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+    fallos = asyncio.run(casos_simulados()) + asyncio.run(caso_http())
+    if fallos:
+        print(f"❌ {fallos} caso(s) del webhook fallaron")
+        return 1
+    print("✅ El webhook solo acepta updates autenticados")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,31 @@
 import gspread
 import qrcode
+import io
 import uuid
 import asyncio
 import os
 import json
+import re
+import sqlite3
 import time
 import logging
+import functools
+import random
+import contextlib
+import bisect
+import heapq
+import contextvars
+import hmac
+import secrets
+import signal
 import traceback
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from google.oauth2.service_account import Credentials
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, filters
+from telegram.error import RetryAfter, TimedOut
+from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, TypeHandler, filters
 
 # Configuración mejorada de logging
 logging.basicConfig(
@@ -28,6 +43,27 @@ SCOPE = ['https://www.googleapis.com/auth/spreadsheets',
 
 ADMIN_ID = '634092669'
 
+# Precio de cada venta (los ingresos de los reportes son ventas × precio)
+PRECIO_VENTA = 12
+
+# Sellos que dan el premio (la tarjeta vuelve a 0) y desde cuántos un cliente
+# está "cerca del premio" en los listados
+SELLOS_PARA_PREMIO = 10
+SELLOS_CERCA_PREMIO = 7
+
+# Encabezados de las hojas
+ENCABEZADOS_REGISTRO = ["user_id", "username", "nombre_completo", "fecha_registro", "sellos", "vendedor"]
+ENCABEZADOS_VENDEDORES = ["username", "nombre", "fecha_incorporacion", "estado", "privilegios"]
+ENCABEZADOS_HISTORIAL = ["user_id", "fecha", "vendedor", "cantidad", "tipo"]
+ENCABEZADOS_ESTADISTICAS = ["Vendedor", "total_clientes", "sellos_activos", "sellos_inactivos", 
+                            "total_ventas", "fecha_actualizacion"]
+ENCABEZADOS_RESUMEN = ["mes", "tipo", "clave", "vendedor", "compras", "clientes", "ultima"]
+
+# HistorialCompras se parte por meses: 'HistorialCompras_AAAA-MM'. La hoja
+# original queda como partición cerrada HISTORIAL_ARCHIVO con todo lo anterior.
+HISTORIAL_PREFIJO = "HistorialCompras_"
+HISTORIAL_ARCHIVO = "0000-00"
+
 # Funciones mejoradas para hora Venezuela (UTC-4)
 def obtener_hora_venezuela():
     """Obtiene la hora actual de Venezuela (UTC-4)"""
@@ -50,272 +86,2533 @@ def obtener_fecha_venezuela():
     hora_venezuela = utc_now + venezuela_offset
     return hora_venezuela.strftime('%Y-%m-%d')
 
-# Sistema de inicialización robusta de Google Sheets
-def inicializar_google_sheets():
-    """Inicializa Google Sheets con manejo robusto de errores"""
+# Sistema de inicialización robusta de Google Sheets
+# Pestañas del libro y sus encabezados (None = solo acceder, no crear)
+PESTANAS = (
+    ("registro_clientes", ENCABEZADOS_REGISTRO),
+    ("Vendedores", ENCABEZADOS_VENDEDORES),
+    ("HistorialCompras", ENCABEZADOS_HISTORIAL),
+    ("estadísticas", None),
+    ("ResumenHistorial", ENCABEZADOS_RESUMEN)
+)
+
+def mes_de(fecha_hora):
+    """'2025-03-14 18:20:00' -> '2025-03'"""
+    return fecha_hora[:7]
+
+def nombre_particion(mes):
+    """Pestaña de la partición del historial de ese mes"""
+    return "HistorialCompras" if mes == HISTORIAL_ARCHIVO else f"{HISTORIAL_PREFIJO}{mes}"
+
+def abrir_google_sheets():
+    """Abre el libro una sola vez y enlaza sus pestañas por título
+
+    Solo se leen los metadatos del libro y la fila 1 de cada pestaña (todas en
+    una misma petición) para comprobar los encabezados; los datos se cargan
+    después, con el bot ya atendiendo. Devuelve las pestañas de PESTANAS y,
+    aparte, las particiones mensuales del historial {mes: worksheet}.
+    """
+    try:
+        google_creds_json = os.getenv('GOOGLE_CREDENTIALS')
+        if not google_creds_json:
+            raise Exception("GOOGLE_CREDENTIALS no encontrada en variables de entorno")
+        
+        creds_dict = json.loads(google_creds_json)
+        creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPE)
+        client = gspread.authorize(creds)
+        
+        spreadsheet = client.open_by_key(SHEET_ID)
+        pestanas = {hoja.title: hoja for hoja in spreadsheet.worksheets()}
+        print(f"✅ Conectado a Google Sheets principal ({len(pestanas)} pestañas) - Hora Venezuela: {obtener_hora_venezuela()}")
+        
+        # Crear las pestañas que falten (salvo estadísticas, que ya debe existir)
+        nuevas = set()
+        for nombre_hoja, headers in PESTANAS:
+            if nombre_hoja in pestanas:
+                continue
+            if not headers:
+                print(f"❌ Hoja '{nombre_hoja}' no encontrada, pero debería existir")
+                continue
+            try:
+                print(f"📊 Creando hoja '{nombre_hoja}' automáticamente...")
+                hoja = spreadsheet.add_worksheet(title=nombre_hoja, rows="100", cols="10")
+                hoja.append_row(headers)
+                pestanas[nombre_hoja] = hoja
+                nuevas.add(nombre_hoja)
+                print(f"✅ Hoja '{nombre_hoja}' creada con encabezados")
+            except Exception as e:
+                print(f"⚠️ Error con hoja '{nombre_hoja}': {e}")
+        
+        # Verificar encabezados leyendo solo la fila 1 de cada pestaña
+        revisar = [(nombre_hoja, headers) for nombre_hoja, headers in PESTANAS
+                   if headers and nombre_hoja in pestanas and nombre_hoja not in nuevas]
+        if revisar:
+            respuesta = spreadsheet.values_batch_get([f"'{nombre_hoja}'!1:1" for nombre_hoja, _ in revisar])
+            for (nombre_hoja, headers), rango in zip(revisar, respuesta.get('valueRanges', [])):
+                if not any(rango.get('values', [])):
+                    pestanas[nombre_hoja].append_row(headers)
+                    print(f"✅ Encabezados agregados a '{nombre_hoja}'")
+        
+        mensuales = {titulo[len(HISTORIAL_PREFIJO):]: hoja for titulo, hoja in pestanas.items()
+                     if titulo.startswith(HISTORIAL_PREFIJO)}
+        print("✅ Todas las hojas de Google Sheets inicializadas correctamente")
+        return tuple(pestanas.get(nombre_hoja) for nombre_hoja, _ in PESTANAS), mensuales
+        
+    except Exception as e:
+        print(f"❌ Error crítico conectando a Google Sheets: {e}")
+        print("⚠️ El bot continuará sin funcionalidad de base de datos")
+        return (None,) * len(PESTANAS), {}
+
+# Las hojas se enlazan al arrancar el bot (conectar_google_sheets), no al importar
+sheet_registro = sheet_vendedores = sheet_historial = sheet_estadisticas = sheet_resumen = None
+
+# Acceso no bloqueante a Google Sheets
+# Métricas del bot en memoria
+LIMITES_LATENCIA = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+METRICAS_PUERTO = int(os.getenv('METRICAS_PUERTO', '0'))
+
+handler_actual = contextvars.ContextVar('handler_actual', default='fondo')
+
+class Histograma:
+    """Contador de latencias por cubetas acumulables (segundos)"""
+
+    def __init__(self):
+        self.cubetas = [0] * len(LIMITES_LATENCIA)
+        self.cuenta = 0
+        self.suma = 0.0
+        self.errores = 0
+
+    def observar(self, segundos, error=False):
+        self.cubetas[bisect.bisect_left(LIMITES_LATENCIA, segundos)] += 1
+        self.cuenta += 1
+        self.suma += segundos
+        if error:
+            self.errores += 1
+
+    def percentil(self, p):
+        """Límite superior de la cubeta que contiene el percentil p"""
+        objetivo = self.cuenta * p
+        acumulado = 0
+        for limite, n in zip(LIMITES_LATENCIA, self.cubetas):
+            acumulado += n
+            if acumulado >= objetivo:
+                return limite
+        return LIMITES_LATENCIA[-1]
+
+class Metricas:
+    """Latencias por handler y por operación de Sheets, llamadas a Sheets por handler y cachés"""
+
+    def __init__(self):
+        self.handlers = {}
+        self.sheets = {}
+        self.sheets_por_handler = Counter()
+        self.caches = {}
+        self.contadores = {}
+
+    def observar_handler(self, nombre, segundos, error=False):
+        self.handlers.setdefault(nombre, Histograma()).observar(segundos, error)
+
+    def observar_sheets(self, operacion, segundos, error=False):
+        self.sheets.setdefault(operacion, Histograma()).observar(segundos, error)
+        self.sheets_por_handler[handler_actual.get()] += 1
+
+    def registrar_cache(self, nombre, objeto):
+        """Registra un objeto con atributos aciertos/fallos"""
+        self.caches[nombre] = objeto
+
+    def registrar_contadores(self, nombre, funcion):
+        """Registra una función que devuelve un dict de contadores {campo: valor}"""
+        self.contadores[nombre] = funcion
+
+    def texto(self):
+        """Resumen legible para el comando /metrics"""
+        lineas = [f"📈 **MÉTRICAS DEL BOT**\n⏰ Hora: {obtener_hora_venezuela()}\n", "⚡ **Handlers:**"]
+        for nombre, h in sorted(self.handlers.items(), key=lambda x: -x[1].cuenta):
+            promedio = h.suma / h.cuenta * 1000 if h.cuenta else 0
+            por_llamada = self.sheets_por_handler[nombre] / h.cuenta if h.cuenta else 0
+            lineas.append(f"• {nombre}: {h.cuenta} llamadas, {h.errores} errores, "
+                          f"prom {promedio:.0f} ms, p95 ≤ {h.percentil(0.95) * 1000:.0f} ms, "
+                          f"{por_llamada:.1f} Sheets/llamada")
+        lineas.append("\n📊 **Google Sheets:**")
+        for operacion, h in sorted(self.sheets.items(), key=lambda x: -x[1].cuenta):
+            promedio = h.suma / h.cuenta * 1000 if h.cuenta else 0
+            lineas.append(f"• {operacion}: {h.cuenta} llamadas, {h.errores} errores, prom {promedio:.0f} ms")
+        lineas.append("\n🎯 **Cachés:**")
+        for nombre, objeto in self.caches.items():
+            total = objeto.aciertos + objeto.fallos
+            ratio = objeto.aciertos / total * 100 if total else 0
+            lineas.append(f"• {nombre}: {ratio:.1f}% aciertos ({objeto.aciertos}/{total})")
+        if self.contadores:
+            lineas.append("\n🚦 **Contadores:**")
+            for nombre, funcion in self.contadores.items():
+                lineas.append(f"• {nombre}: " + ", ".join(f"{campo}={valor}" for campo, valor in funcion().items()))
+        return "\n".join(lineas)
+
+    def prometheus(self):
+        """Exposición en formato de texto de Prometheus"""
+        lineas = []
+        for metrica, tabla, etiqueta in (('shisha_handler_segundos', self.handlers, 'handler'),
+                                         ('shisha_sheets_segundos', self.sheets, 'operacion')):
+            lineas.append(f"# TYPE {metrica} histogram")
+            for nombre, h in tabla.items():
+                acumulado = 0
+                for limite, n in zip(LIMITES_LATENCIA, h.cubetas):
+                    acumulado += n
+                    le = '+Inf' if limite == float('inf') else limite
+                    lineas.append(f'{metrica}_bucket{{{etiqueta}="{nombre}",le="{le}"}} {acumulado}')
+                lineas.append(f'{metrica}_sum{{{etiqueta}="{nombre}"}} {h.suma}')
+                lineas.append(f'{metrica}_count{{{etiqueta}="{nombre}"}} {h.cuenta}')
+            lineas.append(f"# TYPE {metrica.replace('_segundos', '_errores_total')} counter")
+            for nombre, h in tabla.items():
+                lineas.append(f'{metrica.replace("_segundos", "_errores_total")}{{{etiqueta}="{nombre}"}} {h.errores}')
+        lineas.append("# TYPE shisha_sheets_llamadas_total counter")
+        for nombre, n in self.sheets_por_handler.items():
+            lineas.append(f'shisha_sheets_llamadas_total{{handler="{nombre}"}} {n}')
+        lineas.append("# TYPE shisha_cache_aciertos_total counter")
+        lineas.append("# TYPE shisha_cache_fallos_total counter")
+        for nombre, objeto in self.caches.items():
+            lineas.append(f'shisha_cache_aciertos_total{{cache="{nombre}"}} {objeto.aciertos}')
+            lineas.append(f'shisha_cache_fallos_total{{cache="{nombre}"}} {objeto.fallos}')
+        lineas.append("# TYPE shisha_contador gauge")
+        for nombre, funcion in self.contadores.items():
+            for campo, valor in funcion().items():
+                lineas.append(f'shisha_contador{{grupo="{nombre}",campo="{campo}"}} {valor}')
+        return "\n".join(lineas) + "\n"
+
+metricas = Metricas()
+
+def medir(callback):
+    """Envuelve un callback de handler para medir latencia, errores y llamadas a Sheets"""
+    nombre = getattr(callback, '__name__', repr(callback))
+
+    @functools.wraps(callback)
+    async def envoltura(update, context):
+        token = handler_actual.set(nombre)
+        inicio = time.perf_counter()
+        error = False
+        try:
+            return await callback(update, context)
+        except Exception:
+            error = True
+            raise
+        finally:
+            metricas.observar_handler(nombre, time.perf_counter() - inicio, error)
+            handler_actual.reset(token)
+    return envoltura
+
+SHEETS_MAX_HILOS = int(os.getenv('SHEETS_MAX_HILOS', '8'))
+SHEETS_TIMEOUT = float(os.getenv('SHEETS_TIMEOUT', '20'))
+
+# Cuota de la API de Google Sheets (peticiones por minuto del service account)
+SHEETS_CUOTA_POR_MINUTO = float(os.getenv('SHEETS_CUOTA_POR_MINUTO', '60'))
+SHEETS_RAFAGA = int(os.getenv('SHEETS_RAFAGA', '10'))
+SHEETS_REINTENTOS = int(os.getenv('SHEETS_REINTENTOS', '5'))
+SHEETS_ESPERA_BASE = 1.0
+SHEETS_ESPERA_MAXIMA = 64.0
+
+# Carriles de prioridad ante la cuota (menor = sale antes)
+PRIORIDAD_SHEETS_ESCRITURA = 0
+PRIORIDAD_SHEETS_CONSULTA = 1
+PRIORIDAD_SHEETS_LECTURA = 2
+
+OPERACIONES_ESCRITURA = {'values_batch_update', 'update', 'update_cell', 'append_row', 'append_rows',
+                         'delete_rows', 'add_rows', 'clear', 'add_worksheet'}
+OPERACIONES_LECTURA_COMPLETA = {'get_all_values', 'values_batch_get'}
+# Ante un 5xx pudieron aplicarse: repetirlas duplicaría o borraría filas de más
+OPERACIONES_NO_IDEMPOTENTES = {'append_row', 'append_rows', 'delete_rows', 'add_rows', 'add_worksheet'}
+
+executor_sheets = ThreadPoolExecutor(max_workers=SHEETS_MAX_HILOS, thread_name_prefix='sheets')
+
+def prioridad_sheets(operacion):
+    """Carril por defecto según la operación de gspread"""
+    if operacion in OPERACIONES_ESCRITURA:
+        return PRIORIDAD_SHEETS_ESCRITURA
+    if operacion in OPERACIONES_LECTURA_COMPLETA:
+        return PRIORIDAD_SHEETS_LECTURA
+    return PRIORIDAD_SHEETS_CONSULTA
+
+def codigo_error_sheets(error):
+    """Código HTTP de un APIError de gspread (None si el error no viene de la API)"""
+    if isinstance(error, gspread.exceptions.APIError):
+        return getattr(getattr(error, 'response', None), 'status_code', None)
+    return None
+
+class CubetaTokens:
+    """Token bucket que reserva por adelantado: devuelve cuánto esperar para usar el token"""
+
+    def __init__(self, tasa, capacidad):
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self.tokens = float(capacidad)
+        self.actualizado = time.monotonic()
+
+    def _recargar(self, ahora):
+        self.tokens = min(self.capacidad, self.tokens + (ahora - self.actualizado) * self.tasa)
+        self.actualizado = ahora
+
+    def reservar(self):
+        self._recargar(time.monotonic())
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.tasa
+
+    def tomar(self):
+        """Usa un token si hay uno disponible ahora mismo"""
+        self._recargar(time.monotonic())
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def devolver(self):
+        self.tokens = min(self.capacidad, self.tokens + 1)
+
+    def espera(self):
+        """Segundos hasta que haya un token completo"""
+        self._recargar(time.monotonic())
+        return max(0.0, (1 - self.tokens) / self.tasa)
+
+    def llena(self):
+        self._recargar(time.monotonic())
+        return self.tokens >= self.capacidad
+
+class PlanificadorSheets:
+    """Reparte la cuota de Google Sheets entre las peticiones del bot.
+
+    Una cubeta de tokens ajustada a la cuota decide cuándo sale cada petición.
+    Si hay que esperar, las escrituras (compras) salen antes que las consultas
+    puntuales y éstas antes que las lecturas completas de los reportes. Un 429
+    pausa todos los carriles; los 429 y 5xx se reintentan con espera
+    exponencial y jitter.
+    """
+
+    def __init__(self, por_minuto=SHEETS_CUOTA_POR_MINUTO, rafaga=SHEETS_RAFAGA,
+                 reintentos=SHEETS_REINTENTOS, espera_base=SHEETS_ESPERA_BASE,
+                 espera_maxima=SHEETS_ESPERA_MAXIMA):
+        self.cubeta = CubetaTokens(por_minuto / 60, rafaga)
+        self.reintentos = reintentos
+        self.espera_base = espera_base
+        self.espera_maxima = espera_maxima
+        self._espera = []
+        self._secuencia = 0
+        self._pausa_hasta = 0.0
+        self._loop = None
+        self._repartidor = None
+        self.encolados = 0
+        self.limitados = 0
+        self.reintentados = 0
+
+    async def turno(self, prioridad=PRIORIDAD_SHEETS_CONSULTA):
+        """Espera hasta que la petición pueda salir sin pasarse de la cuota"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._espera = []
+            self._repartidor = None
+        if not self._espera and time.monotonic() >= self._pausa_hasta and self.cubeta.tomar():
+            return
+        futuro = loop.create_future()
+        self._secuencia += 1
+        heapq.heappush(self._espera, (prioridad, self._secuencia, futuro))
+        self.encolados += 1
+        if self._repartidor is None or self._repartidor.done():
+            self._repartidor = loop.create_task(self._repartir())
+        await futuro
+
+    async def _repartir(self):
+        # El carril se elige al liberar cada token: lo que llegue con más prioridad pasa delante
+        while self._espera:
+            pausa = self._pausa_hasta - time.monotonic()
+            if pausa > 0:
+                await asyncio.sleep(pausa)
+                continue
+            if not self.cubeta.tomar():
+                await asyncio.sleep(self.cubeta.espera())
+                continue
+            while self._espera:
+                _, _, futuro = heapq.heappop(self._espera)
+                if not futuro.done():
+                    futuro.set_result(None)
+                    break
+            else:
+                self.cubeta.devolver()
+
+    def espera_reintento(self, intento):
+        """Espera exponencial con jitter: entre la mitad y el total del tope del intento"""
+        tope = min(self.espera_maxima, self.espera_base * 2 ** intento)
+        return tope / 2 + random.uniform(0, tope / 2)
+
+    def limitar(self, segundos):
+        """Pausa todos los carriles tras un 429"""
+        self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + segundos)
+        self.limitados += 1
+
+    def contadores(self):
+        return {'en_espera': len(self._espera), 'encolados': self.encolados,
+                'limitados': self.limitados, 'reintentados': self.reintentados}
+
+planificador_sheets = PlanificadorSheets()
+metricas.registrar_contadores('cuota_sheets', lambda: planificador_sheets.contadores())
+
+async def ejecutar_en_sheets(funcion, *args, timeout=None, prioridad=None, **kwargs):
+    """Ejecuta una llamada bloqueante de gspread en el pool de hilos con timeout
+
+    Cada intento espera su turno en planificador_sheets (carril según la
+    operación si no se indica prioridad). Los 429 y 5xx se reintentan con
+    espera exponencial y jitter. Si se agota el tiempo se lanza
+    asyncio.TimeoutError; el hilo termina la petición en segundo plano pero el
+    handler ya no la espera.
+    """
+    operacion = getattr(funcion, '__name__', type(funcion).__name__)
+    if prioridad is None:
+        prioridad = prioridad_sheets(operacion)
+    loop = asyncio.get_running_loop()
+    for intento in range(planificador_sheets.reintentos + 1):
+        await planificador_sheets.turno(prioridad)
+        futuro = loop.run_in_executor(executor_sheets, functools.partial(funcion, *args, **kwargs))
+        inicio = time.perf_counter()
+        error = False
+        try:
+            return await asyncio.wait_for(futuro, timeout or SHEETS_TIMEOUT)
+        except Exception as e:
+            error = True
+            codigo = codigo_error_sheets(e)
+            reintentable = codigo == 429 or (
+                codigo is not None and codigo >= 500 and operacion not in OPERACIONES_NO_IDEMPOTENTES)
+            if not reintentable or intento == planificador_sheets.reintentos:
+                raise
+            espera = planificador_sheets.espera_reintento(intento)
+            if codigo == 429:
+                planificador_sheets.limitar(espera)
+            planificador_sheets.reintentados += 1
+            print(f"⏳ Google Sheets respondió {codigo} en {operacion}; reintento en {espera:.1f}s - Hora: {obtener_hora_venezuela()}")
+        finally:
+            metricas.observar_sheets(operacion, time.perf_counter() - inicio, error)
+        await asyncio.sleep(espera)
+
+# Lecturas completas concurrentes de una hoja se unen en una sola petición
+SHEETS_REUSO_LECTURA = float(os.getenv('SHEETS_REUSO_LECTURA', '2'))
+
+class HojaAsync:
+    """Envoltorio async de una worksheet: cada método se ejecuta fuera del event loop
+
+    get_all_values() es de vuelo único: si ya hay una lectura completa en curso
+    los demás la esperan, y el resultado se reusa durante SHEETS_REUSO_LECTURA
+    segundos. Cualquier escritura en la hoja descarta la lectura compartida.
+    """
+
+    def __init__(self, hoja, nombre, reuso=SHEETS_REUSO_LECTURA):
+        self.hoja = hoja
+        self.nombre = nombre
+        self.ultima_fila = None
+        self.reuso = reuso
+        self._lectura = None
+        self._lectura_hasta = 0.0
+        self.lecturas = 0
+        self.unidas = 0
+        self.reusadas = 0
+
+    def __bool__(self):
+        return self.hoja is not None
+
+    def rango(self, columna_inicio, fila, columna_fin, fila_fin=None):
+        """Rango A1 absoluto dentro de esta hoja, p. ej. 'HistorialCompras'!A5:E5"""
+        return f"'{self.nombre}'!{columna_inicio}{fila}:{columna_fin}{fila_fin or fila}"
+
+    async def anexar(self, filas):
+        """Agrega filas al final con values.append (INSERT_ROWS) y devuelve la primera
+
+        Google Sheets elige la fila según lo que la hoja tiene en ese momento:
+        las filas agregadas o borradas a mano no hacen que se pise ningún dato.
+        """
+        respuesta = await self._llamar('append_rows', filas, value_input_option='RAW',
+                                       insert_data_option='INSERT_ROWS', table_range='A1')
+        return fila_de_rango(respuesta['updates']['updatedRange'])
+
+    async def ubicar(self, fila, id_esperado, buscar=True):
+        """Fila donde está hoy id_esperado, comprobando la columna A antes de escribir en 'fila'
+
+        Si la hoja se editó a mano y la fila ya no es la suya, se busca el ID en
+        la columna A (con buscar=False no). None si no está.
+        """
+        id_esperado = str(id_esperado)
+        if fila:
+            valores = await lector_rangos.leer(self.hoja.spreadsheet, [self.rango('A', fila, 'A')])
+            if valores[0] and valores[0][0] and str(valores[0][0][0]) == id_esperado:
+                return fila
+        if not buscar:
+            return None
+        celda = await self.find(id_esperado, in_column=1)
+        if celda:
+            print(f"⚠️ {id_esperado} ya no estaba en la fila {fila} de '{self.nombre}' sino en la {celda.row} - Hora: {obtener_hora_venezuela()}")
+        return celda.row if celda else None
+
+    async def escribir_en_fila(self, fila, columna_inicio, valores):
+        """Escribe valores desde columna_inicio (0 = A) en 'fila' y devuelve el ID que tiene esa fila
+
+        El rango empieza en la columna A con null en las celdas anteriores, que
+        Sheets deja intactas, y la respuesta trae la fila tal como quedó: se
+        comprueba de quién era sin leerla antes. Si la respuesta no incluye la
+        columna A, se lee aparte.
+        """
+        rango = self.rango('A', fila, letra_columna(columna_inicio + len(valores) - 1))
+        respuesta = await self.update(rango, [[None] * columna_inicio + list(valores)],
+                                      include_values_in_response=True)
+        datos = (respuesta or {}).get('updatedData', {})
+        if re.search(r'!A\d', datos.get('range', '')):
+            filas = datos.get('values') or [[]]
+        else:
+            filas = (await lector_rangos.leer(self.hoja.spreadsheet, [self.rango('A', fila, 'A')]))[0] or [[]]
+        return str(filas[0][0]) if filas[0] else ""
+
+    async def _llamar(self, metodo, *args, **kwargs):
+        if metodo not in OPERACIONES_ESCRITURA:
+            return await ejecutar_en_sheets(getattr(self.hoja, metodo), *args, **kwargs)
+        # Ni durante ni después de la escritura debe servirse la lectura anterior
+        self.invalidar_lectura()
+        try:
+            return await ejecutar_en_sheets(getattr(self.hoja, metodo), *args, **kwargs)
+        finally:
+            self.invalidar_lectura()
+
+    def invalidar_lectura(self):
+        self._lectura = None
+
+    def _fin_lectura(self, lectura):
+        if lectura is self._lectura:
+            self._lectura_hasta = time.monotonic() + self.reuso
+
+    async def get_all_values(self):
+        lectura = self._lectura
+        if lectura is not None and not lectura.done():
+            self.unidas += 1
+        elif (lectura is not None and time.monotonic() < self._lectura_hasta
+              and not lectura.cancelled() and lectura.exception() is None):
+            self.reusadas += 1
+        else:
+            lectura = self._lectura = asyncio.ensure_future(self._llamar('get_all_values'))
+            lectura.add_done_callback(self._fin_lectura)
+            self.lecturas += 1
+        # Copia de la lista externa: hay quien borra filas del resultado
+        return list(await asyncio.shield(lectura))
+
+    def contadores_lectura(self):
+        return {'lecturas': self.lecturas, 'unidas': self.unidas, 'reusadas': self.reusadas}
+
+    async def find(self, valor, **kwargs):
+        return await self._llamar('find', valor, **kwargs)
+
+    async def row_values(self, fila):
+        return await self._llamar('row_values', fila)
+
+    async def append_row(self, valores, **kwargs):
+        return await self._llamar('append_row', valores, **kwargs)
+
+    async def update_cell(self, fila, columna, valor):
+        return await self._llamar('update_cell', fila, columna, valor)
+
+    async def delete_rows(self, inicio, fin=None):
+        return await self._llamar('delete_rows', inicio, fin)
+
+    async def clear(self):
+        return await self._llamar('clear')
+
+    async def update(self, rango, valores, **kwargs):
+        return await self._llamar('update', rango, valores, **kwargs)
+
+hoja_registro = HojaAsync(sheet_registro, "registro_clientes")
+hoja_vendedores = HojaAsync(sheet_vendedores, "Vendedores")
+hoja_historial = HojaAsync(sheet_historial, "HistorialCompras")
+hoja_estadisticas = HojaAsync(sheet_estadisticas, "estadísticas")
+hoja_resumen = HojaAsync(sheet_resumen, "ResumenHistorial")
+
+def hojas_async():
+    return (hoja_registro, hoja_vendedores, hoja_historial, hoja_estadisticas, hoja_resumen,
+            *particiones.hojas.values())
+
+def contadores_lecturas():
+    contadores = {}
+    for hoja in hojas_async():
+        for campo, valor in hoja.contadores_lectura().items():
+            contadores[f"{hoja.nombre}.{campo}"] = valor
+    return contadores
+
+metricas.registrar_contadores('lecturas_completas', contadores_lecturas)
+
+def fila_de_rango(rango):
+    """Primera fila de un rango A1: "'Hoja'!A12:F14" -> 12"""
+    return int(re.search(r'![A-Z]*(\d+)', rango).group(1))
+
+def letra_columna(indice):
+    """Índice de columna desde 0 -> letra A1 (0 -> 'A', 26 -> 'AA')"""
+    letras = ""
+    indice += 1
+    while indice:
+        indice, resto = divmod(indice - 1, 26)
+        letras = chr(ord('A') + resto) + letras
+    return letras
+
+class LectorRangos:
+    """Une en una sola values_batch_get las lecturas de rangos pedidas a la vez
+
+    Los pedidos del mismo ciclo del event loop salen en un lote, y los que
+    llegan mientras ese lote está en vuelo salen juntos en el siguiente: N
+    páginas abiertas a la vez cuestan una o dos peticiones, no N.
+    """
+
+    def __init__(self):
+        self._pendientes = []
+        self._despacho = None
+        self.pedidos = 0
+        self.lotes = 0
+
+    async def leer(self, libro, rangos):
+        """Valores de cada rango A1, en el mismo orden (como 'values' de la API)"""
+        futuro = asyncio.get_running_loop().create_future()
+        self._pendientes.append((libro, rangos, futuro))
+        self.pedidos += 1
+        if self._despacho is None or self._despacho.done():
+            self._despacho = asyncio.ensure_future(self._despachar())
+        return await futuro
+
+    async def _despachar(self):
+        # Deja que los demás pedidos de este mismo ciclo se sumen al lote
+        await asyncio.sleep(0)
+        while self._pendientes:
+            lote, self._pendientes = self._pendientes, []
+            por_libro = {}
+            for pedido in lote:
+                por_libro.setdefault(id(pedido[0]), []).append(pedido)
+            for pedidos in por_libro.values():
+                await self._leer_lote(pedidos)
+
+    async def _leer_lote(self, pedidos):
+        libro = pedidos[0][0]
+        rangos = [rango for _, rangos_pedido, _ in pedidos for rango in rangos_pedido]
+        self.lotes += 1
+        try:
+            respuesta = await ejecutar_en_sheets(libro.values_batch_get, rangos,
+                                                 prioridad=PRIORIDAD_SHEETS_CONSULTA)
+        except Exception as e:
+            for _, _, futuro in pedidos:
+                if not futuro.done():
+                    futuro.set_exception(e)
+            return
+        valores = [rango.get('values', []) for rango in respuesta.get('valueRanges', [])]
+        inicio = 0
+        for _, rangos_pedido, futuro in pedidos:
+            if not futuro.done():
+                futuro.set_result(valores[inicio:inicio + len(rangos_pedido)])
+            inicio += len(rangos_pedido)
+
+    def contadores(self):
+        return {'pedidos': self.pedidos, 'lotes': self.lotes}
+
+lector_rangos = LectorRangos()
+metricas.registrar_contadores('lecturas_rangos', lambda: lector_rangos.contadores())
+
+async def conectar_google_sheets():
+    """Abre Google Sheets fuera del event loop y enlaza las hojas async"""
+    global sheet_registro, sheet_vendedores, sheet_historial, sheet_estadisticas, sheet_resumen
+    try:
+        hojas, mensuales = await ejecutar_en_sheets(abrir_google_sheets, timeout=SHEETS_TIMEOUT * 3)
+    except asyncio.TimeoutError:
+        print(f"❌ Google Sheets no respondió al arrancar; el bot continuará sin base de datos - Hora: {obtener_hora_venezuela()}")
+        return
+    sheet_registro, sheet_vendedores, sheet_historial, sheet_estadisticas, sheet_resumen = hojas
+    for hoja_async, hoja in zip((hoja_registro, hoja_vendedores, hoja_historial,
+                                 hoja_estadisticas, hoja_resumen), hojas):
+        hoja_async.hoja = hoja
+    particiones.enlazar(mensuales)
+
+# Almacenamiento de datos: Google Sheets directo o SQLite local con réplica en Sheets
+BACKEND_DATOS = os.getenv('BACKEND_DATOS', 'sheets').lower()
+RUTA_SQLITE = os.getenv('RUTA_SQLITE', 'shisha_mgta.db')
+
+class AlmacenamientoSheets:
+    """Google Sheets como almacenamiento: cada operación escribe directo en las hojas
+
+    Las filas nuevas se agregan con values.append y la hoja dice en qué fila
+    quedaron. Las actualizaciones y bajas por número de fila comprueban antes
+    que la columna A siga teniendo el ID esperado (HojaAsync.ubicar): el dueño
+    puede agregar o borrar filas a mano. 'historial:AAAA-MM' es una partición mensual.
+    """
+
+    nombre = 'sheets'
+    # Como réplica de SQLite, lo que falte en la hoja se repone en lugar de fallar
+    es_replica = False
+
+    def _hoja(self, tabla):
+        if tabla.startswith('historial:'):
+            return particiones.hoja(tabla.split(':', 1)[1]) or HojaAsync(None, tabla)
+        return {
+            'registro': hoja_registro,
+            'vendedores': hoja_vendedores,
+            'historial': hoja_historial,
+            'estadisticas': hoja_estadisticas,
+            'resumen': hoja_resumen
+        }[tabla]
+
+    def disponible(self, tabla):
+        return bool(self._hoja(tabla))
+
+    async def iniciar(self):
+        """Sin tareas de arranque: las hojas ya quedaron enlazadas en conectar_google_sheets"""
+        return None
+
+    async def leer(self, tabla):
+        """Todas las filas de la tabla (encabezados incluidos), como en get_all_values"""
+        return await self._hoja(tabla).get_all_values()
+
+    async def leer_varias(self, tablas):
+        """Varias tablas completas en una sola petición (values_batch_get): una foto coherente"""
+        hojas = [self._hoja(tabla) for tabla in tablas]
+        if not hojas:
+            return {}
+        libro = hojas[0].hoja.spreadsheet
+        respuesta = await ejecutar_en_sheets(libro.values_batch_get, [f"'{hoja.nombre}'" for hoja in hojas])
+        return {tabla: rango.get('values', []) for tabla, rango in zip(tablas, respuesta.get('valueRanges', []))}
+
+    async def leer_filas(self, tabla, tramos, ultima_columna='F'):
+        """[(fila, valores)] de los tramos de filas [(inicio, fin)], sin leer la hoja entera
+
+        Los tramos de todas las lecturas simultáneas van en una misma petición.
+        """
+        hoja = self._hoja(tabla)
+        rangos = [hoja.rango('A', inicio, ultima_columna, fin) for inicio, fin in tramos]
+        valores = await lector_rangos.leer(hoja.hoja.spreadsheet, rangos) if rangos else []
+        filas = []
+        for (inicio, fin), filas_rango in zip(tramos, valores):
+            # La API omite las filas vacías del final del rango
+            filas += [(fila, filas_rango[i] if i < len(filas_rango) else [])
+                      for i, fila in enumerate(range(inicio, fin + 1))]
+        return filas
+
+    def particiones_existentes(self):
+        return particiones.existentes()
+
+    async def crear_particion(self, mes):
+        """Crea la pestaña del mes con sus encabezados (si otro proceso ya la creó, la enlaza)"""
+        if particiones.hoja(mes):
+            return
+        libro = hoja_registro.hoja.spreadsheet
+        nombre_hoja = nombre_particion(mes)
+        try:
+            hoja = await ejecutar_en_sheets(libro.add_worksheet, title=nombre_hoja, rows=1000,
+                                            cols=len(ENCABEZADOS_HISTORIAL))
+        except gspread.exceptions.APIError as e:
+            # Solo se enlaza si la pestaña ya existe (la creó otro proceso); el resto de errores sigue
+            if 'already exists' not in str(e):
+                raise
+            hoja = await ejecutar_en_sheets(libro.worksheet, nombre_hoja)
+        hoja_async = HojaAsync(hoja, nombre_hoja)
+        await hoja_async.update(hoja_async.rango('A', 1, 'E'), [ENCABEZADOS_HISTORIAL])
+        particiones.hojas[mes] = hoja_async
+        print(f"🗂️ Pestaña '{nombre_hoja}' creada - Hora: {obtener_hora_venezuela()}")
+
+    async def guardar_resumen(self, filas):
+        return await hoja_resumen.anexar(filas)
+
+    async def buscar_cliente(self, user_id):
+        celda = await hoja_registro.find(user_id, in_column=1)
+        if not celda:
+            return None
+        return celda.row, await hoja_registro.row_values(celda.row)
+
+    async def agregar_cliente(self, valores):
+        return await hoja_registro.anexar([valores])
+
+    async def registrar_compra(self, fila_cliente, valores_cliente, es_nuevo, mes_historial, valores_historial):
+        """Sellos y vendedor del cliente y su compra en el historial; devuelve la fila del cliente
+
+        Un cliente nuevo se agrega al final. Uno existente se escribe sin leer
+        antes en la fila que da el índice, y la misma petición confirma que la
+        fila era la suya (escribir_en_fila); su escritura y la del historial
+        salen a la vez. Solo si la hoja se editó a mano se deshace la escritura
+        y se busca al cliente.
+        """
+        user_id = str(valores_cliente[0])
+        if not es_nuevo and not fila_cliente:
+            fila_cliente = await hoja_registro.ubicar(None, user_id)
+            if fila_cliente is None and not self.es_replica:
+                raise ValueError(f"El cliente {user_id} ya no está en registro_clientes")
+        anexar_cliente = es_nuevo or fila_cliente is None
+        if anexar_cliente:
+            escrituras = [hoja_registro.anexar([valores_cliente])]
+        else:
+            escrituras = [hoja_registro.escribir_en_fila(fila_cliente, 4, valores_cliente[4:6])]
+
+        hoja_mes = None
+        if mes_historial:
+            # Las operaciones anteriores traen [mes, fila] o solo la fila del archivo
+            if isinstance(mes_historial, (list, tuple)):
+                mes_historial = mes_historial[0]
+            elif isinstance(mes_historial, int):
+                mes_historial = HISTORIAL_ARCHIVO
+            hoja_mes = particiones.hoja(mes_historial)
+            escrituras.append(hoja_mes.anexar([valores_historial]))
+
+        resultados = await asyncio.gather(*escrituras)
+        if anexar_cliente:
+            return resultados[0]
+        if resultados[0] == user_id:
+            return fila_cliente
+
+        # La fila ya no era del cliente: se devuelve a su dueño y se busca la correcta
+        await self._restaurar_fila_cliente(fila_cliente, resultados[0])
+        fila_real = await hoja_registro.ubicar(None, user_id)
+        if fila_real:
+            await hoja_registro.update(hoja_registro.rango('E', fila_real, 'F'), [valores_cliente[4:6]])
+            return fila_real
+        if self.es_replica:
+            return await hoja_registro.anexar([valores_cliente])
+        if hoja_mes:
+            await hoja_mes.delete_rows(resultados[1])
+        raise ValueError(f"El cliente {user_id} ya no está en registro_clientes")
+
+    async def _restaurar_fila_cliente(self, fila, user_id):
+        """Devuelve sellos y vendedor de la fila pisada a los de su dueño según el índice"""
+        entrada = indice_clientes.en_memoria(user_id) if user_id else None
+        if entrada:
+            valores = [entrada[1].sellos, entrada[1].vendedor]
+        elif not user_id:
+            valores = ["", ""]
+        else:
+            print(f"⚠️ Sellos y vendedor de {user_id} (fila {fila} de registro_clientes) sobrescritos; no está en memoria para restaurarlos - Hora: {obtener_hora_venezuela()}")
+            return
+        await hoja_registro.update(hoja_registro.rango('E', fila, 'F'), [valores])
+
+    async def eliminar_cliente(self, fila, user_id):
+        """Borra la fila del cliente y devuelve cuál era (None si ya no estaba)"""
+        fila = await hoja_registro.ubicar(fila, user_id)
+        if fila:
+            await hoja_registro.delete_rows(fila)
+        return fila
+
+    async def agregar_vendedor(self, valores):
+        return await hoja_vendedores.anexar([valores])
+
+    async def actualizar_estado_vendedor(self, fila, estado, user_id=None):
+        if user_id is not None:
+            fila = await hoja_vendedores.ubicar(fila, user_id)
+            if fila is None and self.es_replica:
+                return
+            if fila is None:
+                raise ValueError(f"El vendedor {user_id} ya no está en la hoja Vendedores")
+        await hoja_vendedores.update_cell(fila, 4, estado)
+
+    async def eliminar_vendedor(self, fila, user_id=None):
+        """Borra la fila del vendedor si sigue siendo suya; devuelve la fila o None"""
+        if user_id is not None and not await hoja_vendedores.ubicar(fila, user_id, buscar=False):
+            return None
+        await hoja_vendedores.delete_rows(fila)
+        return fila
+
+    async def guardar_estadisticas(self, filas):
+        await hoja_estadisticas.clear()
+        await hoja_estadisticas.update(hoja_estadisticas.rango('A', 1, 'F', len(filas)), filas)
+
+class AlmacenamientoSQLite:
+    """SQLite local como fuente de verdad; Google Sheets queda como réplica asíncrona
+
+    Cada tabla guarda el número de fila del registro (las filas nuevas van al
+    final); en la réplica es solo una pista que se comprueba antes de escribir. Cada cambio
+    se anota en la tabla 'replicacion' dentro de la misma transacción y el
+    ReplicadorSheets lo aplica después, en orden, con AlmacenamientoSheets.
+    El historial guarda además el mes de su partición (mes, fila_hoja).
+    """
+
+    nombre = 'sqlite'
+
+    TABLAS = {
+        'registro': ('clientes', ENCABEZADOS_REGISTRO,
+                     ['user_id', 'username', 'nombre_completo', 'fecha_registro', 'sellos', 'vendedor']),
+        'vendedores': ('vendedores', ENCABEZADOS_VENDEDORES,
+                       ['username', 'nombre', 'fecha_incorporacion', 'estado', 'privilegios']),
+        'estadisticas': ('estadisticas', ENCABEZADOS_ESTADISTICAS,
+                         ['vendedor', 'total_clientes', 'sellos_activos', 'sellos_inactivos',
+                          'total_ventas', 'fecha_actualizacion']),
+        'resumen': ('resumen', ENCABEZADOS_RESUMEN,
+                    ['mes', 'tipo', 'clave', 'vendedor', 'compras', 'clientes', 'ultima'])
+    }
+
+    def __init__(self, ruta, replica):
+        self.ruta = ruta
+        self.replica = replica
+        self.conexion = sqlite3.connect(ruta)
+        self.conexion.execute("PRAGMA journal_mode=WAL")
+        self.conexion.execute("PRAGMA synchronous=NORMAL")
+        with self.conexion:
+            self.conexion.executescript("""
+                CREATE TABLE IF NOT EXISTS clientes (
+                    fila INTEGER PRIMARY KEY, user_id TEXT UNIQUE, username TEXT,
+                    nombre_completo TEXT, fecha_registro TEXT, sellos INTEGER, vendedor TEXT);
+                CREATE TABLE IF NOT EXISTS vendedores (
+                    fila INTEGER PRIMARY KEY, username TEXT, nombre TEXT,
+                    fecha_incorporacion TEXT, estado TEXT, privilegios TEXT);
+                CREATE TABLE IF NOT EXISTS historial (
+                    fila INTEGER PRIMARY KEY, user_id TEXT, fecha TEXT,
+                    vendedor TEXT, cantidad INTEGER, tipo TEXT);
+                CREATE INDEX IF NOT EXISTS historial_user_id ON historial (user_id);
+                CREATE TABLE IF NOT EXISTS estadisticas (
+                    fila INTEGER PRIMARY KEY, vendedor TEXT, total_clientes INTEGER,
+                    sellos_activos INTEGER, sellos_inactivos INTEGER, total_ventas INTEGER,
+                    fecha_actualizacion TEXT);
+                CREATE TABLE IF NOT EXISTS resumen (
+                    fila INTEGER PRIMARY KEY, mes TEXT, tipo TEXT, clave TEXT, vendedor TEXT,
+                    compras INTEGER, clientes INTEGER, ultima TEXT);
+                CREATE TABLE IF NOT EXISTS replicacion (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, operacion TEXT, argumentos TEXT);
+                CREATE TABLE IF NOT EXISTS meta (clave TEXT PRIMARY KEY, valor TEXT);
+            """)
+            self._migrar_particiones()
+        replica.es_replica = True
+        self.replicador = ReplicadorSheets(self, replica)
+
+    def _migrar_particiones(self):
+        """Bases anteriores a las particiones: todo su historial pasa al archivo"""
+        columnas = {columna[1] for columna in self.conexion.execute("PRAGMA table_info(historial)")}
+        if 'mes' not in columnas:
+            self.conexion.execute("ALTER TABLE historial ADD COLUMN mes TEXT")
+            self.conexion.execute("ALTER TABLE historial ADD COLUMN fila_hoja INTEGER")
+            self.conexion.execute("UPDATE historial SET mes = ?, fila_hoja = fila", (HISTORIAL_ARCHIVO,))
+        self.conexion.execute("CREATE INDEX IF NOT EXISTS historial_mes ON historial (mes, fila_hoja)")
+
+    def disponible(self, tabla):
+        return True
+
+    async def iniciar(self):
+        """Importa las hojas la primera vez y arranca la réplica en segundo plano"""
+        hidratado = self.conexion.execute("SELECT valor FROM meta WHERE clave = 'hidratado'").fetchone()
+        if not hidratado and self.replica.disponible('registro'):
+            await self.hidratar_desde_sheets()
+        if self.replica.disponible('registro'):
+            self.replicador.iniciar()
+
+    async def hidratar_desde_sheets(self):
+        """Copia las hojas actuales a SQLite conservando los números de fila"""
+        tablas = [tabla for tabla in ('registro', 'vendedores', 'resumen') if self.replica.disponible(tabla)]
+        tablas += [f'historial:{mes}' for mes in self.replica.particiones_existentes()]
+        datos = await self.replica.leer_varias(tablas)
+
+        with self.conexion:
+            self.conexion.execute("DELETE FROM historial")
+            for tabla, filas in datos.items():
+                if tabla.startswith('historial:'):
+                    self.conexion.executemany(
+                        "INSERT INTO historial (user_id, fecha, vendedor, cantidad, tipo, mes, fila_hoja) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [
+                            (list(fila) + [""] * 5)[:5] + [tabla.split(':', 1)[1], fila_num]
+                            for fila_num, fila in enumerate(filas[1:], start=2)
+                            if fila and fila[0]
+                        ]
+                    )
+                    continue
+                nombre_tabla, _, columnas = self.TABLAS[tabla]
+                self.conexion.execute(f"DELETE FROM {nombre_tabla}")
+                self.conexion.executemany(
+                    f"INSERT OR IGNORE INTO {nombre_tabla} (fila, {', '.join(columnas)}) "
+                    f"VALUES (?{', ?' * len(columnas)})",
+                    [
+                        [fila_num] + (list(fila) + [""] * len(columnas))[:len(columnas)]
+                        for fila_num, fila in enumerate(filas[1:], start=2)
+                        if fila and fila[0]
+                    ]
+                )
+            self.conexion.execute("INSERT OR REPLACE INTO meta VALUES ('hidratado', ?)", (obtener_fecha_hora_venezuela(),))
+        print(f"💾 SQLite hidratado desde Google Sheets: "
+              f"{', '.join(f'{t}={max(len(f) - 1, 0)}' for t, f in datos.items())} - Hora: {obtener_hora_venezuela()}")
+
+    def _encolar(self, operacion, *argumentos):
+        self.conexion.execute(
+            "INSERT INTO replicacion (operacion, argumentos) VALUES (?, ?)",
+            (operacion, json.dumps(argumentos))
+        )
+
+    def _siguiente_fila(self, nombre_tabla, columna='fila', donde='', parametros=()):
+        return self.conexion.execute(
+            f"SELECT COALESCE(MAX({columna}), 1) + 1 FROM {nombre_tabla} {donde}", parametros
+        ).fetchone()[0]
+
+    def _desplazar_filas(self, nombre_tabla, desde):
+        # Dos pasos para no chocar con la clave primaria al correr las filas
+        self.conexion.execute(f"UPDATE {nombre_tabla} SET fila = -(fila - 1) WHERE fila > ?", (desde,))
+        self.conexion.execute(f"UPDATE {nombre_tabla} SET fila = -fila WHERE fila < 0")
+
+    async def leer(self, tabla):
+        if tabla.startswith('historial'):
+            # 'historial' a secas es el archivo, como la hoja HistorialCompras
+            mes = tabla.split(':', 1)[1] if ':' in tabla else HISTORIAL_ARCHIVO
+            consulta = ("SELECT fila_hoja, user_id, fecha, vendedor, cantidad, tipo FROM historial "
+                        "WHERE mes = ? ORDER BY fila_hoja", (mes,))
+            encabezados = ENCABEZADOS_HISTORIAL
+        else:
+            nombre_tabla, encabezados, columnas = self.TABLAS[tabla]
+            consulta = (f"SELECT fila, {', '.join(columnas)} FROM {nombre_tabla} ORDER BY fila",)
+        filas = [list(encabezados)]
+        for registro in self.conexion.execute(*consulta):
+            while len(filas) < registro[0] - 1:
+                filas.append([])
+            filas.append(["" if v is None else str(v) for v in registro[1:]])
+        return filas
+
+    async def leer_varias(self, tablas):
+        # Sin await entre lecturas: ninguna escritura puede colarse en medio
+        return {tabla: await self.leer(tabla) for tabla in tablas}
+
+    async def leer_filas(self, tabla, tramos, ultima_columna=None):
+        nombre_tabla, _, columnas = self.TABLAS[tabla]
+        filas = []
+        for inicio, fin in tramos:
+            encontradas = {
+                registro[0]: ["" if v is None else str(v) for v in registro[1:]]
+                for registro in self.conexion.execute(
+                    f"SELECT fila, {', '.join(columnas)} FROM {nombre_tabla} WHERE fila BETWEEN ? AND ?",
+                    (inicio, fin))
+            }
+            filas += [(fila, encontradas.get(fila, [])) for fila in range(inicio, fin + 1)]
+        return filas
+
+    def particiones_existentes(self):
+        return [mes for mes, in self.conexion.execute("SELECT DISTINCT mes FROM historial ORDER BY mes")]
+
+    async def crear_particion(self, mes):
+        # La partición nace con su primera compra; en Sheets hace falta la pestaña
+        with self.conexion:
+            self._encolar('crear_particion', mes)
+        self.replicador.avisar()
+
+    async def guardar_resumen(self, filas):
+        with self.conexion:
+            inicio = self._siguiente_fila('resumen')
+            self.conexion.executemany("INSERT INTO resumen VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                      [[i] + list(f) for i, f in enumerate(filas, start=inicio)])
+            self._encolar('guardar_resumen', filas)
+        self.replicador.avisar()
+        return inicio
+
+    async def buscar_cliente(self, user_id):
+        registro = self.conexion.execute(
+            "SELECT fila, user_id, username, nombre_completo, fecha_registro, sellos, vendedor "
+            "FROM clientes WHERE user_id = ?", (str(user_id),)
+        ).fetchone()
+        if not registro:
+            return None
+        return registro[0], ["" if v is None else str(v) for v in registro[1:]]
+
+    async def agregar_cliente(self, valores):
+        with self.conexion:
+            fila = self._siguiente_fila('clientes')
+            self.conexion.execute("INSERT INTO clientes VALUES (?, ?, ?, ?, ?, ?, ?)", [fila] + list(valores))
+            self._encolar('agregar_cliente', valores)
+        self.replicador.avisar()
+        return fila
+
+    async def registrar_compra(self, fila_cliente, valores_cliente, es_nuevo, mes_historial, valores_historial):
+        with self.conexion:
+            if es_nuevo:
+                fila_cliente = self._siguiente_fila('clientes')
+                self.conexion.execute("INSERT INTO clientes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                      [fila_cliente] + list(valores_cliente))
+            else:
+                self.conexion.execute("UPDATE clientes SET sellos = ?, vendedor = ? WHERE fila = ?",
+                                      (valores_cliente[4], valores_cliente[5], fila_cliente))
+            if mes_historial:
+                fila = self._siguiente_fila('historial', 'fila_hoja', "WHERE mes = ?", (mes_historial,))
+                self.conexion.execute(
+                    "INSERT INTO historial (user_id, fecha, vendedor, cantidad, tipo, mes, fila_hoja) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)", list(valores_historial) + [mes_historial, fila])
+            self._encolar('registrar_compra', fila_cliente, valores_cliente, es_nuevo,
+                          mes_historial, valores_historial)
+        self.replicador.avisar()
+        return fila_cliente
+
+    async def eliminar_cliente(self, fila, user_id):
+        with self.conexion:
+            self.conexion.execute("DELETE FROM clientes WHERE fila = ?", (fila,))
+            self._desplazar_filas('clientes', fila)
+            self._encolar('eliminar_cliente', fila, user_id)
+        self.replicador.avisar()
+        return fila
+
+    async def agregar_vendedor(self, valores):
+        with self.conexion:
+            fila = self._siguiente_fila('vendedores')
+            self.conexion.execute("INSERT INTO vendedores VALUES (?, ?, ?, ?, ?, ?)", [fila] + list(valores))
+            self._encolar('agregar_vendedor', valores)
+        self.replicador.avisar()
+        return fila
+
+    async def actualizar_estado_vendedor(self, fila, estado, user_id=None):
+        with self.conexion:
+            self.conexion.execute("UPDATE vendedores SET estado = ? WHERE fila = ?", (estado, fila))
+            self._encolar('actualizar_estado_vendedor', fila, estado, user_id)
+        self.replicador.avisar()
+
+    async def eliminar_vendedor(self, fila, user_id=None):
+        with self.conexion:
+            self.conexion.execute("DELETE FROM vendedores WHERE fila = ?", (fila,))
+            self._desplazar_filas('vendedores', fila)
+            self._encolar('eliminar_vendedor', fila, user_id)
+        self.replicador.avisar()
+        return fila
+
+    async def guardar_estadisticas(self, filas):
+        with self.conexion:
+            self.conexion.execute("DELETE FROM estadisticas")
+            self.conexion.executemany("INSERT INTO estadisticas VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                      [[i] + list(f) for i, f in enumerate(filas[1:], start=2)])
+            self._encolar('guardar_estadisticas', filas)
+        self.replicador.avisar()
+
+    def pendientes(self, limite=50):
+        return self.conexion.execute(
+            "SELECT id, operacion, argumentos FROM replicacion ORDER BY id LIMIT ?", (limite,)
+        ).fetchall()
+
+    def confirmar_replicado(self, id_operacion):
+        with self.conexion:
+            self.conexion.execute("DELETE FROM replicacion WHERE id = ?", (id_operacion,))
+
+class ReplicadorSheets:
+    """Aplica en segundo plano, y en orden, los cambios pendientes de SQLite sobre Google Sheets
+
+    Si una operación falla se reintenta con espera creciente sin saltarla:
+    las siguientes dependen de los números de fila que ella deja.
+    """
+
+    def __init__(self, origen, destino, espera_maxima=60):
+        self.origen = origen
+        self.destino = destino
+        self.espera_maxima = espera_maxima
+        self.evento = asyncio.Event()
+        self.tarea = None
+        self.replicadas = 0
+
+    def iniciar(self):
+        if not self.tarea:
+            self.tarea = asyncio.create_task(self._bucle())
+            print(f"🔁 Réplica SQLite → Google Sheets iniciada - Hora: {obtener_hora_venezuela()}")
+
+    def avisar(self):
+        self.evento.set()
+
+    async def detener(self):
+        if self.tarea:
+            self.tarea.cancel()
+            try:
+                await self.tarea
+            except asyncio.CancelledError:
+                pass
+            self.tarea = None
+
+    async def _bucle(self):
+        espera = 1
+        while True:
+            pendientes = self.origen.pendientes()
+            if not pendientes:
+                self.evento.clear()
+                await self.evento.wait()
+                continue
+
+            for id_operacion, operacion, argumentos in pendientes:
+                try:
+                    await getattr(self.destino, operacion)(*json.loads(argumentos))
+                except Exception as e:
+                    print(f"⚠️ Error replicando '{operacion}' en Google Sheets (reintento en {espera}s): {e}")
+                    await asyncio.sleep(espera)
+                    espera = min(espera * 2, self.espera_maxima)
+                    break
+                self.origen.confirmar_replicado(id_operacion)
+                self.replicadas += 1
+                espera = 1
+
+almacen_sheets = AlmacenamientoSheets()
+if BACKEND_DATOS == 'sqlite':
+    almacen = AlmacenamientoSQLite(RUTA_SQLITE, almacen_sheets)
+    print(f"💾 Almacenamiento principal: SQLite ({RUTA_SQLITE}) con réplica en Google Sheets")
+else:
+    almacen = almacen_sheets
+
+# Almacenamiento temporal
+QR_VALIDEZ_SEGUNDOS = 10 * 60
+BARRIDO_CODIGOS_SEGUNDOS = int(os.getenv('BARRIDO_CODIGOS_SEGUNDOS', '60'))
+# Tiempo durante el que un QR vencido responde "expirado" en vez de "inválido"
+QR_RECORDAR_VENCIDOS_SEGUNDOS = int(os.getenv('QR_RECORDAR_VENCIDOS_SEGUNDOS', str(24 * 3600)))
+MAX_VENCIDOS_RECORDADOS = 10000
+
+class AlmacenTTL:
+    """Diccionario con vencimiento por entrada.
+
+    Un min-heap ordenado por vencimiento permite insertar en O(log n), leer
+    en O(1) y purgar solo lo vencido sin recorrer todo el diccionario. Las
+    entradas del heap que ya no corresponden (claves usadas o reemplazadas)
+    se descartan al purgar. Con max_entradas, al llenarse se desaloja la
+    entrada más próxima a vencer. Con recordar_vencidos, las claves vencidas
+    se recuerdan ese tiempo para distinguirlas de las que nunca existieron.
+    """
+
+    def __init__(self, ttl, reloj=time.monotonic, max_entradas=None, recordar_vencidos=None):
+        self.ttl = ttl
+        self.reloj = reloj
+        self.max_entradas = max_entradas
+        self._datos = {}
+        self._heap = []
+        self._vencidos = AlmacenTTL(recordar_vencidos, reloj, max_entradas=MAX_VENCIDOS_RECORDADOS) if recordar_vencidos else None
+
+    def __len__(self):
+        return len(self._datos)
+
+    def guardar(self, clave, valor, ttl=None):
+        if self.max_entradas and clave not in self._datos and len(self._datos) >= self.max_entradas:
+            self.purgar() or self._desalojar()
+        vence = self.reloj() + (self.ttl if ttl is None else ttl)
+        self._datos[clave] = (vence, valor)
+        heapq.heappush(self._heap, (vence, clave))
+        if len(self._heap) > 2 * len(self._datos) + 64:
+            self._compactar()
+
+    def obtener(self, clave):
+        """Devuelve el valor vigente o None si no existe o ya venció"""
+        entrada = self._datos.get(clave)
+        if entrada is None:
+            return None
+        if entrada[0] <= self.reloj():
+            del self._datos[clave]
+            self._recordar_vencido(clave)
+            return None
+        return entrada[1]
+
+    def tomar(self, clave):
+        """Devuelve y elimina el valor vigente en un solo paso (None si no existe o venció)"""
+        valor = self.obtener(clave)
+        if valor is not None:
+            del self._datos[clave]
+        return valor
+
+    def quitar(self, clave):
+        entrada = self._datos.pop(clave, None)
+        return entrada[1] if entrada else None
+
+    def purgar(self):
+        """Elimina las entradas vencidas y devuelve cuántas se quitaron"""
+        ahora = self.reloj()
+        quitadas = 0
+        while self._heap and self._heap[0][0] <= ahora:
+            vence, clave = heapq.heappop(self._heap)
+            entrada = self._datos.get(clave)
+            if entrada and entrada[0] == vence:
+                del self._datos[clave]
+                self._recordar_vencido(clave)
+                quitadas += 1
+        return quitadas
+
+    def vencio(self, clave):
+        """True si la clave existió y venció hace menos de recordar_vencidos"""
+        return self._vencidos is not None and self._vencidos.obtener(clave) is not None
+
+    def _recordar_vencido(self, clave):
+        if self._vencidos is not None:
+            self._vencidos.guardar(clave, True)
+
+    def _desalojar(self):
+        """Quita la entrada vigente más próxima a vencer para respetar el límite"""
+        while self._heap:
+            vence, clave = heapq.heappop(self._heap)
+            entrada = self._datos.get(clave)
+            if entrada and entrada[0] == vence:
+                del self._datos[clave]
+                return
+
+    def limpiar(self):
+        self._datos.clear()
+        self._heap.clear()
+        if self._vencidos is not None:
+            self._vencidos.limpiar()
+
+    def _compactar(self):
+        self._heap = [(vence, clave) for clave, (vence, _) in self._datos.items()]
+        heapq.heapify(self._heap)
+
+codigos_activos = AlmacenTTL(QR_VALIDEZ_SEGUNDOS, recordar_vencidos=QR_RECORDAR_VENCIDOS_SEGUNDOS)
+
+# Estado de conversación: un flujo pendiente por usuario, con vencimiento
+FLUJO_TTL_SEGUNDOS = int(os.getenv('FLUJO_TTL_SEGUNDOS', '300'))
+MAX_ESTADOS_CONVERSACION = int(os.getenv('MAX_ESTADOS_CONVERSACION', '10000'))
+FLUJOS_TEXTO = ('agregar_vendedor', 'agregar_cliente', 'eliminar_cliente')
+
+estados_conversacion = AlmacenTTL(FLUJO_TTL_SEGUNDOS, max_entradas=MAX_ESTADOS_CONVERSACION)
+
+def iniciar_flujo(user_id, flujo, ttl=None, **datos):
+    """Registra el flujo pendiente del usuario (reemplaza cualquier otro)"""
+    estados_conversacion.guardar(str(user_id), {'flujo': flujo, **datos}, ttl)
+
+def flujo_activo(user_id, flujo=None):
+    """Devuelve el estado pendiente del usuario, opcionalmente solo si es de ese flujo"""
+    estado = estados_conversacion.obtener(str(user_id))
+    if estado and (flujo is None or estado['flujo'] == flujo):
+        return estado
+    return None
+
+def terminar_flujo(user_id):
+    return estados_conversacion.quitar(str(user_id))
+
+# Concurrencia: los updates se atienden en paralelo (MAX_UPDATES_CONCURRENTES)
+MAX_UPDATES_CONCURRENTES = int(os.getenv('MAX_UPDATES_CONCURRENTES', '32'))
+
+class CandadosPorClave:
+    """Un asyncio.Lock por clave, creado al usarse y liberado cuando nadie lo espera"""
+
+    def __init__(self):
+        self._candados = {}
+
+    def __len__(self):
+        return len(self._candados)
+
+    @contextlib.asynccontextmanager
+    async def bloquear(self, clave):
+        entrada = self._candados.get(clave)
+        if entrada is None:
+            entrada = self._candados[clave] = [asyncio.Lock(), 0]
+        entrada[1] += 1
+        try:
+            async with entrada[0]:
+                yield
+        finally:
+            entrada[1] -= 1
+            if entrada[1] == 0:
+                del self._candados[clave]
+
+class CandadoCompartido:
+    """Varios usos compartidos a la vez o uno exclusivo (con preferencia al exclusivo)
+
+    Las compras y altas de clientes lo toman compartido; la baja de un
+    cliente, que desplaza las filas de todos los demás, lo toma exclusivo.
+    """
+
+    def __init__(self):
+        self._compartidos = 0
+        self._exclusivo = False
+        self._condicion = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def compartido(self):
+        async with self._condicion:
+            await self._condicion.wait_for(lambda: not self._exclusivo)
+            self._compartidos += 1
+        try:
+            yield
+        finally:
+            async with self._condicion:
+                self._compartidos -= 1
+                self._condicion.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def exclusivo(self):
+        async with self._condicion:
+            await self._condicion.wait_for(lambda: not self._exclusivo)
+            self._exclusivo = True
+            await self._condicion.wait_for(lambda: self._compartidos == 0)
+        try:
+            yield
+        finally:
+            async with self._condicion:
+                self._exclusivo = False
+                self._condicion.notify_all()
+
+candados = CandadosPorClave()
+estructura_registro = CandadoCompartido()
+
+@contextlib.asynccontextmanager
+async def bloquear_cliente(user_id):
+    """Serializa las operaciones sobre un mismo cliente; clientes distintos no se esperan"""
+    async with estructura_registro.compartido():
+        async with candados.bloquear(f"cliente:{user_id}"):
+            yield
+
+def bloquear_vendedor(user_id):
+    """Serializa las altas y bajas de un mismo vendedor"""
+    return candados.bloquear(f"vendedor:{user_id}")
+
+# Salida hacia Telegram: límites de envío, reintentos y prioridades
+SALIDA_GLOBAL_POR_SEG = float(os.getenv('SALIDA_GLOBAL_POR_SEG', '30'))
+SALIDA_CHAT_POR_SEG = float(os.getenv('SALIDA_CHAT_POR_SEG', '1'))
+SALIDA_RAFAGA_CHAT = int(os.getenv('SALIDA_RAFAGA_CHAT', '3'))
+SALIDA_TRABAJADORES = int(os.getenv('SALIDA_TRABAJADORES', '8'))
+SALIDA_REINTENTOS = int(os.getenv('SALIDA_REINTENTOS', '3'))
+
+PRIORIDAD_CLIENTE = 0        # confirmaciones y respuestas al cliente
+PRIORIDAD_QR = 1             # QR para los vendedores
+PRIORIDAD_NOTIFICACION = 2   # avisos de venta a vendedores
+
+class DespachadorSalida:
+    """Cola de envíos a Telegram con prioridad y límites por chat y globales.
+
+    Cada envío pasa por una cubeta global y otra de su chat. Un RetryAfter
+    (429) pausa todos los envíos el tiempo indicado y el mensaje se reintenta;
+    los timeouts se reintentan con espera creciente. Con esperar=False el
+    envío sale del camino crítico del handler y los errores solo se registran.
+    """
+
+    MAX_CUBETAS = 10000
+
+    def __init__(self, global_por_seg=SALIDA_GLOBAL_POR_SEG, chat_por_seg=SALIDA_CHAT_POR_SEG,
+                 rafaga_chat=SALIDA_RAFAGA_CHAT, trabajadores=SALIDA_TRABAJADORES,
+                 reintentos=SALIDA_REINTENTOS):
+        self.global_ = CubetaTokens(global_por_seg, max(int(global_por_seg), 1))
+        self.chat_por_seg = chat_por_seg
+        self.rafaga_chat = rafaga_chat
+        self.num_trabajadores = trabajadores
+        self.reintentos = reintentos
+        self._cubetas = {}
+        self._pausa_hasta = 0.0
+        self._secuencia = 0
+        self._cola = None
+        self._loop = None
+        self._trabajadores = []
+        self.enviados = 0
+        self.limitados = 0
+        self.fallidos = 0
+
+    def _cubeta(self, chat_id):
+        cubeta = self._cubetas.get(chat_id)
+        if cubeta is None:
+            if len(self._cubetas) >= self.MAX_CUBETAS:
+                self._cubetas = {c: b for c, b in self._cubetas.items() if not b.llena()}
+            cubeta = self._cubetas[chat_id] = CubetaTokens(self.chat_por_seg, self.rafaga_chat)
+        return cubeta
+
+    def _asegurar_trabajadores(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._cola = asyncio.PriorityQueue()
+            self._trabajadores = [loop.create_task(self._trabajar()) for _ in range(self.num_trabajadores)]
+
+    def enviar(self, chat_id, funcion, prioridad=PRIORIDAD_CLIENTE, esperar=True):
+        """Encola funcion() (una llamada a la API de Telegram) y devuelve un futuro con su resultado
+
+        Con esperar=True el futuro falla si el envío no se pudo hacer; si no,
+        el error solo se imprime y el futuro termina con None.
+        """
+        self._asegurar_trabajadores()
+        futuro = self._loop.create_future()
+        self._secuencia += 1
+        self._cola.put_nowait((prioridad, self._secuencia, chat_id, funcion, futuro, esperar))
+        return futuro
+
+    async def detener(self):
+        """Espera a que salga lo encolado y detiene los trabajadores"""
+        if self._cola is not None and self._loop is asyncio.get_running_loop():
+            await self._cola.join()
+        for tarea in self._trabajadores:
+            tarea.cancel()
+        await asyncio.gather(*self._trabajadores, return_exceptions=True)
+        self._trabajadores = []
+        self._loop = None
+
+    async def _trabajar(self):
+        while True:
+            _, _, chat_id, funcion, futuro, esperar = await self._cola.get()
+            try:
+                resultado = await self._entregar(chat_id, funcion)
+                if not futuro.done():
+                    futuro.set_result(resultado)
+            except Exception as e:
+                self.fallidos += 1
+                print(f"❌ Envío a {chat_id} fallido: {e} - Hora: {obtener_hora_venezuela()}")
+                if not futuro.done():
+                    if esperar:
+                        futuro.set_exception(e)
+                    else:
+                        futuro.set_result(None)
+            finally:
+                self._cola.task_done()
+
+    async def _entregar(self, chat_id, funcion):
+        for intento in range(self.reintentos + 1):
+            pausa = self._pausa_hasta - time.monotonic()
+            if pausa > 0:
+                await asyncio.sleep(pausa)
+            espera = max(self.global_.reservar(), self._cubeta(chat_id).reservar())
+            if espera > 0:
+                await asyncio.sleep(espera)
+            try:
+                resultado = await funcion()
+                self.enviados += 1
+                return resultado
+            except RetryAfter as e:
+                if intento == self.reintentos:
+                    raise
+                segundos = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + segundos)
+                self.limitados += 1
+                print(f"⏳ Telegram pidió esperar {segundos:.0f}s (chat {chat_id}) - Hora: {obtener_hora_venezuela()}")
+            except TimedOut:
+                if intento == self.reintentos:
+                    raise
+                await asyncio.sleep(0.5 * 2 ** intento)
+
+despachador = DespachadorSalida()
+
+async def responder(update: Update, texto, prioridad=PRIORIDAD_CLIENTE, **kwargs):
+    """reply_text a través del despachador de salida"""
+    return await despachador.enviar(update.effective_user.id,
+                                    functools.partial(update.message.reply_text, texto, **kwargs),
+                                    prioridad)
+
+async def editar(query, texto, prioridad=PRIORIDAD_CLIENTE, **kwargs):
+    """edit_message_text de un botón inline a través del despachador de salida
+
+    query.answer() no pasa por aquí: no es un mensaje del chat y Telegram
+    espera la respuesta al instante.
+    """
+    return await despachador.enviar(query.from_user.id,
+                                    functools.partial(query.edit_message_text, texto, **kwargs),
+                                    prioridad)
+
+# Filas de las hojas como registros compactos
+def entero(valor, defecto=0):
+    """Celda numérica de la hoja ('', '7', 7, 'x') -> int"""
+    try:
+        return int(valor) if valor not in ("", None) else defecto
+    except (TypeError, ValueError):
+        return defecto
+
+def mapa_columnas(encabezados, esperados):
+    """Posición de cada columna esperada según la fila de encabezados leída
+
+    Se calcula una vez por lectura de la hoja. Un encabezado que no aparece
+    conserva su posición por defecto (el orden de 'esperados').
+    """
+    posiciones = {str(nombre).strip().lower(): i for i, nombre in enumerate(encabezados or ())}
+    return tuple(posiciones.get(nombre.lower(), i) for i, nombre in enumerate(esperados))
+
+def celdas(fila, columnas):
+    """Valores de la fila en el orden de 'columnas' ('' si la fila es más corta)"""
+    largo = len(fila)
+    return [fila[i] if i < largo else "" for i in columnas]
+
+COLUMNAS_REGISTRO = tuple(range(len(ENCABEZADOS_REGISTRO)))
+COLUMNAS_VENDEDORES = tuple(range(len(ENCABEZADOS_VENDEDORES)))
+COLUMNAS_HISTORIAL = tuple(range(len(ENCABEZADOS_HISTORIAL)))
+COLUMNAS_RESUMEN = tuple(range(len(ENCABEZADOS_RESUMEN)))
+
+class Cliente:
+    """Fila de registro_clientes, con los sellos ya como entero"""
+
+    __slots__ = ('user_id', 'username', 'nombre', 'fecha_registro', 'sellos', 'vendedor')
+
+    def __init__(self, user_id, username="", nombre="", fecha_registro="", sellos=0, vendedor=""):
+        self.user_id = user_id
+        self.username = username
+        self.nombre = nombre
+        self.fecha_registro = fecha_registro
+        self.sellos = sellos
+        self.vendedor = vendedor
+
+    @classmethod
+    def desde_fila(cls, fila, columnas=COLUMNAS_REGISTRO):
+        user_id, username, nombre, fecha_registro, sellos, vendedor = celdas(fila, columnas)
+        return cls(str(user_id), username, nombre, fecha_registro, entero(sellos), vendedor)
+
+    def valores(self):
+        """Fila tal como se escribe en la hoja"""
+        return [self.user_id, self.username, self.nombre, self.fecha_registro, self.sellos, self.vendedor]
+
+    def copia(self):
+        return Cliente(*self.valores())
+
+class Vendedor:
+    """Vendedor activo: ID de Telegram, nombre y privilegios (admin/premium/normal)"""
+
+    __slots__ = ('user_id', 'nombre', 'privilegios')
+
+    def __init__(self, user_id, nombre, privilegios='normal'):
+        self.user_id = user_id
+        self.nombre = nombre
+        self.privilegios = privilegios
+
+class Compra:
+    """Compra del historial de un cliente (el cliente es la clave del índice)"""
+
+    __slots__ = ('fecha', 'vendedor', 'cantidad', 'tipo')
+
+    def __init__(self, fecha, vendedor, cantidad=1, tipo="compra_normal"):
+        self.fecha = fecha
+        self.vendedor = vendedor
+        self.cantidad = cantidad
+        self.tipo = tipo
+
+    @classmethod
+    def desde_fila(cls, fila, columnas=COLUMNAS_HISTORIAL):
+        _, fecha, vendedor, cantidad, tipo = celdas(fila, columnas)
+        return cls(fecha, vendedor, entero(cantidad, 1), tipo)
+
+# Registro de vendedores en memoria
+VENDEDORES_TTL = int(os.getenv('VENDEDORES_TTL', '300'))
+
+class RegistroVendedores:
+    """Vendedores activos indexados por ID y por nombre.
+
+    Se construye con una sola lectura de la hoja de vendedores; la limpieza
+    de duplicados se calcula sobre esa misma lectura. Política de frescura:
+    los datos se consideran válidos durante VENDEDORES_TTL segundos; los
+    cambios hechos por el bot (agregar/desactivar) se aplican al momento en
+    memoria y las ediciones manuales en la hoja se ven al vencer el TTL o
+    con el botón ACTUALIZAR CACHE.
+    """
+
+    def __init__(self):
+        self.por_id = {}
+        self.por_nombre = {}
+        self.filas = {}
+        self.premium = set()
+        self.normales = set()
+        self.timestamp = None
+        self.aciertos = 0
+        self.fallos = 0
+        self._lock = asyncio.Lock()
+
+    def vigente(self):
+        return (self.timestamp is not None and
+                time.monotonic() - self.timestamp < VENDEDORES_TTL)
+
+    def invalidar(self):
+        self.timestamp = None
+
+    def _indexar(self, vendedor, fila=None):
+        user_id = vendedor.user_id
+        self.por_id[user_id] = vendedor
+        self.por_nombre[vendedor.nombre] = vendedor
+        if fila is not None:
+            self.filas[user_id] = fila
+        if vendedor.privilegios == 'premium':
+            self.premium.add(user_id)
+        elif user_id != ADMIN_ID:
+            self.normales.add(user_id)
+
+    def _quitar(self, user_id):
+        vendedor = self.por_id.pop(user_id, None)
+        if vendedor and self.por_nombre.get(vendedor.nombre) is vendedor:
+            del self.por_nombre[vendedor.nombre]
+        self.filas.pop(user_id, None)
+        self.premium.discard(user_id)
+        self.normales.discard(user_id)
+        return vendedor
+
+    def _construir(self, todos_datos, columnas):
+        self.por_id, self.por_nombre, self.filas = {}, {}, {}
+        self.premium, self.normales = set(), set()
+        
+        for fila_num, fila in enumerate(todos_datos[1:], start=2):
+            if not fila or not any(fila):
+                continue
+            user_id, nombre, _, estado, privilegios = celdas(fila, columnas)
+            user_id = str(user_id)
+            estado = estado or 'SI'
+            if estado.upper() != 'SI' or not user_id.isdigit() or user_id in self.por_id:
+                continue
+            self._indexar(Vendedor(user_id, nombre or 'Sin nombre', privilegios or 'normal'), fila_num)
+        
+        if ADMIN_ID not in self.por_id:
+            self._indexar(Vendedor(ADMIN_ID, 'Alushi_1 (Admin)', 'admin'))
+
+    async def _limpiar_duplicados(self, todos_datos, columnas):
+        """Elimina duplicados activos detectados en la lectura ya hecha"""
+        columna_id, columna_estado = columnas[0], columnas[3]
+        vistos = set()
+        filas_a_eliminar = []
+        for fila_num, fila in enumerate(todos_datos[1:], start=2):
+            if len(fila) > columna_id and fila[columna_id]:
+                user_id = fila[columna_id]
+                estado = fila[columna_estado] if len(fila) > columna_estado else 'SI'
+                if user_id == ADMIN_ID:
+                    continue
+                if user_id in vistos and estado == 'SI':
+                    filas_a_eliminar.append(fila_num)
+                else:
+                    vistos.add(user_id)
+        
+        for fila_num in sorted(filas_a_eliminar, reverse=True):
+            # Si la fila ya no es de ese vendedor (la hoja cambió) no se borra
+            if await almacen.eliminar_vendedor(fila_num, todos_datos[fila_num - 1][columna_id]):
+                del todos_datos[fila_num - 1]
+        
+        if filas_a_eliminar:
+            print(f"🧹 Duplicados eliminados: {len(filas_a_eliminar)}")
+        return len(filas_a_eliminar)
+
+    async def refrescar(self, todos_datos=None):
+        """Relee la hoja de vendedores una sola vez (o usa 'todos_datos') y reconstruye los índices"""
+        async with self._lock:
+            if not almacen.disponible('vendedores') or (todos_datos is None and self.vigente()):
+                # Otra tarea (p. ej. el calentamiento) acaba de refrescar mientras se esperaba
+                return
+            if todos_datos is None:
+                todos_datos = await almacen.leer('vendedores')
+            columnas = mapa_columnas(todos_datos[0] if todos_datos else (), ENCABEZADOS_VENDEDORES)
+            await self._limpiar_duplicados(todos_datos, columnas)
+            self._construir(todos_datos, columnas)
+            self.timestamp = time.monotonic()
+            print(f"🎯 Total vendedores activos encontrados: {len(self.por_id)} - Hora: {obtener_hora_venezuela()}")
+
+    async def asegurar(self):
+        """Garantiza datos vigentes según la política de frescura"""
+        if self.vigente():
+            self.aciertos += 1
+            return
+        self.fallos += 1
+        await self.refrescar()
+
+    def vendedor_agregado(self, fila_num, valores):
+        """Aplica en memoria un vendedor recién escrito en la hoja"""
+        self._indexar(Vendedor(str(valores[0]), valores[1], valores[4]), fila_num)
+
+    def vendedor_desactivado(self, user_id):
+        """Quita de los índices un vendedor marcado como inactivo"""
+        return self._quitar(user_id)
+
+    def activos(self):
+        return list(self.por_id.values())
+
+registro_vendedores = RegistroVendedores()
+metricas.registrar_cache('registro_vendedores', registro_vendedores)
+
+# Índice en memoria de registro_clientes
+MAX_CLIENTES_EN_MEMORIA = int(os.getenv('MAX_CLIENTES_EN_MEMORIA', '50000'))
+
+def clientes_de_filas(todos_datos):
+    """[(fila, Cliente)] de una lectura completa de registro_clientes"""
+    if not todos_datos:
+        return []
+    columnas = mapa_columnas(todos_datos[0], ENCABEZADOS_REGISTRO)
+    columna_id = columnas[0]
+    return [
+        (fila_num, Cliente.desde_fila(fila, columnas))
+        for fila_num, fila in enumerate(todos_datos[1:], start=2)
+        if len(fila) > columna_id and fila[columna_id]
+    ]
+
+def filas_de_clientes(todos_datos, vendedor=None):
+    """(columnas, filas) de registro_clientes para un listado, sin convertir
+
+    Con 'vendedor' solo quedan sus clientes; se convierten a Cliente
+    únicamente las filas que se muestran.
+    """
+    if not todos_datos:
+        return COLUMNAS_REGISTRO, []
+    columnas = mapa_columnas(todos_datos[0], ENCABEZADOS_REGISTRO)
+    columna_id, columna_vendedor = columnas[0], columnas[5]
+    filas = todos_datos[1:]
+    if vendedor is not None:
+        filas = [fila for fila in filas if len(fila) > columna_vendedor and fila[columna_vendedor] == vendedor]
+    return columnas, [fila for fila in filas if len(fila) > columna_id and fila[columna_id]]
+
+class IndiceClientes:
+    """Espejo write-through de registro_clientes: user_id -> (fila, Cliente)
+
+    Se carga una sola vez desde el almacenamiento y se actualiza con cada alta,
+    cambio o baja que hace el bot. Si se supera MAX_CLIENTES_EN_MEMORIA se
+    desalojan los clientes menos usados; a partir de ahí un fallo en memoria se
+    resuelve con una búsqueda puntual por user_id.
+    """
+
+    def __init__(self, max_entradas=MAX_CLIENTES_EN_MEMORIA):
+        self.max_entradas = max_entradas
+        self._clientes = OrderedDict()
+        self._por_vendedor = {}
+        self.columnas = COLUMNAS_REGISTRO
+        self.completo = False
+        self.cargado = False
+        self.aciertos = 0
+        self.fallos = 0
+
+    async def cargar(self, todos_datos=None, clientes=None):
+        """Carga (o recarga) el espejo completo con una sola lectura
+
+        'clientes' son esas mismas filas ya convertidas (clientes_de_filas),
+        para no convertirlas dos veces si quien leyó la hoja también las usa.
+        """
+        if not almacen.disponible('registro'):
+            return 0
+        if todos_datos is None:
+            try:
+                todos_datos = await almacen.leer('registro')
+            except Exception as e:
+                print(f"❌ Error cargando índice de clientes: {e}")
+                return 0
+
+        if clientes is None:
+            clientes = clientes_de_filas(todos_datos)
+        self.columnas = mapa_columnas(todos_datos[0] if todos_datos else (), ENCABEZADOS_REGISTRO)
+        self._clientes = OrderedDict()
+        self._por_vendedor = {}
+        self.completo = True
+        for fila_num, cliente in clientes:
+            if cliente.user_id not in self._clientes:
+                self._guardar(cliente.user_id, fila_num, cliente)
+        hoja_registro.ultima_fila = max(len(todos_datos), 1)
+        self.cargado = True
+        print(f"📇 Índice de clientes cargado: {len(self._clientes)} clientes - Hora: {obtener_hora_venezuela()}")
+        return len(self._clientes)
+
+    def _guardar(self, user_id, fila_num, cliente):
+        self._clientes[user_id] = (fila_num, cliente)
+        self._clientes.move_to_end(user_id)
+        # Las bajas y cambios de vendedor se limpian al consultar (filas_de_vendedor)
+        self._por_vendedor.setdefault(cliente.vendedor, set()).add(user_id)
+        while len(self._clientes) > self.max_entradas:
+            self._clientes.popitem(last=False)
+            self.completo = False
+
+    async def obtener(self, user_id):
+        """Devuelve (fila, Cliente) del cliente o None si no está registrado
+
+        Mientras el calentamiento del arranque carga el espejo, los clientes se
+        buscan puntualmente por su ID para no hacer esperar al usuario.
+        """
+        user_id = str(user_id)
+        if not self.cargado and not cargando_datos():
+            await self.cargar()
+
+        entrada = self._clientes.get(user_id)
+        if entrada:
+            self._clientes.move_to_end(user_id)
+            self.aciertos += 1
+            return entrada
+
+        self.fallos += 1
+        if self.completo or not almacen.disponible('registro'):
+            return None
+
+        # Cliente desalojado de memoria: buscar solo por su ID
+        encontrado = await almacen.buscar_cliente(user_id)
+        if not encontrado:
+            return None
+        fila_num, valores = encontrado
+        cliente = Cliente.desde_fila(valores, self.columnas)
+        self._guardar(user_id, fila_num, cliente)
+        return fila_num, cliente
+
+    async def existe(self, user_id):
+        return await self.obtener(user_id) is not None
+
+    def en_memoria(self, user_id):
+        """(fila, Cliente) si el cliente está en memoria, sin buscarlo en la hoja ni contar el acceso"""
+        return self._clientes.get(str(user_id))
+
+    def fila_de(self, user_id):
+        """Fila conocida del cliente en registro_clientes, o None si no está en memoria"""
+        entrada = self.en_memoria(user_id)
+        return entrada[0] if entrada else None
+
+    def filas_de_vendedor(self, vendedor):
+        """[(fila, user_id)] de los clientes del vendedor, en orden de fila
+
+        Solo es la lista completa si el índice lo es (self.completo).
+        """
+        miembros = self._por_vendedor.get(vendedor, set())
+        filas = []
+        for user_id in list(miembros):
+            entrada = self._clientes.get(user_id)
+            if entrada and entrada[1].vendedor == vendedor:
+                filas.append((entrada[0], user_id))
+            else:
+                miembros.discard(user_id)
+        filas.sort()
+        return filas
+
+    async def agregar(self, fila):
+        """Agrega un cliente al final de la hoja y al índice"""
+        await datos_listos()
+        fila_num = await almacen.agregar_cliente(list(fila))
+        fila_num, cliente = self.registrar_local(fila_num, Cliente.desde_fila([str(v) for v in fila]))
+        estadisticas_vivas.cliente_agregado(cliente)
+        return fila_num, cliente
+
+    def registrar_local(self, fila_num, cliente):
+        """Refleja en el índice una fila que ya se escribió en la hoja"""
+        self._guardar(cliente.user_id, fila_num, cliente)
+        hoja_registro.ultima_fila = max(hoja_registro.ultima_fila or 1, fila_num)
+        return fila_num, cliente
+
+    async def eliminar(self, user_id):
+        """Elimina la fila del cliente y desplaza las filas posteriores del índice"""
+        await datos_listos()
+        entrada = await self.obtener(user_id)
+        if not entrada:
+            return None
+        fila_esperada, cliente = entrada
+        fila_num = await almacen.eliminar_cliente(fila_esperada, str(user_id))
+        del self._clientes[str(user_id)]
+        if fila_num != fila_esperada:
+            # La hoja se editó a mano: las filas del índice ya no son fiables
+            programar_carga_datos()
+        if fila_num:
+            for otro_id, (otra_fila, otro_cliente) in list(self._clientes.items()):
+                if otra_fila > fila_num:
+                    self._clientes[otro_id] = (otra_fila - 1, otro_cliente)
+            if hoja_registro.ultima_fila:
+                hoja_registro.ultima_fila = max(hoja_registro.ultima_fila - 1, 1)
+        estadisticas_vivas.cliente_eliminado(cliente)
+        return cliente
+
+indice_clientes = IndiceClientes()
+metricas.registrar_cache('indice_clientes', indice_clientes)
+
+class EstadisticasEnVivo:
+    """Agregados de clientes y ventas mantenidos en memoria
+
+    Se construyen una vez a partir de registro_clientes, el resumen de los
+    meses cerrados del historial y las filas de los abiertos, y luego se
+    actualizan con cada compra, registro o baja, de modo que las estadísticas
+    y el ranking se calculan sin leer Google Sheets.
+    """
+
+    def __init__(self):
+        self.construido = False
+        self.version = 0
+        self.reiniciar()
+
+    def reiniciar(self):
+        self.version += 1
+        self.total_clientes = 0
+        self.total_sellos = 0
+        self.distribucion_sellos = Counter()
+        self.registros_por_fecha = Counter()
+        self.clientes_por_vendedor = {}
+        self.total_ventas = 0
+        self.ventas_por_vendedor = {}
+        # Resumen diario: fecha -> vendedor -> ventas, ingreso, clientes distintos, última venta
+        self.ventas_diarias = {}
+        self.fechas_con_ventas = []
+
+    def construir(self, clientes, resumen, historiales):
+        """Recalcula todos los agregados a partir de los datos de las hojas
+
+        clientes: [(fila, Cliente)] de registro_clientes; resumen: filas de
+        ResumenHistorial (meses cerrados); historiales: filas de cada
+        partición abierta.
+        """
+        self.reiniciar()
+        for _, cliente in clientes:
+            self._sumar_cliente(cliente, 1)
+        for fila in resumen[1:]:
+            mes, tipo, clave, vendedor, compras, clientes, ultima = parsear_resumen(fila)
+            if tipo == 'dia':
+                self._sumar_ventas(clave, vendedor, compras, ultima, clientes=clientes)
+            elif tipo == 'cliente' and vendedor:
+                self._datos_vendedor(vendedor)['clientes_unicos'].add(clave)
+        for datos_historial in historiales:
+            if not datos_historial:
+                continue
+            columnas = mapa_columnas(datos_historial[0], ENCABEZADOS_HISTORIAL)[:3]
+            for fila in datos_historial[1:]:
+                if fila and any(fila):
+                    self.compra_registrada(*celdas(fila, columnas))
+        self.construido = True
+        print(f"📈 Estadísticas en memoria: {self.total_clientes} clientes, {self.total_ventas} ventas - Hora: {obtener_hora_venezuela()}")
+
+    def _sumar_cliente(self, cliente, signo):
+        self.version += 1
+        sellos = cliente.sellos
+        self.total_clientes += signo
+        self.total_sellos += signo * sellos
+        self.distribucion_sellos[sellos] += signo
+        self.registros_por_fecha[cliente.fecha_registro] += signo
+
+        vendedor = cliente.vendedor
+        if vendedor:
+            datos = self.clientes_por_vendedor.setdefault(
+                vendedor, {'clientes': 0, 'sellos': 0, 'sin_sellos': 0, 'cerca_premio': 0}
+            )
+            datos['clientes'] += signo
+            datos['sellos'] += signo * sellos
+            if sellos == 0:
+                datos['sin_sellos'] += signo
+            elif sellos >= SELLOS_CERCA_PREMIO:
+                datos['cerca_premio'] += signo
+
+    def cliente_agregado(self, cliente):
+        self._sumar_cliente(cliente, 1)
+
+    def cliente_eliminado(self, cliente):
+        self._sumar_cliente(cliente, -1)
+
+    def cliente_modificado(self, antes, despues):
+        self._sumar_cliente(antes, -1)
+        self._sumar_cliente(despues, 1)
+
+    def _datos_vendedor(self, vendedor):
+        return self.ventas_por_vendedor.setdefault(
+            vendedor, {'ventas': 0, 'clientes_unicos': set(), 'ultima_venta': ''}
+        )
+
+    def _dia(self, fecha, vendedor):
+        vendedores = self.ventas_diarias.get(fecha)
+        if vendedores is None:
+            vendedores = self.ventas_diarias[fecha] = {}
+            bisect.insort(self.fechas_con_ventas, fecha)
+        return vendedores.setdefault(
+            vendedor, {'ventas': 0, 'ingreso': 0, 'clientes': 0, 'ultima_venta': '', 'vistos': None}
+        )
+
+    def _sumar_ventas(self, fecha, vendedor, ventas, ultima_venta, user_id=None, clientes=0):
+        """Suma ventas al total, al día y al vendedor
+
+        user_id: cliente de una compra suelta; clientes: distintos del día ya
+        contados (filas 'dia' del resumen, cuyos user_id no se conocen).
+        """
+        self.version += 1
+        self.total_ventas += ventas
+        dia = self._dia(fecha[:10], vendedor)
+        dia['ventas'] += ventas
+        dia['ingreso'] += ventas * PRECIO_VENTA
+        dia['clientes'] += clientes
+        dia['ultima_venta'] = max(dia['ultima_venta'], ultima_venta)
+        if user_id:
+            if dia['vistos'] is None:
+                dia['vistos'] = set()
+            if user_id not in dia['vistos']:
+                dia['vistos'].add(user_id)
+                dia['clientes'] += 1
+        if vendedor:
+            datos = self._datos_vendedor(vendedor)
+            datos['ventas'] += ventas
+            datos['ultima_venta'] = max(datos['ultima_venta'], ultima_venta)
+            if user_id:
+                datos['clientes_unicos'].add(user_id)
+
+    def compra_registrada(self, user_id, fecha_hora, vendedor):
+        self._sumar_ventas(fecha_hora, vendedor, 1, fecha_hora, user_id=user_id)
+
+    def ventas_en(self, desde, hasta):
+        """Ventas por vendedor entre dos fechas 'AAAA-MM-DD' (inclusive)
+
+        Recorre solo los días con ventas de la ventana: O(días × vendedores).
+        Los clientes distintos son exactos en los días con compras en memoria;
+        en los que solo se conocen por el resumen se suman los de cada día.
+        """
+        ventas = {}
+        inicio = bisect.bisect_left(self.fechas_con_ventas, desde)
+        fin = bisect.bisect_right(self.fechas_con_ventas, hasta)
+        for fecha in self.fechas_con_ventas[inicio:fin]:
+            for vendedor, dia in self.ventas_diarias[fecha].items():
+                datos = ventas.setdefault(vendedor, {
+                    'ventas': 0, 'ingreso': 0, 'clientes': set(), 'resumidos': 0, 'ultima_venta': ''
+                })
+                datos['ventas'] += dia['ventas']
+                datos['ingreso'] += dia['ingreso']
+                datos['ultima_venta'] = max(datos['ultima_venta'], dia['ultima_venta'])
+                vistos = dia['vistos'] or ()
+                datos['clientes'].update(vistos)
+                datos['resumidos'] += dia['clientes'] - len(vistos)
+        return {
+            vendedor: {
+                'ventas': datos['ventas'],
+                'ingreso': datos['ingreso'],
+                'clientes_unicos': len(datos['clientes']) + datos['resumidos'],
+                'ultima_venta': datos['ultima_venta']
+            }
+            for vendedor, datos in ventas.items()
+        }
+
+    def clientes_con_sellos(self):
+        return self.total_clientes - self.distribucion_sellos[0]
+
+    def clientes_cerca_premio(self):
+        return sum(self.distribucion_sellos[s] for s in range(SELLOS_CERCA_PREMIO, SELLOS_PARA_PREMIO))
+
+    def instantanea(self, vendedores_activos, ventana=None):
+        return InstantaneaEstadisticas(self, vendedores_activos, ventana)
+
+class InstantaneaEstadisticas:
+    """Foto de los agregados (y de los vendedores activos) para un reporte
+
+    Se copia de una vez, sin awaits de por medio, y la comparten todas las
+    piezas de un mismo reporte: aunque entre una venta mientras se arma, los
+    números no se contradicen. 'version' identifica el estado copiado. Con
+    una ventana (etiqueta, desde, hasta) las ventas por vendedor y
+    ventas_ventana son los de esas fechas; sin ella, los de todo el historial.
+    """
+
+    def __init__(self, estadisticas, vendedores_activos, ventana=None):
+        self.version = estadisticas.version
+        self.tomada = obtener_fecha_hora_venezuela()
+        self.hoy = obtener_fecha_venezuela()
+        self.total_clientes = estadisticas.total_clientes
+        self.total_sellos = estadisticas.total_sellos
+        self.total_ventas = estadisticas.total_ventas
+        self.clientes_con_sellos = estadisticas.clientes_con_sellos()
+        self.clientes_cerca_premio = estadisticas.clientes_cerca_premio()
+        self.clientes_nuevos_hoy = estadisticas.registros_por_fecha[self.hoy]
+        self.ventas_hoy = sum(datos['ventas'] for datos in estadisticas.ventas_en(self.hoy, self.hoy).values())
+        self.clientes_por_vendedor = {
+            vendedor: dict(datos) for vendedor, datos in estadisticas.clientes_por_vendedor.items()
+        }
+        self.ventana = ventana
+        if ventana:
+            self.ventas_por_vendedor = estadisticas.ventas_en(ventana[1], ventana[2])
+            self.ventas_ventana = sum(datos['ventas'] for datos in self.ventas_por_vendedor.values())
+        else:
+            self.ventas_ventana = self.total_ventas
+            self.ventas_por_vendedor = {
+                vendedor: {
+                    'ventas': datos['ventas'],
+                    'ingreso': datos['ventas'] * PRECIO_VENTA,
+                    'clientes_unicos': len(datos['clientes_unicos']),
+                    'ultima_venta': datos['ultima_venta']
+                }
+                for vendedor, datos in estadisticas.ventas_por_vendedor.items()
+            }
+        self.vendedores_activos = list(vendedores_activos)
+
+estadisticas_vivas = EstadisticasEnVivo()
+
+async def tomar_instantanea(ventana=None):
+    """Asegura los datos en memoria y copia los agregados para un reporte"""
+    if not estadisticas_vivas.construido:
+        await cargar_datos_en_memoria()
+    vendedores_activos = await obtener_vendedores_activos()
+    return estadisticas_vivas.instantanea(vendedores_activos, ventana)
+
+def parsear_ventana(args):
+    """Argumentos de /estadisticas y /ranking -> (etiqueta, desde, hasta), o None sin argumentos
+
+    hoy | semana (desde el lunes) | mes | rango AAAA-MM-DD AAAA-MM-DD.
+    Lanza ValueError si no se entienden.
+    """
+    if not args:
+        return None
+    hoy = datetime.strptime(obtener_fecha_venezuela(), '%Y-%m-%d').date()
+    tipo = args[0].lower()
+    if tipo == 'hoy' and len(args) == 1:
+        desde = hasta = hoy
+    elif tipo == 'semana' and len(args) == 1:
+        desde, hasta = hoy - timedelta(days=hoy.weekday()), hoy
+    elif tipo == 'mes' and len(args) == 1:
+        desde, hasta = hoy.replace(day=1), hoy
+    elif tipo == 'rango' and len(args) == 3:
+        desde, hasta = sorted(datetime.strptime(fecha, '%Y-%m-%d').date() for fecha in args[1:])
+    else:
+        raise ValueError(f"Ventana desconocida: {' '.join(args)}")
+    if desde == hasta:
+        etiqueta = f"{tipo} {desde:%d/%m/%Y}"
+    else:
+        etiqueta = f"{tipo} {desde:%d/%m/%Y} - {hasta:%d/%m/%Y}"
+    return etiqueta, desde.isoformat(), hasta.isoformat()
+
+COMPRAS_POR_PAGINA = 10
+
+MESES_HISTORIAL_EN_MEMORIA = int(os.getenv('MESES_HISTORIAL_EN_MEMORIA', '3'))
+
+def parsear_resumen(fila):
+    """Fila de ResumenHistorial -> (mes, tipo, clave, vendedor, compras, clientes, ultima)"""
+    mes, tipo, clave, vendedor, compras, clientes, ultima = celdas(fila, COLUMNAS_RESUMEN)
+    return mes, tipo, clave, vendedor, entero(compras), entero(clientes), ultima
+
+def resumir_particion(mes, compras):
+    """Filas de resumen de un mes cerrado a partir de sus compras (user_id, fecha, vendedor)
+
+    Una fila 'dia' por día y vendedor (compras, clientes distintos, última),
+    una 'cliente' por cliente y vendedor (compras, última) y al final la fila
+    'cierre' con el total: su presencia marca el mes como resumido.
+    """
+    dias = {}
+    clientes = {}
+    total = 0
+    for user_id, fecha_hora, vendedor in compras:
+        total += 1
+        dia = dias.setdefault((fecha_hora[:10], vendedor), [0, set(), ''])
+        dia[0] += 1
+        dia[1].add(user_id)
+        dia[2] = max(dia[2], fecha_hora)
+        cliente = clientes.setdefault((user_id, vendedor), [0, ''])
+        cliente[0] += 1
+        cliente[1] = max(cliente[1], fecha_hora)
+    filas = [[mes, 'dia', fecha, vendedor, n, len(usuarios), ultima]
+             for (fecha, vendedor), (n, usuarios, ultima) in sorted(dias.items())]
+    filas += [[mes, 'cliente', user_id, vendedor, n, '', ultima]
+              for (user_id, vendedor), (n, ultima) in clientes.items()]
+    filas.append([mes, 'cierre', '', '', total, '', obtener_fecha_hora_venezuela()])
+    return filas
+
+def compras_de_filas(datos_historial):
+    """(user_id, fecha, vendedor) de cada fila de una partición"""
+    if not datos_historial:
+        return
+    columnas = mapa_columnas(datos_historial[0], ENCABEZADOS_HISTORIAL)[:3]
+    for fila in datos_historial[1:]:
+        if fila and any(fila):
+            user_id, fecha_hora, vendedor = celdas(fila, columnas)
+            if user_id:
+                yield str(user_id), fecha_hora, vendedor
+
+def meses_resumidos(resumen):
+    return {fila[0] for fila in resumen[1:] if len(fila) > 1 and fila[1] == 'cierre'}
+
+class IndiceHistorial:
+    """Índice del historial por partición mensual: mes -> user_id -> compras en orden
+
+    Las particiones abiertas están siempre en memoria. De las cerradas basta
+    con cuántas compras tiene cada cliente en cada mes (sale del resumen): sus
+    filas se leen solo al paginar hacia ellas y se conservan las
+    MESES_HISTORIAL_EN_MEMORIA usadas más recientemente.
+    """
+
+    def __init__(self):
+        self._particiones = OrderedDict()
+        self._conteos = {}
+        self.cerradas = set()
+        self.cargado = False
+
+    def construir(self, resumen, historiales):
+        """resumen: filas de ResumenHistorial; historiales: {mes: filas} ya leídas"""
+        self._particiones = OrderedDict()
+        self._conteos = {}
+        self.cerradas = set()
+        for fila in resumen[1:]:
+            mes, tipo, clave, _, compras, _, _ = parsear_resumen(fila)
+            if tipo == 'cierre':
+                self.cerradas.add(mes)
+            elif tipo == 'cliente' and clave:
+                conteo = self._conteos.setdefault(clave, {})
+                conteo[mes] = conteo.get(mes, 0) + compras
+        for mes in sorted(historiales):
+            self.cargar_particion(mes, historiales[mes])
+        self.cargado = True
+
+    def cargar_particion(self, mes, datos_historial):
+        compras = {}
+        columnas = mapa_columnas(datos_historial[0] if datos_historial else (), ENCABEZADOS_HISTORIAL)
+        columna_id = columnas[0]
+        for fila in datos_historial[1:]:
+            if len(fila) > columna_id and fila[columna_id]:
+                compras.setdefault(str(fila[columna_id]), []).append(Compra.desde_fila(fila, columnas))
+        self._particiones[mes] = compras
+        self._particiones.move_to_end(mes)
+        self._recortar()
+
+    def _recortar(self):
+        cerradas = [mes for mes in self._particiones if mes in self.cerradas]
+        for mes in cerradas[:max(len(cerradas) - MESES_HISTORIAL_EN_MEMORIA, 0)]:
+            del self._particiones[mes]
+
+    def cerrar_particion(self, mes):
+        """El mes ya tiene resumen: sus conteos pasan a _conteos y sus filas pueden descartarse"""
+        for user_id, compras in self._particiones.get(mes, {}).items():
+            self._conteos.setdefault(user_id, {})[mes] = len(compras)
+        self.cerradas.add(mes)
+        self._recortar()
+
+    def compras_de(self, mes):
+        for user_id, compras in self._particiones.get(mes, {}).items():
+            for compra in compras:
+                yield user_id, compra.fecha, compra.vendedor
+
+    def agregar(self, user_id, fecha_hora, vendedor, cantidad=1, tipo="compra_normal", mes=None):
+        particion = self._particiones.setdefault(mes or mes_de(fecha_hora), {})
+        particion.setdefault(str(user_id), []).append(Compra(fecha_hora, vendedor, cantidad, tipo))
+
+    def _conteo_meses(self, user_id):
+        """{mes: compras} del cliente; las abiertas se cuentan en memoria"""
+        conteo = dict(self._conteos.get(user_id, {}))
+        for mes, compras in self._particiones.items():
+            if mes not in self.cerradas and user_id in compras:
+                conteo[mes] = len(compras[user_id])
+        return conteo
+
+    def total(self, user_id):
+        return sum(self._conteo_meses(str(user_id)).values())
+
+    def _tramos(self, user_id, cursor, tamano):
+        """Meses que cubren las compras [inicio, cursor) y el índice global de su primera compra"""
+        conteo = self._conteo_meses(user_id)
+        total = sum(conteo.values())
+        if cursor is None or cursor > total:
+            cursor = total
+        inicio = max(cursor - tamano, 0)
+        tramos = []
+        base = 0
+        for mes in sorted(conteo):
+            if base < cursor and base + conteo[mes] > inicio:
+                tramos.append((mes, base))
+            base += conteo[mes]
+        return tramos, inicio, cursor
+
+    def faltantes(self, user_id, cursor=None, tamano=COMPRAS_POR_PAGINA):
+        """Particiones cerradas que hay que leer para mostrar esa página"""
+        tramos, _, _ = self._tramos(str(user_id), cursor, tamano)
+        return [mes for mes, _ in tramos if mes not in self._particiones]
+
+    def pagina(self, user_id, cursor=None, tamano=COMPRAS_POR_PAGINA):
+        """Compras anteriores a 'cursor' (índice exclusivo), de la más reciente a la más antigua
+
+        Devuelve (compras, inicio, cursor); 'inicio' es el cursor de la página
+        siguiente hacia atrás (0 si no hay más).
+        """
+        user_id = str(user_id)
+        tramos, inicio, cursor = self._tramos(user_id, cursor, tamano)
+        compras = []
+        for mes, base in tramos:
+            if mes in self._particiones:
+                self._particiones.move_to_end(mes)
+            filas = self._particiones.get(mes, {}).get(user_id, [])
+            compras.extend(filas[max(inicio - base, 0):cursor - base])
+        return compras[::-1], inicio, cursor
+
+indice_historial = IndiceHistorial()
+
+async def asegurar_historial(user_id, cursor=None):
+    """Lee las particiones cerradas que necesita esa página del historial del cliente"""
+    faltantes = indice_historial.faltantes(user_id, cursor)
+    # Cada partición por su lectura compartida: varios clientes piden el mismo mes a la vez
+    leidas = await asyncio.gather(*(almacen.leer(f'historial:{mes}') for mes in faltantes))
+    for mes, datos_historial in zip(faltantes, leidas):
+        indice_historial.cargar_particion(mes, datos_historial)
+
+class ParticionesHistorial:
+    """Particiones mensuales de HistorialCompras y las escrituras en curso de cada una
+
+    Cada compra se escribe en la pestaña de su mes. La primera compra de un
+    mes nuevo crea la pestaña y cierra el mes anterior: cuando terminan sus
+    escrituras en curso se agrega su resumen a ResumenHistorial, y desde
+    entonces sus filas ya no hacen falta para las estadísticas. Cada mes se
+    cierra una sola vez (cerrados), aunque se vuelva a abrir por una compra
+    con fecha anterior.
+    """
+
+    def __init__(self):
+        self.hojas = {}
+        self.abiertas = set()
+        self.actual = None
+        self._en_curso = Counter()
+        self._terminadas = {}
+        self._rotacion = asyncio.Lock()
+        self.cierres = set()
+        self.cerrados = set()
+
+    def hoja(self, mes):
+        if mes == HISTORIAL_ARCHIVO:
+            return hoja_historial
+        return self.hojas.get(mes)
+
+    def enlazar(self, mensuales):
+        for mes, hoja in mensuales.items():
+            self.hojas[mes] = HojaAsync(hoja, nombre_particion(mes))
+
+    def existentes(self):
+        meses = sorted(self.hojas)
+        return [HISTORIAL_ARCHIVO] + meses if hoja_historial else meses
+
+    def iniciar(self, mes, existe=False, cerrados=()):
+        """Estado tras la carga: mes en curso, si su pestaña ya existe y los meses ya resumidos"""
+        self.actual = mes
+        self.abiertas = {mes} if existe else set()
+        self.cerrados.update(cerrados)
+
+    async def reservar(self, fecha_hora):
+        """Anota una escritura en la partición de esa fecha (la crea si hace falta): devuelve el mes"""
+        mes = mes_de(fecha_hora)
+        if mes != self.actual or mes not in self.abiertas:
+            await self._abrir(mes)
+        self._en_curso[mes] += 1
+        return mes
+
+    def terminar(self, mes):
+        """Fin de una escritura anotada con reservar(), guardada o no"""
+        self._en_curso[mes] -= 1
+        if self._en_curso[mes] <= 0:
+            del self._en_curso[mes]
+            evento = self._terminadas.pop(mes, None)
+            if evento:
+                evento.set()
+
+    async def _abrir(self, mes):
+        async with self._rotacion:
+            if mes == self.actual and mes in self.abiertas:
+                return
+            anterior = self.actual
+            if mes not in self.abiertas:
+                await almacen.crear_particion(mes)
+                self.abiertas.add(mes)
+            self.actual = mes
+        print(f"🗂️ Historial: compras de {mes} en '{nombre_particion(mes)}' - Hora: {obtener_hora_venezuela()}")
+        if anterior and anterior < mes and anterior not in self.cerrados:
+            self.cerrados.add(anterior)
+            tarea = asyncio.create_task(self.cerrar(anterior))
+            self.cierres.add(tarea)
+            tarea.add_done_callback(self.cierres.discard)
+
+    async def cerrar(self, mes):
+        """Resume el mes cuando terminan sus escrituras en curso"""
+        while self._en_curso.get(mes):
+            await self._terminadas.setdefault(mes, asyncio.Event()).wait()
+        filas = resumir_particion(mes, indice_historial.compras_de(mes))
+        try:
+            await almacen.guardar_resumen(filas)
+        except Exception as e:
+            self.cerrados.discard(mes)
+            print(f"⚠️ No se pudo resumir {mes}; se reintentará al arrancar: {e}")
+            return
+        indice_historial.cerrar_particion(mes)
+        print(f"📦 Mes {mes} cerrado: {filas[-1][4]} compras resumidas en {len(filas)} filas - Hora: {obtener_hora_venezuela()}")
+
+particiones = ParticionesHistorial()
+
+carga_datos = None
+
+def cargando_datos():
+    return carga_datos is not None and not carga_datos.done()
+
+def programar_carga_datos():
+    """Lanza la carga de los índices en memoria o devuelve la que ya está en curso"""
+    global carga_datos
+    if not cargando_datos():
+        carga_datos = asyncio.ensure_future(_cargar_datos_en_memoria())
+    return carga_datos
+
+async def cargar_datos_en_memoria():
+    """Lee clientes e historial una vez y construye los índices en memoria
+
+    Si ya hay una carga en curso (p. ej. el calentamiento del arranque) se
+    espera esa misma en lugar de volver a leer las hojas.
+    """
+    return await asyncio.shield(programar_carga_datos())
+
+async def datos_listos():
+    """Espera la carga en curso, si la hay, antes de modificar los índices"""
+    if cargando_datos():
+        await asyncio.shield(carga_datos)
+
+async def _cargar_datos_en_memoria():
+    # Clientes, vendedores, resumen del historial y el mes en curso salen de la misma lectura
+    mes_actual = mes_de(obtener_fecha_hora_venezuela())
+    con_historial = almacen.disponible('historial')
+    existentes = almacen.particiones_existentes() if con_historial else []
+    tablas = [tabla for tabla in ('registro', 'vendedores', 'resumen') if almacen.disponible(tabla)]
+    if mes_actual in existentes:
+        tablas.append(f'historial:{mes_actual}')
     try:
-        google_creds_json = os.getenv('GOOGLE_CREDENTIALS')
-        if not google_creds_json:
-            raise Exception("GOOGLE_CREDENTIALS no encontrada en variables de entorno")
-        
-        creds_dict = json.loads(google_creds_json)
-        creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPE)
-        client = gspread.authorize(creds)
-        
-        spreadsheet = client.open_by_key(SHEET_ID)
-        print(f"✅ Conectado a Google Sheets principal - Hora Venezuela: {obtener_hora_venezuela()}")
-        
-        # Función auxiliar para inicializar hojas
-        def inicializar_hoja(nombre_hoja, headers=None):
-            try:
-                hoja = spreadsheet.worksheet(nombre_hoja)
-                print(f"✅ Hoja '{nombre_hoja}' encontrada")
-                
-                # Verificar si necesita encabezados
-                if headers:
-                    existing_data = hoja.get_all_values()
-                    if not existing_data or not any(existing_data):
-                        hoja.append_row(headers)
-                        print(f"✅ Encabezados agregados a '{nombre_hoja}'")
-                
-                return hoja
-            except gspread.exceptions.WorksheetNotFound:
-                print(f"📊 Creando hoja '{nombre_hoja}' automáticamente...")
-                hoja = spreadsheet.add_worksheet(title=nombre_hoja, rows="100", cols="10")
-                if headers:
-                    hoja.append_row(headers)
-                    print(f"✅ Hoja '{nombre_hoja}' creada con encabezados")
-                return hoja
-            except Exception as e:
-                print(f"⚠️ Error con hoja '{nombre_hoja}': {e}")
-                return None
-        
-        # Inicializar todas las hojas con sus encabezados
-        sheet_registro = inicializar_hoja("registro_clientes", 
-                                        ["user_id", "username", "nombre_completo", "fecha_registro", "sellos", "vendedor"])
-        
-        sheet_vendedores = inicializar_hoja("Vendedores", 
-                                          ["username", "nombre", "fecha_incorporacion", "estado", "privilegios"])
-        
-        sheet_historial = inicializar_hoja("HistorialCompras", 
-                                         ["user_id", "fecha", "vendedor", "cantidad", "tipo"])
-        
-        # ✅ SOLO ACCEDER a estadísticas (ya existe) - NO CREAR
+        datos = await almacen.leer_varias(tablas)
+        resumen = datos.get('resumen') or [ENCABEZADOS_RESUMEN]
+        resumidos = meses_resumidos(resumen)
+        # Meses anteriores sin resumen (el archivo la primera vez, o un cierre que no llegó a escribirse)
+        por_cerrar = [mes for mes in existentes if mes < mes_actual and mes not in resumidos]
+        abiertos = {}
+        if por_cerrar:
+            abiertos = await almacen.leer_varias([f'historial:{mes}' for mes in por_cerrar])
+    except Exception as e:
+        print(f"❌ Error cargando datos en memoria: {e}")
+        return False
+
+    abiertos = {tabla.split(':', 1)[1]: filas for tabla, filas in abiertos.items()}
+    if por_cerrar and 'resumen' in datos:
+        filas_resumen = []
+        for mes in por_cerrar:
+            filas_resumen += resumir_particion(mes, compras_de_filas(abiertos[mes]))
         try:
-            sheet_estadisticas = spreadsheet.worksheet("estadísticas")
-            print("✅ Hoja 'estadísticas' encontrada (ya existente)")
-        except gspread.exceptions.WorksheetNotFound:
-            print("❌ Hoja 'estadísticas' no encontrada, pero debería existir")
-            sheet_estadisticas = None
+            await almacen.guardar_resumen(filas_resumen)
+            resumen = resumen + filas_resumen
+            print(f"📦 Historial resumido: {', '.join(por_cerrar)} - Hora: {obtener_hora_venezuela()}")
         except Exception as e:
-            print(f"⚠️ Error accediendo a hoja 'estadísticas': {e}")
-            sheet_estadisticas = None
-        
-        print("✅ Todas las hojas de Google Sheets inicializadas correctamente")
-        return sheet_registro, sheet_vendedores, sheet_historial, sheet_estadisticas
-        
-    except Exception as e:
-        print(f"❌ Error crítico conectando a Google Sheets: {e}")
-        print("⚠️ El bot continuará sin funcionalidad de base de datos")
-        return None, None, None, None
+            print(f"⚠️ No se pudo guardar el resumen de {', '.join(por_cerrar)}: {e}")
 
-# Inicializar Google Sheets
-sheet_registro, sheet_vendedores, sheet_historial, sheet_estadisticas = inicializar_google_sheets()
+    datos_registro = datos.get('registro', [])
+    # Cada fila de clientes se convierte una sola vez para el índice y las estadísticas
+    clientes = clientes_de_filas(datos_registro)
+    await indice_clientes.cargar(datos_registro, clientes)
+    resumidos = meses_resumidos(resumen)
+    if con_historial:
+        historial_actual = datos.get(f'historial:{mes_actual}')
+        abiertos[mes_actual] = historial_actual or [ENCABEZADOS_HISTORIAL]
+        particiones.iniciar(mes_actual, historial_actual is not None, resumidos)
+    estadisticas_vivas.construir(clientes, resumen,
+                                 [filas for mes, filas in abiertos.items() if mes not in resumidos])
+    indice_historial.construir(resumen, abiertos)
+    if 'vendedores' in datos:
+        try:
+            await registro_vendedores.refrescar(datos['vendedores'])
+        except Exception as e:
+            print(f"⚠️ Error actualizando vendedores: {e}")
+    return True
 
-# Almacenamiento temporal
-codigos_activos = {}
-solicitudes_activas = {}
-usuarios_agregando_vendedor = set()
-usuarios_agregando_cliente = set()
-usuarios_eliminando_cliente = set()
-
-# Cache para evitar duplicados
-vendedores_cache = {
-    'data': [],
-    'timestamp': None
-}
+async def registrar_compra_en_lote(user_id, cliente, vendedor_actual, fila_nuevo_cliente=None):
+    """Registra una compra completa en el almacenamiento
+
+    Se guardan el sello sumado, el vendedor asignado, la compra en la
+    partición del mes de HistorialCompras y el reinicio a 0 cuando el cliente
+    completa SELLOS_PARA_PREMIO sellos.
+    Devuelve los sellos alcanzados con esta compra (SELLOS_PARA_PREMIO = premio).
+    """
+    await datos_listos()
+    if cliente:
+        fila_cliente, registro = cliente
+        antes = registro.copia()
+        sellos_alcanzados = registro.sellos + 1
+    else:
+        fila_cliente = None
+        registro = Cliente.desde_fila([str(v) for v in fila_nuevo_cliente])
+        sellos_alcanzados = 1
+
+    sellos_guardados = 0 if sellos_alcanzados >= SELLOS_PARA_PREMIO else sellos_alcanzados
+    valores_cliente = [registro.user_id, registro.username, registro.nombre,
+                       registro.fecha_registro, sellos_guardados, vendedor_actual]
+
+    fecha_hora = obtener_fecha_hora_venezuela()  # ✅ Hora Venezuela
+    valores_historial = [user_id, fecha_hora, vendedor_actual, 1, "compra_normal"]
+    mes_historial = None
 
-def debug_hoja_vendedores():
-    """Función de debug para verificar la estructura de la hoja Vendedores"""
     try:
-        if not sheet_vendedores:
-            print("❌ No hay conexión a Google Sheets")
-            return
-        
-        print("🔍 DEBUG - ESTRUCTURA HOJA VENDEDORES:")
-        todos_datos = sheet_vendedores.get_all_values()
-        
-        if len(todos_datos) == 0:
-            print("   📭 Hoja vacía")
-            return
-        
-        headers = todos_datos[0]
-        print(f"   📊 Encabezados: {headers}")
-        
-        if len(todos_datos) > 1:
-            print("   👥 Datos de vendedores:")
-            for i, fila in enumerate(todos_datos[1:], 1):
-                print(f"      {i}. {fila}")
-        else:
-            print("   📭 No hay datos de vendedores")
-            
-    except Exception as e:
-        print(f"❌ Error en debug: {e}")
+        if almacen.disponible('historial'):
+            mes_historial = await particiones.reservar(fecha_hora)
+        fila_guardada = await almacen.registrar_compra(fila_cliente, valores_cliente, not cliente,
+                                                       mes_historial, valores_historial)
+    except Exception:
+        if mes_historial:
+            particiones.terminar(mes_historial)
+        raise
+
+    if cliente and fila_guardada != fila_cliente:
+        # La hoja se editó a mano: las filas del índice ya no son fiables
+        programar_carga_datos()
+    registro.sellos = sellos_guardados
+    registro.vendedor = vendedor_actual
+    indice_clientes.registrar_local(fila_guardada, registro)
 
-# Llamar debug al inicio
-debug_hoja_vendedores()
+    if cliente:
+        estadisticas_vivas.cliente_modificado(antes, registro)
+    else:
+        estadisticas_vivas.cliente_agregado(registro)
+    if mes_historial:
+        estadisticas_vivas.compra_registrada(user_id, fecha_hora, vendedor_actual)
+        indice_historial.agregar(user_id, fecha_hora, vendedor_actual, mes=mes_historial)
+        particiones.terminar(mes_historial)
+    print(f"📝 Compra guardada: {user_id} - {vendedor_actual} - Hora: {obtener_hora_venezuela()}")
+    return sellos_alcanzados
 
 async def forzar_actualizacion_cache():
     """Fuerza la actualización del cache de vendedores"""
-    global vendedores_cache
-    vendedores_cache = {
-        'data': [],
-        'timestamp': None
-    }
+    registro_vendedores.invalidar()
     print(f"🔄 Cache de vendedores forzado a actualizar - Hora: {obtener_hora_venezuela()}")
 
-def limpiar_duplicados_vendedores():
-    """Limpia duplicados en la hoja de vendedores"""
-    try:
-        if not sheet_vendedores:
-            return 0
-            
-        todos_datos = sheet_vendedores.get_all_values()
-        if len(todos_datos) <= 1:
-            return 0
-            
-        headers = todos_datos[0]
-        datos_vendedores = todos_datos[1:]
-        
-        vendedores_unicos = {}
-        filas_a_eliminar = []
-        
-        for i, fila in enumerate(datos_vendedores):
-            if len(fila) > 0 and fila[0]:
-                user_id = fila[0]
-                estado = fila[3] if len(fila) > 3 else 'SI'
-                
-                if user_id == ADMIN_ID:
-                    continue
-                    
-                if user_id in vendedores_unicos and estado == 'SI':
-                    filas_a_eliminar.append(i + 2)
-                else:
-                    vendedores_unicos[user_id] = True
-        
-        for fila_num in sorted(filas_a_eliminar, reverse=True):
-            sheet_vendedores.delete_rows(fila_num)
-        
-        if filas_a_eliminar:
-            print(f"🧹 Duplicados eliminados: {len(filas_a_eliminar)}")
-        
-        return len(filas_a_eliminar)
-        
-    except Exception as e:
-        print(f"❌ Error limpiando duplicados: {e}")
-        return 0
-
 async def obtener_vendedores_activos(forzar_actualizacion=False):
-    """Obtiene lista de vendedores activos desde Google Sheets - CORREGIDA"""
-    global vendedores_cache
-    
+    """Obtiene lista de vendedores activos desde el registro en memoria"""
     try:
         if forzar_actualizacion:
-            vendedores_cache = {'data': [], 'timestamp': None}
-        
-        if (vendedores_cache['timestamp'] and 
-            (datetime.now() - vendedores_cache['timestamp']).total_seconds() < 300 and
-            not forzar_actualizacion):
-            return vendedores_cache['data']
-        
-        if not sheet_vendedores:
-            return []
-        
-        duplicados_eliminados = limpiar_duplicados_vendedores()
-        if duplicados_eliminados > 0:
-            print(f"🔄 Se limpiaron {duplicados_eliminados} duplicados")
-        
-        todos_datos = sheet_vendedores.get_all_values()
-        
-        if len(todos_datos) <= 1:
-            vendedores_cache['data'] = []
-            vendedores_cache['timestamp'] = datetime.now()
-            return []
-        
-        headers = todos_datos[0]
-        datos_vendedores = todos_datos[1:]
-        
-        vendedores_activos = []
-        vendedores_ids_vistos = set()
-        
-        print(f"🔍 Procesando {len(datos_vendedores)} filas de vendedores...")
-        
-        for i, fila in enumerate(datos_vendedores, 1):
-            if not fila or not any(fila):
-                continue
-                
-            # ✅ CORRECCIÓN: Mapear correctamente las columnas según tu estructura real
-            vendedor_dict = {}
-            for j, header in enumerate(headers):
-                if j < len(fila):
-                    vendedor_dict[header] = fila[j]
-                else:
-                    vendedor_dict[header] = ""
-            
-            # ✅ CORRECCIÓN: Usar las columnas CORRECTAS según tu estructura de Sheets
-            estado = vendedor_dict.get('estado', 'SI')
-            user_id = vendedor_dict.get('username', '')  # ✅ COLUMNA CORREGIDA: 'username' no 'user_id'
-            nombre = vendedor_dict.get('nombre', 'Sin nombre')
-            privilegios = vendedor_dict.get('privilegios', 'normal')
-            
-            print(f"🔍 Procesando vendedor {i}: ID={user_id}, Nombre={nombre}, Estado={estado}, Privilegios={privilegios}")
-            
-            if (estado.upper() == 'SI' and user_id and user_id.isdigit() and 
-                user_id not in vendedores_ids_vistos):
-                
-                vendedores_ids_vistos.add(user_id)
-                
-                vendedor_data = {
-                    'user_id': str(user_id),
-                    'nombre': nombre,
-                    'privilegios': privilegios
-                }
-                vendedores_activos.append(vendedor_data)
-                print(f"✅ Vendedor activo agregado: {nombre} ({user_id})")
-            else:
-                print(f"❌ Vendedor no cumple requisitos: ID={user_id}, Estado={estado}")
-        
-        # ✅ CORRECCIÓN: Agregar admin si no está en la lista
-        admin_ya_esta = any(v['user_id'] == ADMIN_ID for v in vendedores_activos)
-        if not admin_ya_esta:
-            vendedores_activos.append({
-                'user_id': ADMIN_ID,
-                'nombre': 'Alushi_1 (Admin)',
-                'privilegios': 'admin'
-            })
-            print("✅ Admin agregado como vendedor activo")
-        
-        vendedores_cache['data'] = vendedores_activos
-        vendedores_cache['timestamp'] = datetime.now()
-        
-        print(f"🎯 Total vendedores activos encontrados: {len(vendedores_activos)} - Hora: {obtener_hora_venezuela()}")
-        
-        # ✅ DEBUG: Mostrar todos los vendedores encontrados
-        for v in vendedores_activos:
-            print(f"   👤 {v['nombre']} (ID: {v['user_id']}) - {v['privilegios']}")
-        
-        return vendedores_activos
-        
+            registro_vendedores.invalidar()
+        await registro_vendedores.asegurar()
+        return registro_vendedores.activos()
     except Exception as e:
         print(f"❌ Error crítico obteniendo vendedores: {e}")
-        # ✅ DEBUG: Mostrar más información del error
         print(f"📋 Traceback completo: {traceback.format_exc()}")
         return []
 
 async def obtener_vendedores_validos():
     """Obtiene solo vendedores con IDs válidos para envío de QR"""
     vendedores = await obtener_vendedores_activos()
-    return [v for v in vendedores if v['user_id'].isdigit()]
+    return [v for v in vendedores if v.user_id.isdigit()]
 
 async def es_admin(user_id: str) -> bool:
     """Verifica si el usuario es admin"""
@@ -323,76 +2620,76 @@ async def es_admin(user_id: str) -> bool:
 
 async def es_vendedor(user_id: str) -> bool:
     """Verifica si el usuario es vendedor"""
-    vendedores = await obtener_vendedores_activos()
-    return any(v['user_id'] == user_id for v in vendedores)
+    await registro_vendedores.asegurar()
+    return user_id in registro_vendedores.por_id
 
 async def es_vendedor_premium(user_id: str) -> bool:
     """Verifica si el usuario es vendedor premium"""
-    vendedores = await obtener_vendedores_activos()
-    for v in vendedores:
-        if v['user_id'] == user_id and v['privilegios'] == 'premium':
-            return True
-    return False
+    await registro_vendedores.asegurar()
+    return user_id in registro_vendedores.premium
 
 async def obtener_privilegios_usuario(user_id: str) -> str:
     """Obtiene los privilegios del usuario"""
     if user_id == ADMIN_ID:
         return 'admin'
     
-    vendedores = await obtener_vendedores_activos()
-    for v in vendedores:
-        if v['user_id'] == user_id:
-            return v.get('privilegios', 'normal')
-    return 'cliente'
+    await registro_vendedores.asegurar()
+    return privilegios_en_registro(user_id)
+
+def privilegios_en_registro(user_id: str) -> str:
+    """Privilegios según el registro de vendedores ya cargado (sin asegurar ni leer la hoja)"""
+    if user_id == ADMIN_ID:
+        return 'admin'
+    
+    vendedor = registro_vendedores.por_id.get(user_id)
+    if not vendedor:
+        return 'cliente'
+    # La hoja solo distingue vendedores: 'admin' es únicamente ADMIN_ID
+    return 'premium' if vendedor.privilegios == 'premium' else 'normal'
+
+async def exigir_admin(update: Update, denegado: str) -> bool:
+    """Guarda de cada acción de admin, además de la tabla de botones por rol"""
+    if await es_admin(str(update.effective_user.id)):
+        return True
+    await responder(update, denegado)
+    return False
 
-async def guardar_estadisticas_en_sheet():
+async def guardar_estadisticas_en_sheet(instantanea=None):
     """Guarda las estadísticas en la hoja 'estadísticas'"""
     try:
-        if not sheet_estadisticas:
+        if not almacen.disponible('estadisticas'):
             print("❌ Hoja estadísticas no disponible")
             return False
-            
-        # Limpiar hoja existente
-        sheet_estadisticas.clear()
+        
+        if instantanea is None:
+            instantanea = await tomar_instantanea()
         
         # Encabezados
-        headers = ["Vendedor", "total_clientes", "sellos_activos", "sellos_inactivos", 
-                  "total_ventas", "fecha_actualizacion"]
-        sheet_estadisticas.append_row(headers)
+        filas = [ENCABEZADOS_ESTADISTICAS]
         
-        # Obtener datos actualizados
-        vendedores_activos = await obtener_vendedores_activos()
-        datos_registro = sheet_registro.get_all_values() if sheet_registro else []
-        datos_historial = sheet_historial.get_all_values() if sheet_historial else []
+        fecha_actualizacion = instantanea.tomada  # ✅ Hora Venezuela
         
-        for vendedor in vendedores_activos:
-            if vendedor['user_id'] == ADMIN_ID:
+        for vendedor in instantanea.vendedores_activos:
+            if vendedor.user_id == ADMIN_ID:
                 continue
                 
-            nombre_vendedor = vendedor['nombre']
+            nombre_vendedor = vendedor.nombre
+            clientes = instantanea.clientes_por_vendedor.get(nombre_vendedor, {})
+            ventas = instantanea.ventas_por_vendedor.get(nombre_vendedor, {})
             
-            # Calcular estadísticas por vendedor
-            clientes_vendedor = [c for c in datos_registro[1:] if len(c) > 5 and c[5] == nombre_vendedor]
-            total_clientes = len(clientes_vendedor)
-            
-            sellos_activos = sum(int(c[4]) for c in clientes_vendedor if len(c) > 4 and c[4] and int(c[4]) > 0)
-            sellos_inactivos = len([c for c in clientes_vendedor if len(c) > 4 and (not c[4] or int(c[4]) == 0)])
-            
-            ventas_vendedor = [v for v in datos_historial[1:] if len(v) > 2 and v[2] == nombre_vendedor]
-            total_ventas = len(ventas_vendedor)
-            
-            # Guardar fila
-            fila_estadisticas = [
+            filas.append([
                 nombre_vendedor,
-                total_clientes,
-                sellos_activos,
-                sellos_inactivos,
-                total_ventas,
-                obtener_fecha_hora_venezuela()  # ✅ Hora Venezuela
-            ]
-            sheet_estadisticas.append_row(fila_estadisticas)
+                clientes.get('clientes', 0),
+                clientes.get('sellos', 0),
+                clientes.get('sin_sellos', 0),
+                ventas.get('ventas', 0),
+                fecha_actualizacion
+            ])
         
-        print(f"✅ Estadísticas guardadas en Google Sheets - Hora: {obtener_hora_venezuela()}")
+        # Reemplazar la tabla completa de una sola vez
+        await almacen.guardar_estadisticas(filas)
+        
+        print(f"✅ Estadísticas guardadas en Google Sheets (versión {instantanea.version}) - Hora: {obtener_hora_venezuela()}")
         return True
         
     except Exception as e:
@@ -411,12 +2708,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await procesar_compra_qr(update, user_id, comando)
                 return
         
-        if await es_admin(user_id):
+        privilegios = await rol_de(update, context)
+        if privilegios == 'admin':
             await mostrar_teclado_admin_completo(update)
             return
-            
-        privilegios = await obtener_privilegios_usuario(user_id)
-        if privilegios == 'premium':
+        elif privilegios == 'premium':
             await mostrar_teclado_vendedor_premium(update)
             return
         elif privilegios == 'normal':
@@ -427,7 +2723,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     except Exception as e:
         print(f"❌ Error en start: {e}")
-        await update.message.reply_text("⚠️ Error temporal. Por favor, intenta nuevamente.")
+        await responder(update, "⚠️ Error temporal. Por favor, intenta nuevamente.")
 
 async def mostrar_teclado_admin_completo(update: Update):
     """Muestra teclado con TODAS las funciones (Admin + Vendedor + Cliente)"""
@@ -445,7 +2741,7 @@ async def mostrar_teclado_admin_completo(update: Update):
     
     mensaje = f"👑 PANEL ADMIN COMPLETO - Shisha MGTA\n⏰ Hora Venezuela: {obtener_hora_venezuela()}"
     
-    await update.message.reply_text(mensaje, reply_markup=reply_markup)
+    await responder(update, mensaje, reply_markup=reply_markup)
 
 async def mostrar_teclado_vendedor_premium(update: Update):
     """Muestra teclado personalizado para vendedores PREMIUM"""
@@ -459,7 +2755,7 @@ async def mostrar_teclado_vendedor_premium(update: Update):
     
     mensaje = f"🌟 PANEL VENDEDOR PREMIUM - Shisha MGTA\n⏰ Hora Venezuela: {obtener_hora_venezuela()}"
     
-    await update.message.reply_text(mensaje, reply_markup=reply_markup)
+    await responder(update, mensaje, reply_markup=reply_markup)
 
 async def mostrar_teclado_vendedor_normal(update: Update):
     """Muestra teclado personalizado para vendedores NORMALES"""
@@ -472,14 +2768,14 @@ async def mostrar_teclado_vendedor_normal(update: Update):
     
     mensaje = f"👨‍💼 PANEL VENDEDOR NORMAL - Shisha MGTA\n⏰ Hora Venezuela: {obtener_hora_venezuela()}"
     
-    await update.message.reply_text(mensaje, reply_markup=reply_markup)
+    await responder(update, mensaje, reply_markup=reply_markup)
 
 async def mostrar_menu_principal(update: Update, user_id: str, nombre: str):
     """Muestra el menú principal con botones para clientes"""
     try:
-        celda = sheet_registro.find(user_id) if sheet_registro else None
+        cliente = await indice_clientes.obtener(user_id) if almacen.disponible('registro') else None
         
-        if celda:
+        if cliente:
             keyboard = [
                 [KeyboardButton("🛒 COMPRAS"), KeyboardButton("📊 MIS SELLOS")],
                 [KeyboardButton("📋 MI HISTORIAL"), KeyboardButton("ℹ️ INFORMACIÓN")],
@@ -496,147 +2792,11 @@ async def mostrar_menu_principal(update: Update, user_id: str, nombre: str):
             mensaje = f"👋 ¡Hola {nombre}! - Shisha MGTA\n⏰ Hora Venezuela: {obtener_hora_venezuela()}\n\nRegístrate para empezar a acumular sellos"
         
         reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        await update.message.reply_text(mensaje, reply_markup=reply_markup)
+        await responder(update, mensaje, reply_markup=reply_markup)
         
     except Exception as e:
         print(f"❌ Error mostrando menú: {e}")
-        await update.message.reply_text("¡Bienvenido! Usa /registro para unirte.")
-
-async def manejar_botones_avanzados(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Maneja los botones del menú"""
-    texto = update.message.text
-    user_id = str(update.effective_user.id)
-    privilegios = await obtener_privilegios_usuario(user_id)
-    
-    if texto == "👤 AGREGAR VENDEDOR NORMAL":
-        if await es_admin(user_id):
-            usuarios_agregando_vendedor.add(user_id)
-            await update.message.reply_text(
-                "👤 **AGREGAR VENDEDOR NORMAL**\n\n"
-                "📱 **Envía el ID y nombre del vendedor:**\n"
-                "`123456789 Nombre_Apellido`"
-            )
-        else:
-            await update.message.reply_text("❌ Solo administradores pueden agregar vendedores.")
-    
-    elif texto == "🌟 AGREGAR VENDEDOR PREMIUM":
-        if await es_admin(user_id):
-            usuarios_agregando_vendedor.add(user_id)
-            await update.message.reply_text(
-                "🌟 **AGREGAR VENDEDOR PREMIUM**\n\n"
-                "📱 **Envía el ID y nombre del vendedor:**\n"
-                "`123456789 Nombre_Apellido`"
-            )
-        else:
-            await update.message.reply_text("❌ Solo administradores pueden agregar vendedores.")
-    
-    elif texto == "🚫 ELIMINAR VENDEDOR":
-        if await es_admin(user_id):
-            await mostrar_lista_eliminar_vendedor(update)
-        else:
-            await update.message.reply_text("❌ Solo administradores pueden eliminar vendedores.")
-    
-    elif texto == "📋 LISTAR VENDEDORES":
-        if await es_admin(user_id):
-            await listar_vendedores(update, context)
-        else:
-            await update.message.reply_text("❌ Solo administradores pueden ver la lista de vendedores.")
-    
-    elif texto == "👥 VER CLIENTES":
-        if await es_admin(user_id):
-            await mostrar_clientes_admin(update)
-        elif await es_vendedor(user_id):
-            await mostrar_clientes_vendedor(update, user_id)
-        else:
-            await update.message.reply_text("❌ Solo vendedores y administradores pueden ver clientes.")
-    
-    elif texto == "➕ AGREGAR CLIENTE":
-        if await es_admin(user_id):
-            usuarios_agregando_cliente.add(user_id)
-            await update.message.reply_text(
-                "➕ **AGREGAR CLIENTE**\n\n"
-                "📱 **Envía el ID y nombre del cliente:**\n"
-                "`123456789 Nombre Cliente`"
-            )
-        else:
-            await update.message.reply_text("❌ Solo administradores pueden agregar clientes.")
-    
-    elif texto == "🚫 ELIMINAR CLIENTE":
-        if await es_admin(user_id):
-            usuarios_eliminando_cliente.add(user_id)
-            await update.message.reply_text(
-                "🚫 **ELIMINAR CLIENTE**\n\n"
-                "📱 **Envía el ID del cliente a eliminar:**\n"
-                "`123456789`"
-            )
-        else:
-            await update.message.reply_text("❌ Solo administradores pueden eliminar clientes.")
-    
-    elif texto == "💰 MIS VENTAS":
-        if await es_vendedor(user_id) or await es_admin(user_id):
-            await mostrar_mis_ventas(update, user_id)
-        else:
-            await update.message.reply_text("❌ Solo vendedores y administradores pueden ver ventas.")
-    
-    elif texto == "📊 ESTADÍSTICAS":
-        if await es_admin(user_id) or privilegios == 'premium':
-            # Forzar actualización de cache antes de mostrar estadísticas
-            await forzar_actualizacion_cache()
-            
-            # ✅ GUARDAR en la hoja primero
-            await guardar_estadisticas_en_sheet()
-            
-            estadisticas = await obtener_estadisticas_completas()
-            await update.message.reply_text(estadisticas)
-        else:
-            await update.message.reply_text("❌ Solo administradores y vendedores premium pueden ver estadísticas.")
-    
-    elif texto == "🏆 RANKING VENDEDORES":
-        if await es_admin(user_id) or privilegios == 'premium':
-            # Forzar actualización de cache antes de mostrar ranking
-            await forzar_actualizacion_cache()
-            ranking = await generar_ranking_detallado()
-            await update.message.reply_text(ranking)
-        else:
-            await update.message.reply_text("❌ Solo administradores y vendedores premium pueden ver rankings.")
-    
-    elif texto == "🛒 COMPRAS" or texto == "🛒 COMPRAR AHORA":
-        await solicitar_compra(update, context)
-    
-    elif texto == "📊 MIS SELLOS":
-        await sellos(update, context)
-    
-    elif texto == "📋 MI HISTORIAL":
-        await historial_cliente(update, context)
-    
-    elif texto == "ℹ️ INFORMACIÓN":
-        await info(update, context)
-    
-    elif texto == "📝 REGISTRARME":
-        await registro_directo(update, context)
-    
-    elif texto == "📞 CONTACTAR" or texto == "📞 CONTACTAR ADMIN":
-        await manejar_contacto(update, context)
-    
-    elif texto == "🔄 ACTUALIZAR CACHE":
-        if await es_admin(user_id):
-            await forzar_actualizacion_cache()
-            await update.message.reply_text(f"✅ **Cache actualizado correctamente**\n\nLos datos ahora están sincronizados con Google Sheets.\n⏰ Hora: {obtener_hora_venezuela()}")
-        else:
-            await update.message.reply_text("❌ Solo el administrador puede actualizar el cache.")
-    
-    elif texto == "🏠 INICIO":
-        await start(update, context)
-    
-    else:
-        if user_id in usuarios_agregando_vendedor:
-            await procesar_agregar_vendedor_rapido(update, context)
-        elif user_id in usuarios_agregando_cliente:
-            await procesar_agregar_cliente(update, context)
-        elif user_id in usuarios_eliminando_cliente:
-            await procesar_eliminar_cliente(update, context)
-        else:
-            await start(update, context)
+        await responder(update, "¡Bienvenido! Usa /registro para unirte.")
 
 async def procesar_agregar_vendedor_rapido(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Procesa el agregado rápido de vendedor"""
@@ -644,56 +2804,53 @@ async def procesar_agregar_vendedor_rapido(update: Update, context: ContextTypes
     texto = update.message.text
     
     try:
-        if user_id not in usuarios_agregando_vendedor:
+        estado = flujo_activo(user_id, 'agregar_vendedor')
+        if not estado:
+            return
+        
+        if not await exigir_admin(update, "❌ Solo administradores pueden agregar vendedores."):
+            terminar_flujo(user_id)
             return
         
-        es_premium = "🌟 AGREGAR VENDEDOR PREMIUM" in usuarios_agregando_vendedor
+        es_premium = estado.get('premium', False)
         
-        usuarios_agregando_vendedor.discard(user_id)
+        terminar_flujo(user_id)
         
         partes = texto.split(' ', 1)
         if len(partes) != 2:
-            await update.message.reply_text("❌ **Formato incorrecto**\n\nUsa: `123456789 Nombre_Apellido`")
+            await responder(update, "❌ **Formato incorrecto**\n\nUsa: `123456789 Nombre_Apellido`")
             return
         
         nuevo_vendedor_id = partes[0].strip()
         nombre_vendedor = partes[1].strip().replace(' ', '_')
         
         if not nuevo_vendedor_id.isdigit():
-            await update.message.reply_text("❌ **ID inválido**\n\nEl ID debe contener solo números.")
+            await responder(update, "❌ **ID inválido**\n\nEl ID debe contener solo números.")
             return
         
-        try:
-            todos_datos = sheet_vendedores.get_all_values()
-            if len(todos_datos) > 1:
-                datos_vendedores = todos_datos[1:]
-                for fila in datos_vendedores:
-                    if len(fila) > 0 and str(fila[0]) == nuevo_vendedor_id:
-                        estado = fila[3] if len(fila) > 3 else 'SI'
-                        if estado.upper() == 'SI':
-                            await update.message.reply_text(f"❌ El vendedor {nuevo_vendedor_id} ya existe.")
-                            return
-        except Exception as e:
-            print(f"⚠️ Error verificando duplicados: {e}")
-        
-        privilegios = "premium" if es_premium else "normal"
-        nueva_fila = [
-            nuevo_vendedor_id,
-            nombre_vendedor,
-            obtener_fecha_venezuela(),  # ✅ Hora Venezuela
-            "SI",
-            privilegios
-        ]
-        
-        sheet_vendedores.append_row(nueva_fila)
-        
-        # Forzar actualización del cache
-        await forzar_actualizacion_cache()
-        
-        vendedores_actualizados = await obtener_vendedores_activos()
+        async with bloquear_vendedor(nuevo_vendedor_id):
+            await registro_vendedores.asegurar()
+            if nuevo_vendedor_id in registro_vendedores.por_id:
+                await responder(update, f"❌ El vendedor {nuevo_vendedor_id} ya existe.")
+                return
+            
+            privilegios = "premium" if es_premium else "normal"
+            nueva_fila = [
+                nuevo_vendedor_id,
+                nombre_vendedor,
+                obtener_fecha_venezuela(),  # ✅ Hora Venezuela
+                "SI",
+                privilegios
+            ]
+            
+            fila_nueva = await almacen.agregar_vendedor(nueva_fila)
+            
+            registro_vendedores.vendedor_agregado(fila_nueva, nueva_fila)
+            vendedores_actualizados = registro_vendedores.activos()
         
         tipo_vendedor = "🌟 PREMIUM" if es_premium else "👤 NORMAL"
-        await update.message.reply_text(
+        await responder(
+            update,
             f"✅ **Vendedor {tipo_vendedor} agregado**\n\n"
             f"👤 **Nombre:** {nombre_vendedor.replace('_', ' ')}\n"
             f"🆔 **ID:** `{nuevo_vendedor_id}`\n"
@@ -705,7 +2862,7 @@ async def procesar_agregar_vendedor_rapido(update: Update, context: ContextTypes
         
     except Exception as e:
         print(f"❌ Error agregando vendedor: {e}")
-        await update.message.reply_text(f"❌ Error agregando vendedor: {str(e)}")
+        await responder(update, f"❌ Error agregando vendedor: {str(e)}")
 
 async def procesar_agregar_cliente(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Procesa el agregado de cliente por admin"""
@@ -713,43 +2870,48 @@ async def procesar_agregar_cliente(update: Update, context: ContextTypes.DEFAULT
     texto = update.message.text
     
     try:
-        if user_id not in usuarios_agregando_cliente:
+        if not flujo_activo(user_id, 'agregar_cliente'):
+            return
+        
+        if not await exigir_admin(update, "❌ Solo administradores pueden agregar clientes."):
+            terminar_flujo(user_id)
             return
         
-        usuarios_agregando_cliente.discard(user_id)
+        terminar_flujo(user_id)
         
         partes = texto.split(' ', 1)
         if len(partes) != 2:
-            await update.message.reply_text("❌ **Formato incorrecto**\n\nUsa: `123456789 Nombre Cliente`")
+            await responder(update, "❌ **Formato incorrecto**\n\nUsa: `123456789 Nombre Cliente`")
             return
         
         cliente_id = partes[0].strip()
         nombre_cliente = partes[1].strip()
         
         if not cliente_id.isdigit():
-            await update.message.reply_text("❌ **ID inválido**\n\nEl ID debe contener solo números.")
+            await responder(update, "❌ **ID inválido**\n\nEl ID debe contener solo números.")
             return
         
-        try:
-            celda = sheet_registro.find(cliente_id)
-            if celda:
-                await update.message.reply_text(f"❌ El cliente {cliente_id} ya existe.")
-                return
-        except:
-            pass
-        
-        nueva_fila = [
-            cliente_id,
-            "",
-            nombre_cliente,
-            obtener_fecha_venezuela(),  # ✅ Hora Venezuela
-            0,
-            ""
-        ]
-        
-        sheet_registro.append_row(nueva_fila)
+        async with bloquear_cliente(cliente_id):
+            try:
+                if await indice_clientes.existe(cliente_id):
+                    await responder(update, f"❌ El cliente {cliente_id} ya existe.")
+                    return
+            except:
+                pass
+            
+            nueva_fila = [
+                cliente_id,
+                "",
+                nombre_cliente,
+                obtener_fecha_venezuela(),  # ✅ Hora Venezuela
+                0,
+                ""
+            ]
+            
+            await indice_clientes.agregar(nueva_fila)
         
-        await update.message.reply_text(
+        await responder(
+            update,
             f"✅ **Cliente agregado**\n\n"
             f"👤 **Nombre:** {nombre_cliente}\n"
             f"🆔 **ID:** `{cliente_id}`\n"
@@ -761,7 +2923,7 @@ async def procesar_agregar_cliente(update: Update, context: ContextTypes.DEFAULT
         
     except Exception as e:
         print(f"❌ Error agregando cliente: {e}")
-        await update.message.reply_text(f"❌ Error agregando cliente: {str(e)}")
+        await responder(update, f"❌ Error agregando cliente: {str(e)}")
 
 async def procesar_eliminar_cliente(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Procesa la eliminación de cliente por admin"""
@@ -769,30 +2931,33 @@ async def procesar_eliminar_cliente(update: Update, context: ContextTypes.DEFAUL
     texto = update.message.text
     
     try:
-        if user_id not in usuarios_eliminando_cliente:
+        if not flujo_activo(user_id, 'eliminar_cliente'):
+            return
+        
+        if not await exigir_admin(update, "❌ Solo administradores pueden eliminar clientes."):
+            terminar_flujo(user_id)
             return
         
-        usuarios_eliminando_cliente.discard(user_id)
+        terminar_flujo(user_id)
         
         cliente_id = texto.strip()
         
         if not cliente_id.isdigit():
-            await update.message.reply_text("❌ **ID inválido**\n\nEl ID debe contener solo números.")
+            await responder(update, "❌ **ID inválido**\n\nEl ID debe contener solo números.")
             return
         
         try:
-            celda = sheet_registro.find(cliente_id)
-            if not celda:
-                await update.message.reply_text(f"❌ Cliente {cliente_id} no encontrado.")
+            # La baja desplaza filas de otros clientes: espera a que terminen las compras en curso
+            async with estructura_registro.exclusivo():
+                registro = await indice_clientes.eliminar(cliente_id)
+            if not registro:
+                await responder(update, f"❌ Cliente {cliente_id} no encontrado.")
                 return
             
-            fila = celda.row
-            datos_cliente = sheet_registro.row_values(fila)
-            nombre_cliente = datos_cliente[2] if len(datos_cliente) > 2 else "Sin nombre"
+            nombre_cliente = registro.nombre or "Sin nombre"
             
-            sheet_registro.delete_rows(fila)
-            
-            await update.message.reply_text(
+            await responder(
+                update,
                 f"✅ **Cliente eliminado**\n\n"
                 f"👤 **Nombre:** {nombre_cliente}\n"
                 f"🆔 **ID:** `{cliente_id}`\n"
@@ -802,212 +2967,285 @@ async def procesar_eliminar_cliente(update: Update, context: ContextTypes.DEFAUL
             print(f"✅ Cliente eliminado por admin: {nombre_cliente} ({cliente_id}) - Hora: {obtener_hora_venezuela()}")
             
         except Exception as e:
-            await update.message.reply_text(f"❌ Error eliminando cliente: {str(e)}")
+            await responder(update, f"❌ Error eliminando cliente: {str(e)}")
         
     except Exception as e:
         print(f"❌ Error procesando eliminación: {e}")
-        await update.message.reply_text(f"❌ Error: {str(e)}")
+        await responder(update, f"❌ Error: {str(e)}")
 
-async def mostrar_clientes_admin(update: Update):
-    """Muestra todos los clientes para admin"""
-    try:
-        if not sheet_registro:
-            await update.message.reply_text("❌ Error de conexión con Google Sheets.")
-            return
-        
-        todos_datos = sheet_registro.get_all_values()
-        
-        if len(todos_datos) <= 1:
-            await update.message.reply_text("👥 **CLIENTES REGISTRADOS**\n\n📭 No hay clientes registrados aún.")
-            return
+CLIENTES_POR_PAGINA_ADMIN = 20
+CLIENTES_POR_PAGINA_VENDEDOR = 15
+VENTAS_POR_PAGINA = 10
+
+def tramos_de_filas(filas):
+    """Números de fila ordenados -> tramos contiguos [(inicio, fin)]"""
+    tramos = []
+    for fila in filas:
+        if tramos and tramos[-1][1] == fila - 1:
+            tramos[-1] = (tramos[-1][0], fila)
+        else:
+            tramos.append((fila, fila))
+    return tramos
+
+async def pagina_clientes_completa(vendedor, pagina, tamano):
+    """Misma página que pagina_clientes, leyendo registro_clientes entero"""
+    todos_datos = await almacen.leer('registro')
+    columnas, filas = filas_de_clientes(todos_datos, vendedor)
+    fin = len(filas) - pagina * tamano
+    seleccion = filas[max(fin - tamano, 0):max(fin, 0)]
+    return [Cliente.desde_fila(fila, columnas) for fila in seleccion[::-1]], fin - tamano > 0
+
+async def pagina_clientes(vendedor=None, pagina=0, tamano=CLIENTES_POR_PAGINA_ADMIN):
+    """Clientes de una página del listado (0 = los más recientes), del más reciente al más antiguo
+
+    Devuelve (clientes, hay_mas). Solo se leen las filas de la página: sin
+    vendedor, el tramo final según la última fila conocida de
+    registro_clientes; con vendedor, sus filas según el índice. Si el índice
+    no está completo, o las filas ya no son las esperadas (la hoja se editó a
+    mano), se lee la hoja entera.
+    """
+    if not indice_clientes.cargado:
+        await cargar_datos_en_memoria()
+    columnas = indice_clientes.columnas
+    esperados = None
+    if vendedor is None and hoja_registro.ultima_fila:
+        fin = hoja_registro.ultima_fila - pagina * tamano
+        inicio = max(fin - tamano + 1, 2)
+        tramos = [(inicio, fin)] if fin >= inicio else []
+        hay_mas = inicio > 2
+    elif vendedor is not None and indice_clientes.completo:
+        filas = indice_clientes.filas_de_vendedor(vendedor)
+        fin = len(filas) - pagina * tamano
+        esperados = dict(filas[max(fin - tamano, 0):max(fin, 0)])
+        tramos = tramos_de_filas(sorted(esperados))
+        hay_mas = fin - tamano > 0
+    else:
+        return await pagina_clientes_completa(vendedor, pagina, tamano)
+    
+    leidas = await almacen.leer_filas('registro', tramos, letra_columna(max(columnas)))
+    clientes = []
+    for fila_num, valores in leidas:
+        cliente = Cliente.desde_fila(valores, columnas)
+        if esperados is not None:
+            movida = cliente.user_id != esperados[fila_num] or cliente.vendedor != vendedor
+        else:
+            # Tramo final: cada id leído debe estar en la fila que registra el índice
+            fila_indice = indice_clientes.fila_de(cliente.user_id)
+            movida = (fila_indice is not None or indice_clientes.completo) and fila_indice != fila_num
+        if movida:
+            print(f"⚠️ Filas de {vendedor or 'la página'} movidas en la hoja; se lee registro_clientes entero - Hora: {obtener_hora_venezuela()}")
+            return await pagina_clientes_completa(vendedor, pagina, tamano)
+        if cliente.user_id:
+            clientes.append(cliente)
+    return clientes[::-1], hay_mas
+
+def resumen_clientes(vendedor=None):
+    """(clientes, sellos, cerca del premio) de todos o de un vendedor, desde las estadísticas en memoria"""
+    if vendedor is None:
+        cerca = sum(n for sellos, n in estadisticas_vivas.distribucion_sellos.items() if sellos >= SELLOS_CERCA_PREMIO)
+        return estadisticas_vivas.total_clientes, estadisticas_vivas.total_sellos, cerca
+    datos = estadisticas_vivas.clientes_por_vendedor.get(vendedor, {})
+    return datos.get('clientes', 0), datos.get('sellos', 0), datos.get('cerca_premio', 0)
+
+def botones_listado(listado, pagina, hay_mas):
+    botones = []
+    if hay_mas:
+        botones.append(InlineKeyboardButton("◀️ Clientes anteriores", callback_data=f"listado_{listado}_{pagina + 1}"))
+    if pagina > 0:
+        botones.append(InlineKeyboardButton("▶️ Más recientes", callback_data=f"listado_{listado}_{pagina - 1}"))
+    return InlineKeyboardMarkup([botones]) if botones else None
+
+async def construir_clientes_admin(pagina=0):
+    """Arma el mensaje y los botones de una página de todos los clientes"""
+    clientes, hay_mas = await pagina_clientes(None, pagina, CLIENTES_POR_PAGINA_ADMIN)
+    total_clientes, _, _ = resumen_clientes()
+    
+    if not total_clientes and not clientes:
+        return "👥 **CLIENTES REGISTRADOS**\n\n📭 No hay clientes registrados aún.", None
+    
+    mensaje = f"👥 **TODOS LOS CLIENTES - ADMIN**\n⏰ Hora: {obtener_hora_venezuela()}\n\n"
+    
+    for i, cliente in enumerate(clientes, pagina * CLIENTES_POR_PAGINA_ADMIN + 1):
+        nombre_completo = cliente.nombre or f"Usuario_{cliente.user_id}"
+        vendedor = cliente.vendedor or "Sin asignar"
         
-        headers = todos_datos[0]
-        datos_clientes = todos_datos[1:]
+        mensaje += f"{i}. **{nombre_completo}**\n"
+        mensaje += f"   🆔 {cliente.user_id} | 🏺 {cliente.sellos}/{SELLOS_PARA_PREMIO}\n"
+        mensaje += f"   👤 {vendedor}\n\n"
+    
+    mensaje += f"📊 **Total clientes:** {total_clientes}"
+    return mensaje, botones_listado('admin', pagina, hay_mas)
+
+async def construir_clientes_vendedor(nombre_vendedor, pagina=0):
+    """Arma el mensaje y los botones de una página de los clientes del vendedor"""
+    clientes, hay_mas = await pagina_clientes(nombre_vendedor, pagina, CLIENTES_POR_PAGINA_VENDEDOR)
+    total_clientes, total_sellos, clientes_cerca_premio = resumen_clientes(nombre_vendedor)
+    
+    if not total_clientes and not clientes:
+        return "👥 **MIS CLIENTES**\n\n📭 No tienes clientes registrados aún.", None
+    
+    mensaje = f"👥 **MIS CLIENTES - {nombre_vendedor}**\n⏰ Hora: {obtener_hora_venezuela()}\n\n"
+    
+    for i, cliente in enumerate(clientes, pagina * CLIENTES_POR_PAGINA_VENDEDOR + 1):
+        nombre_completo = cliente.nombre or f"Usuario_{cliente.user_id}"
         
-        mensaje = f"👥 **TODOS LOS CLIENTES - ADMIN**\n⏰ Hora: {obtener_hora_venezuela()}\n\n"
+        mensaje += f"{i}. **{nombre_completo}**\n"
+        mensaje += f"   🆔 {cliente.user_id} | 🏺 {cliente.sellos}/{SELLOS_PARA_PREMIO}\n\n"
+    
+    mensaje += f"📊 **Resumen:**\n"
+    mensaje += f"• Total clientes: {total_clientes}\n"
+    mensaje += f"• Cerca del premio: {clientes_cerca_premio}\n"
+    mensaje += f"• Sellos generados: {total_sellos}"
+    return mensaje, botones_listado('clientes', pagina, hay_mas)
+
+async def construir_mis_ventas(nombre_vendedor, admin, pagina=0):
+    """Arma el mensaje y los botones de una página de MIS VENTAS (el admin ve todas)"""
+    vendedor = None if admin else nombre_vendedor
+    clientes, hay_mas = await pagina_clientes(vendedor, pagina, VENTAS_POR_PAGINA)
+    total_clientes, total_sellos, clientes_cerca_premio = resumen_clientes(vendedor)
+    
+    if not total_clientes and not clientes:
+        if admin:
+            return "💰 **MIS VENTAS - ADMIN**\n\n📭 No hay clientes registrados aún.", None
+        return "💰 **MIS VENTAS**\n\n📭 No tienes clientes registrados aún.", None
+    
+    if admin:
+        mensaje = f"💰 **TODAS LAS VENTAS - ADMIN**\n⏰ Hora: {obtener_hora_venezuela()}\n\n"
+    else:
+        mensaje = f"💰 **MIS VENTAS - {nombre_vendedor}**\n⏰ Hora: {obtener_hora_venezuela()}\n\n"
+    
+    for i, cliente in enumerate(clientes, pagina * VENTAS_POR_PAGINA + 1):
+        nombre_completo = cliente.nombre or f"Usuario_{cliente.user_id}"
+        vendedor_asignado = cliente.vendedor or "Sin asignar"
         
-        for i, cliente in enumerate(datos_clientes[-20:][::-1], 1):
-            if len(cliente) >= 6:
-                user_id_cliente = cliente[0]
-                nombre_completo = cliente[2] if len(cliente) > 2 and cliente[2] else f"Usuario_{user_id_cliente}"
-                sellos = cliente[4] if len(cliente) > 4 and cliente[4] else "0"
-                vendedor = cliente[5] if len(cliente) > 5 and cliente[5] else "Sin asignar"
-                
-                mensaje += f"{i}. **{nombre_completo}**\n"
-                mensaje += f"   🆔 {user_id_cliente} | 🏺 {sellos}/10\n"
-                mensaje += f"   👤 {vendedor}\n\n"
+        estado_premio = "🎯 (Cerca del premio!)" if cliente.sellos >= SELLOS_CERCA_PREMIO else ""
         
-        total_clientes = len(datos_clientes)
-        mensaje += f"📊 **Total clientes:** {total_clientes}"
+        mensaje += f"{i}. **{nombre_completo}**\n"
+        mensaje += f"   🆔 {cliente.user_id} | 🏺 {cliente.sellos}/{SELLOS_PARA_PREMIO} {estado_premio}\n"
+        if admin:
+            mensaje += f"   👤 {vendedor_asignado}\n"
+        mensaje += "\n"
+    
+    mensaje += f"📊 **Resumen:**\n"
+    mensaje += f"• Total clientes: {total_clientes}\n"
+    mensaje += f"• Cerca del premio: {clientes_cerca_premio}\n"
+    mensaje += f"• Sellos generados: {total_sellos}\n"
+    if admin:
+        mensaje += f"• Ingresos estimados: ${total_sellos * PRECIO_VENTA:,}"
+    return mensaje, botones_listado('ventas', pagina, hay_mas)
+
+async def mostrar_clientes_admin(update: Update):
+    """Muestra todos los clientes para admin"""
+    try:
+        if not almacen.disponible('registro'):
+            await responder(update, "❌ Error de conexión con Google Sheets.")
+            return
         
-        await update.message.reply_text(mensaje)
+        mensaje, reply_markup = await construir_clientes_admin()
+        await responder(update, mensaje, reply_markup=reply_markup)
         print(f"📋 Admin consultó lista completa de clientes - Hora: {obtener_hora_venezuela()}")
         
     except Exception as e:
         print(f"❌ Error mostrando clientes admin: {e}")
-        await update.message.reply_text("❌ Error obteniendo datos de clientes.")
+        await responder(update, "❌ Error obteniendo datos de clientes.")
 
 async def mostrar_clientes_vendedor(update: Update, user_id: str):
     """Muestra clientes del vendedor específico"""
     try:
-        if not sheet_registro:
-            await update.message.reply_text("❌ Error de conexión con Google Sheets.")
+        if not almacen.disponible('registro'):
+            await responder(update, "❌ Error de conexión con Google Sheets.")
             return
         
-        vendedores = await obtener_vendedores_activos()
-        vendedor_actual = next((v for v in vendedores if v['user_id'] == user_id), None)
+        await registro_vendedores.asegurar()
+        vendedor_actual = registro_vendedores.por_id.get(user_id)
         
         if not vendedor_actual:
-            await update.message.reply_text("❌ No se encontró tu información de vendedor.")
-            return
-        
-        nombre_vendedor = vendedor_actual['nombre']
-        
-        todos_datos = sheet_registro.get_all_values()
-        
-        if len(todos_datos) <= 1:
-            await update.message.reply_text("👥 **MIS CLIENTES**\n\n📭 No tienes clientes registrados aún.")
-            return
-        
-        headers = todos_datos[0]
-        datos_clientes = todos_datos[1:]
-        
-        clientes_vendedor = []
-        for cliente in datos_clientes:
-            if len(cliente) > 5 and cliente[5] == nombre_vendedor:
-                clientes_vendedor.append(cliente)
-        
-        if not clientes_vendedor:
-            await update.message.reply_text("👥 **MIS CLIENTES**\n\n📭 No tienes clientes registrados aún.")
+            await responder(update, "❌ No se encontró tu información de vendedor.")
             return
         
-        mensaje = f"👥 **MIS CLIENTES - {nombre_vendedor}**\n⏰ Hora: {obtener_hora_venezuela()}\n\n"
-        
-        for i, cliente in enumerate(clientes_vendedor[-15:][::-1], 1):
-            if len(cliente) >= 6:
-                user_id_cliente = cliente[0]
-                nombre_completo = cliente[2] if len(cliente) > 2 and cliente[2] else f"Usuario_{user_id_cliente}"
-                sellos = cliente[4] if len(cliente) > 4 and cliente[4] else "0"
-                
-                mensaje += f"{i}. **{nombre_completo}**\n"
-                mensaje += f"   🆔 {user_id_cliente} | 🏺 {sellos}/10\n\n"
-        
-        total_clientes = len(clientes_vendedor)
-        clientes_cerca_premio = len([c for c in clientes_vendedor if len(c) > 4 and c[4] and int(c[4]) >= 7])
-        
-        mensaje += f"📊 **Resumen:**\n"
-        mensaje += f"• Total clientes: {total_clientes}\n"
-        mensaje += f"• Cerca del premio: {clientes_cerca_premio}\n"
-        mensaje += f"• Sellos generados: {sum(int(c[4]) for c in clientes_vendedor if len(c) > 4 and c[4])}"
-        
-        await update.message.reply_text(mensaje)
-        print(f"📋 Vendedor {nombre_vendedor} consultó sus clientes - Hora: {obtener_hora_venezuela()}")
+        mensaje, reply_markup = await construir_clientes_vendedor(vendedor_actual.nombre)
+        await responder(update, mensaje, reply_markup=reply_markup)
+        print(f"📋 Vendedor {vendedor_actual.nombre} consultó sus clientes - Hora: {obtener_hora_venezuela()}")
         
     except Exception as e:
         print(f"❌ Error mostrando clientes vendedor: {e}")
-        await update.message.reply_text("❌ Error obteniendo datos de clientes.")
+        await responder(update, "❌ Error obteniendo datos de clientes.")
 
 async def mostrar_mis_ventas(update: Update, user_id: str):
     """Muestra clientes personales del vendedor con sus sellos"""
     try:
-        if not sheet_registro:
-            await update.message.reply_text("❌ Error de conexión con Google Sheets.")
-            return
-        
-        vendedores = await obtener_vendedores_activos()
-        vendedor_actual = next((v for v in vendedores if v['user_id'] == user_id), None)
-        
-        if not vendedor_actual:
-            await update.message.reply_text("❌ No se encontró tu información de vendedor.")
+        if not almacen.disponible('registro'):
+            await responder(update, "❌ Error de conexión con Google Sheets.")
             return
         
-        nombre_vendedor = vendedor_actual['nombre']
-        privilegios = vendedor_actual['privilegios']
-        
-        todos_datos = sheet_registro.get_all_values()
+        await registro_vendedores.asegurar()
+        vendedor_actual = registro_vendedores.por_id.get(user_id)
         
-        if len(todos_datos) <= 1:
-            if await es_admin(user_id):
-                await update.message.reply_text("💰 **MIS VENTAS - ADMIN**\n\n📭 No hay clientes registrados aún.")
-            else:
-                await update.message.reply_text("💰 **MIS VENTAS**\n\n📭 No tienes clientes registrados aún.")
+        if not vendedor_actual:
+            await responder(update, "❌ No se encontró tu información de vendedor.")
             return
         
-        headers = todos_datos[0]
-        datos_clientes = todos_datos[1:]
+        mensaje, reply_markup = await construir_mis_ventas(vendedor_actual.nombre, await es_admin(user_id))
+        await responder(update, mensaje, reply_markup=reply_markup)
+        print(f"💰 {vendedor_actual.nombre} consultó sus ventas - Hora: {obtener_hora_venezuela()}")
         
-        if await es_admin(user_id):
-            clientes_vendedor = datos_clientes
-            titulo = f"💰 **TODAS LAS VENTAS - ADMIN**\n⏰ Hora: {obtener_hora_venezuela()}\n\n"
+    except Exception as e:
+        print(f"❌ Error mostrando mis ventas: {e}")
+        await responder(update, "❌ Error obteniendo datos de ventas.")
+
+async def manejar_paginas_clientes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Maneja los botones de paginación de VER CLIENTES y MIS VENTAS"""
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = str(query.from_user.id)
+    
+    try:
+        _, listado, pagina = query.data.split('_')
+        pagina = int(pagina)
+        admin = await es_admin(user_id)
+        await registro_vendedores.asegurar()
+        vendedor_actual = registro_vendedores.por_id.get(user_id)
+        
+        if listado == 'admin' and admin:
+            mensaje, reply_markup = await construir_clientes_admin(pagina)
+        elif listado == 'clientes' and vendedor_actual:
+            mensaje, reply_markup = await construir_clientes_vendedor(vendedor_actual.nombre, pagina)
+        elif listado == 'ventas' and vendedor_actual:
+            mensaje, reply_markup = await construir_mis_ventas(vendedor_actual.nombre, admin, pagina)
         else:
-            clientes_vendedor = [c for c in datos_clientes if len(c) > 5 and c[5] == nombre_vendedor]
-            titulo = f"💰 **MIS VENTAS - {nombre_vendedor}**\n⏰ Hora: {obtener_hora_venezuela()}\n\n"
-        
-        if not clientes_vendedor:
-            await update.message.reply_text("💰 **MIS VENTAS**\n\n📭 No tienes clientes registrados aún.")
+            await editar(query, "❌ Solo vendedores y administradores pueden ver clientes.")
             return
         
-        mensaje = titulo
-        
-        for i, cliente in enumerate(clientes_vendedor[-10:][::-1], 1):
-            if len(cliente) >= 6:
-                user_id_cliente = cliente[0]
-                nombre_completo = cliente[2] if len(cliente) > 2 and cliente[2] else f"Usuario_{user_id_cliente}"
-                sellos = cliente[4] if len(cliente) > 4 and cliente[4] else "0"
-                vendedor_asignado = cliente[5] if len(cliente) > 5 and cliente[5] else "Sin asignar"
-                
-                estado_premio = "🎯 (Cerca del premio!)" if int(sellos) >= 7 else ""
-                
-                if await es_admin(user_id):
-                    mensaje += f"{i}. **{nombre_completo}**\n"
-                    mensaje += f"   🆔 {user_id_cliente} | 🏺 {sellos}/10 {estado_premio}\n"
-                    mensaje += f"   👤 {vendedor_asignado}\n\n"
-                else:
-                    mensaje += f"{i}. **{nombre_completo}**\n"
-                    mensaje += f"   🆔 {user_id_cliente} | 🏺 {sellos}/10 {estado_premio}\n\n"
-        
-        total_clientes = len(clientes_vendedor)
-        clientes_cerca_premio = len([c for c in clientes_vendedor if len(c) > 4 and c[4] and int(c[4]) >= 7])
-        total_sellos = sum(int(c[4]) for c in clientes_vendedor if len(c) > 4 and c[4])
-        
-        mensaje += f"📊 **Resumen:**\n"
-        mensaje += f"• Total clientes: {total_clientes}\n"
-        mensaje += f"• Cerca del premio: {clientes_cerca_premio}\n"
-        mensaje += f"• Sellos generados: {total_sellos}\n"
-        if await es_admin(user_id):
-            mensaje += f"• Ingresos estimados: ${total_sellos * 12:,}"
-        
-        await update.message.reply_text(mensaje)
-        print(f"💰 {nombre_vendedor} consultó sus ventas - Hora: {obtener_hora_venezuela()}")
-        
+        await editar(query, mensaje, reply_markup=reply_markup)
     except Exception as e:
-        print(f"❌ Error mostrando mis ventas: {e}")
-        await update.message.reply_text("❌ Error obteniendo datos de ventas.")
+        print(f"❌ Error paginando clientes: {e}")
+        await editar(query, "❌ Error obteniendo datos de clientes.")
 
 async def mostrar_lista_eliminar_vendedor(update: Update):
     """Muestra lista de vendedores para eliminar"""
     try:
         vendedores = await obtener_vendedores_activos()
-        vendedores_para_eliminar = [v for v in vendedores if v['user_id'] != ADMIN_ID]
+        vendedores_para_eliminar = [v for v in vendedores if v.user_id != ADMIN_ID]
         
         if not vendedores_para_eliminar:
-            await update.message.reply_text("❌ No hay vendedores disponibles para eliminar.")
+            await responder(update, "❌ No hay vendedores disponibles para eliminar.")
             return
         
         keyboard = []
         for vendedor in vendedores_para_eliminar:
-            privilegios_emoji = "🌟" if vendedor['privilegios'] == 'premium' else "👤"
+            privilegios_emoji = "🌟" if vendedor.privilegios == 'premium' else "👤"
             keyboard.append([InlineKeyboardButton(
-                f"🚫 {privilegios_emoji} {vendedor['nombre']} (ID: {vendedor['user_id']})", 
-                callback_data=f"eliminar_{vendedor['user_id']}"
+                f"🚫 {privilegios_emoji} {vendedor.nombre} (ID: {vendedor.user_id})", 
+                callback_data=f"eliminar_{vendedor.user_id}"
             )])
         
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("🚫 **ELIMINAR VENDEDOR - SELECCIONA:**", reply_markup=reply_markup)
+        await responder(update, "🚫 **ELIMINAR VENDEDOR - SELECCIONA:**", reply_markup=reply_markup)
         
     except Exception as e:
         print(f"❌ Error mostrando lista eliminar vendedor: {e}")
-        await update.message.reply_text("❌ Error cargando lista de vendedores.")
+        await responder(update, "❌ Error cargando lista de vendedores.")
 
 async def manejar_eliminar_vendedor(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja la eliminación de vendedores desde botones"""
@@ -1018,42 +3256,33 @@ async def manejar_eliminar_vendedor(update: Update, context: ContextTypes.DEFAUL
     data = query.data
     
     if not await es_admin(user_id):
-        await query.edit_message_text("❌ Solo administradores pueden eliminar vendedores.")
+        await editar(query, "❌ Solo administradores pueden eliminar vendedores.")
         return
     
     try:
         vendedor_id = data.replace('eliminar_', '')
         
         if vendedor_id == ADMIN_ID:
-            await query.edit_message_text("❌ No puedes eliminarte a ti mismo como admin.")
-            return
-        
-        todos_datos = sheet_vendedores.get_all_values()
-        datos_vendedores = todos_datos[1:]
-        
-        vendedor_encontrado = False
-        nombre_vendedor = "Sin nombre"
-        privilegios_vendedor = "normal"
-        
-        for i, fila in enumerate(datos_vendedores, start=2):
-            if len(fila) > 0 and str(fila[0]) == vendedor_id:
-                sheet_vendedores.update_cell(i, 4, "NO")
-                nombre_vendedor = fila[1] if len(fila) > 1 else "Sin nombre"
-                privilegios_vendedor = fila[4] if len(fila) > 4 else "normal"
-                vendedor_encontrado = True
-                break
-        
-        if not vendedor_encontrado:
-            await query.edit_message_text("❌ Vendedor no encontrado.")
+            await editar(query, "❌ No puedes eliminarte a ti mismo como admin.")
             return
         
-        # Forzar actualización del cache
-        await forzar_actualizacion_cache()
-        
-        vendedores_actualizados = await obtener_vendedores_activos()
+        async with bloquear_vendedor(vendedor_id):
+            await registro_vendedores.asegurar()
+            fila_vendedor = registro_vendedores.filas.get(vendedor_id)
+            
+            if fila_vendedor is None:
+                await editar(query, "❌ Vendedor no encontrado.")
+                return
+            
+            await almacen.actualizar_estado_vendedor(fila_vendedor, "NO", vendedor_id)
+            vendedor = registro_vendedores.vendedor_desactivado(vendedor_id)
+            nombre_vendedor = vendedor.nombre
+            privilegios_vendedor = vendedor.privilegios
+        vendedores_actualizados = registro_vendedores.activos()
         
         privilegios_emoji = "🌟" if privilegios_vendedor == 'premium' else "👤"
-        await query.edit_message_text(
+        await editar(
+            query,
             f"✅ **Vendedor eliminado**\n\n"
             f"{privilegios_emoji} **Nombre:** {nombre_vendedor}\n"
             f"🆔 **ID:** `{vendedor_id}`\n"
@@ -1065,7 +3294,7 @@ async def manejar_eliminar_vendedor(update: Update, context: ContextTypes.DEFAUL
         
     except Exception as e:
         print(f"❌ Error eliminando vendedor: {e}")
-        await query.edit_message_text("❌ Error eliminando vendedor.")
+        await editar(query, "❌ Error eliminando vendedor.")
 
 async def manejar_contacto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja el botón de contacto"""
@@ -1082,20 +3311,15 @@ async def manejar_contacto(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"📱 Contacta directamente al admin"
     )
     
-    await update.message.reply_text(mensaje_contacto)
+    await responder(update, mensaje_contacto)
 
 async def registrar_usuario(update: Update, user_id: str, nombre: str):
     """Registra un nuevo usuario en el sistema"""
     try:
-        if not sheet_registro:
-            await update.message.reply_text("❌ Error del sistema. Intenta más tarde.")
+        if not almacen.disponible('registro'):
+            await responder(update, "❌ Error del sistema. Intenta más tarde.")
             return
             
-        celda = sheet_registro.find(user_id)
-        if celda:
-            await update.message.reply_text("ℹ️ Ya estás registrado en el programa.")
-            return
-        
         first_name = update.effective_user.first_name or ""
         last_name = update.effective_user.last_name or ""
         username = f"@{update.effective_user.username}" if update.effective_user.username else ""
@@ -1104,40 +3328,46 @@ async def registrar_usuario(update: Update, user_id: str, nombre: str):
         if not nombre_completo or nombre_completo == " ":
             nombre_completo = nombre
         
-        sheet_registro.append_row([
-            user_id,
-            username,
-            nombre_completo,
-            obtener_fecha_venezuela(),  # ✅ Hora Venezuela
-            0,
-            ""
-        ])
+        async with bloquear_cliente(user_id):
+            if await indice_clientes.existe(user_id):
+                await responder(update, "ℹ️ Ya estás registrado en el programa.")
+                return
+            
+            await indice_clientes.agregar([
+                user_id,
+                username,
+                nombre_completo,
+                obtener_fecha_venezuela(),  # ✅ Hora Venezuela
+                0,
+                ""
+            ])
         
         mensaje_bienvenida = (
             "🎉 **¡Bienvenidos a la Tarjeta de Promociones de Shisha_Mgta!**\n\n"
             "✅ Ahora participas en nuestro programa de fidelidad\n"
             "🏺 Cada compra de arguile = 1 sello\n"
-            "💰 10 sellos = 50% de descuento\n\n"
+            f"💰 {SELLOS_PARA_PREMIO} sellos = 50% de descuento\n\n"
             "📱 **Para comprar:**\n"
             "• Usa 🛒 COMPRAS\n"
             "• Selecciona tu vendedor\n"
             "• ¡Escanea el QR y listo!"
         )
         
-        await update.message.reply_text(mensaje_bienvenida)
+        await responder(update, mensaje_bienvenida)
         await mostrar_menu_principal(update, user_id, nombre_completo)
         print(f"✅ Nuevo usuario registrado: {nombre_completo} ({user_id}) - Hora: {obtener_hora_venezuela()}")
         
     except Exception as e:
         print(f"❌ Error registrando usuario: {e}")
-        await update.message.reply_text("❌ Error en el registro. Intenta más tarde.")
+        await responder(update, "❌ Error en el registro. Intenta más tarde.")
 
 async def registro_directo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Comando directo /registro"""
     user_id = str(update.effective_user.id)
     
     if await es_vendedor(user_id) and not await es_admin(user_id):
-        await update.message.reply_text(
+        await responder(
+            update,
             "❌ **No puedes registrarte como cliente**\n\n"
             "Eres un vendedor activo del sistema.\n"
             "Si deseas ser cliente, primero debes ser eliminado como vendedor."
@@ -1154,39 +3384,38 @@ async def solicitar_compra(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         if await es_vendedor(user_id) and not await es_admin(user_id):
-            await update.message.reply_text("❌ **Los vendedores no pueden realizar compras**\n\nSolo los clientes registrados pueden usar esta función.")
+            await responder(update, "❌ **Los vendedores no pueden realizar compras**\n\nSolo los clientes registrados pueden usar esta función.")
             return
         
-        celda = sheet_registro.find(user_id)
-        if not celda:
-            await update.message.reply_text("🔐 **Primero debes registrarte**\n\nUsa 📝 REGISTRARME")
+        if not await indice_clientes.existe(user_id):
+            await responder(update, "🔐 **Primero debes registrarte**\n\nUsa 📝 REGISTRARME")
             return
         
         vendedores = await obtener_vendedores_validos()
         
         if not vendedores:
-            await update.message.reply_text("❌ **No hay vendedores disponibles**")
+            await responder(update, "❌ **No hay vendedores disponibles**")
             return
         
         keyboard = []
         for vendedor in vendedores:
-            privilegios_emoji = "🌟" if vendedor['privilegios'] == 'premium' else "👤"
+            privilegios_emoji = "🌟" if vendedor.privilegios == 'premium' else "👤"
             keyboard.append([InlineKeyboardButton(
-                f"{privilegios_emoji} {vendedor['nombre']}", 
-                callback_data=f"vendedor_{vendedor['user_id']}"
+                f"{privilegios_emoji} {vendedor.nombre}", 
+                callback_data=f"vendedor_{vendedor.user_id}"
             )])
         
         keyboard.append([InlineKeyboardButton("❓ No sé / Cualquier vendedor", callback_data="vendedor_todos")])
         
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        solicitudes_activas[user_id] = {
-            'nombre_cliente': nombre_cliente,
-            'user_id_cliente': user_id,
-            'timestamp': datetime.now()
-        }
+        iniciar_flujo(user_id, 'compra', ttl=QR_VALIDEZ_SEGUNDOS,
+                      nombre_cliente=nombre_cliente,
+                      user_id_cliente=user_id,
+                      timestamp=datetime.now())
         
-        await update.message.reply_text(
+        await responder(
+            update,
             f"🛒 **Solicitud de Compra**\n\n"
             f"👤 **Cliente:** {nombre_cliente}\n"
             f"⏰ **Hora:** {obtener_hora_venezuela()}\n\n"
@@ -1200,7 +3429,7 @@ async def solicitar_compra(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     except Exception as e:
         print(f"❌ Error en solicitud de compra: {e}")
-        await update.message.reply_text("❌ Error procesando solicitud.")
+        await responder(update, "❌ Error procesando solicitud.")
 
 async def manejar_seleccion_vendedor(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja la selección de vendedor y genera QR"""
@@ -1210,39 +3439,34 @@ async def manejar_seleccion_vendedor(update: Update, context: ContextTypes.DEFAU
     user_id_cliente = str(query.from_user.id)
     data = query.data
     
-    if user_id_cliente not in solicitudes_activas:
-        await query.edit_message_text("❌ La solicitud ha expirado. Usa 🛒 COMPRAS nuevamente.")
+    datos_solicitud = flujo_activo(user_id_cliente, 'compra')
+    if not datos_solicitud:
+        await editar(query, "❌ La solicitud ha expirado. Usa 🛒 COMPRAS nuevamente.")
         return
     
-    datos_solicitud = solicitudes_activas[user_id_cliente]
     nombre_cliente = datos_solicitud['nombre_cliente']
     
     try:
-        celda = sheet_registro.find(user_id_cliente)
-        fila = celda.row
-        datos_cliente = sheet_registro.row_values(fila)
-        
-        while len(datos_cliente) < 6:
-            datos_cliente.append("")
-        
-        sellos_actual = int(datos_cliente[4]) if len(datos_cliente) > 4 and datos_cliente[4] else 0
+        fila, datos_cliente = await indice_clientes.obtener(user_id_cliente)
+        sellos_actual = datos_cliente.sellos
         
         if data == "vendedor_todos":
             vendedores = await obtener_vendedores_validos()
-            vendedores_ids = [v['user_id'] for v in vendedores]
+            vendedores_ids = [v.user_id for v in vendedores]
             mensaje_cliente = "📨 **QR enviado a todos los vendedores**"
             vendedor_nombre = "todos los vendedores"
         else:
             vendedor_id = data.replace('vendedor_', '')
             vendedores_ids = [vendedor_id] if vendedor_id.isdigit() else []
             
-            vendedores = await obtener_vendedores_activos()
-            vendedor_nombre = next((v['nombre'] for v in vendedores if v['user_id'] == vendedor_id), "Vendedor")
+            await registro_vendedores.asegurar()
+            vendedor = registro_vendedores.por_id.get(vendedor_id)
+            vendedor_nombre = vendedor.nombre if vendedor else "Vendedor"
             mensaje_cliente = f"📨 **QR enviado a {vendedor_nombre}**"
         
         if not vendedores_ids:
-            await query.edit_message_text("❌ No hay vendedores válidos para enviar el QR.")
-            del solicitudes_activas[user_id_cliente]
+            await editar(query, "❌ No hay vendedores válidos para enviar el QR.")
+            terminar_flujo(user_id_cliente)
             return
         
         qr_enviado = await generar_y_enviar_qr_automatico(
@@ -1250,27 +3474,30 @@ async def manejar_seleccion_vendedor(update: Update, context: ContextTypes.DEFAU
         )
         
         if qr_enviado:
-            await query.edit_message_text(
+            await editar(
+                query,
                 f"✅ **Solicitud Completada**\n\n"
                 f"{mensaje_cliente}\n\n"
                 f"👤 **Cliente:** {nombre_cliente}\n"
-                f"📊 **Sellos actuales:** {sellos_actual}/10\n"
+                f"📊 **Sellos actuales:** {sellos_actual}/{SELLOS_PARA_PREMIO}\n"
                 f"⏰ **Hora:** {obtener_hora_venezuela()}\n\n"
                 f"⚡ **El vendedor ya tiene tu QR listo**\n"
                 f"¡Acércate para escanearlo! 🏺"
             )
         else:
-            await query.edit_message_text("❌ Error generando QR. Intenta nuevamente.")
+            await editar(query, "❌ Error generando QR. Intenta nuevamente.")
         
-        del solicitudes_activas[user_id_cliente]
+        terminar_flujo(user_id_cliente)
         
         print(f"✅ QR generado para {nombre_cliente}, vendedor: {vendedor_nombre} - Hora: {obtener_hora_venezuela()}")
         
     except Exception as e:
         print(f"❌ Error en selección de vendedor: {e}")
-        await query.edit_message_text("❌ Error procesando selección.")
-        if user_id_cliente in solicitudes_activas:
-            del solicitudes_activas[user_id_cliente]
+        await editar(query, "❌ Error procesando selección.")
+        terminar_flujo(user_id_cliente)
+
+# QR en vuelo a la vez por solicitud, además de los límites del despachador
+MAX_ENVIOS_QR_SIMULTANEOS = int(os.getenv('MAX_ENVIOS_QR_SIMULTANEOS', '5'))
 
 async def generar_y_enviar_qr_automatico(context: ContextTypes.DEFAULT_TYPE, 
                                        nombre_cliente: str, user_id_cliente: str,
@@ -1281,16 +3508,18 @@ async def generar_y_enviar_qr_automatico(context: ContextTypes.DEFAULT_TYPE,
         codigo_unico = f"compra_{uuid.uuid4().hex[:8]}_{int(datetime.now().timestamp())}"
         link_compra = f"https://t.me/Shishamgtabot?start={codigo_unico}"
         
-        codigos_activos[codigo_unico] = {
+        codigos_activos.guardar(codigo_unico, {
             'user_id': user_id_cliente,
             'timestamp': datetime.now(),
             'nombre': nombre_cliente,
             'vendedor': vendedor_nombre
-        }
+        })
         
+        # QR en memoria: sin escribir archivos en disco
         img_qr = qrcode.make(link_compra)
-        nombre_archivo = f"qr_auto_{nombre_cliente.replace(' ', '_')}_{int(datetime.now().timestamp())}.png"
-        img_qr.save(nombre_archivo)
+        buffer_qr = io.BytesIO()
+        img_qr.save(buffer_qr, format='PNG')
+        foto_qr = buffer_qr.getvalue()
         
         # ✅ TEXTO CORREGIDO: Sin errores y con hora Venezuela
         hora_venezuela = obtener_hora_venezuela()
@@ -1299,8 +3528,8 @@ async def generar_y_enviar_qr_automatico(context: ContextTypes.DEFAULT_TYPE,
             f"🏺 **QR AUTOMÁTICO GENERADO**\n\n"
             f"👤 **Cliente:** {nombre_cliente}\n"
             f"📱 **Usuario:** {user_id_cliente}\n"
-            f"📊 **Sellos actuales:** {sellos_actual}/10\n"
-            f"🎯 **Faltan para premio:** {10 - sellos_actual}\n"
+            f"📊 **Sellos actuales:** {sellos_actual}/{SELLOS_PARA_PREMIO}\n"
+            f"🎯 **Faltan para premio:** {SELLOS_PARA_PREMIO - sellos_actual}\n"
             f"⏰ **Hora Venezuela:** {hora_venezuela}\n"
             f"🔒 **Válido por:** 10 minutos\n\n"
             f"📋 **INSTRUCCIONES:**\n"
@@ -1309,38 +3538,65 @@ async def generar_y_enviar_qr_automatico(context: ContextTypes.DEFAULT_TYPE,
             f"3. ¡Compra registrada automáticamente! ✅"
         )
         
-        qrs_enviados = 0
-        with open(nombre_archivo, 'rb') as qr_file:
-            for vendedor_id in vendedores_ids:
+        # ✅ SISTEMA DE PRECIOS PRIVADO: privilegios desde el registro en memoria
+        await registro_vendedores.asegurar()
+        
+        # Privilegios resueltos una sola vez por destinatario, antes del reparto
+        privilegios_por_id = {}
+        for vendedor_id in vendedores_ids:
+            if vendedor_id.isdigit():
+                privilegios_por_id[vendedor_id] = privilegios_en_registro(vendedor_id)
+            else:
+                print(f"⚠️ ID de vendedor inválido: {vendedor_id}")
+        ids_validos = list(privilegios_por_id)
+        
+        fallos = []
+        foto = {'qr': foto_qr}
+        limite = asyncio.Semaphore(MAX_ENVIOS_QR_SIMULTANEOS)
+        
+        async def enviar_qr(vendedor_id, vendedor_privilegios):
+            if vendedor_privilegios in ['admin', 'premium']:
+                # Admin/Premium ven precios
+                mensaje_vendedor = mensaje_vendedor_base + f"\n💰 **Valor venta:** ${PRECIO_VENTA}"
+            else:
+                # Vendedores normales NO ven precios
+                mensaje_vendedor = mensaje_vendedor_base
+            
+            async with limite:
                 try:
-                    if vendedor_id.isdigit():
-                        # ✅ SISTEMA DE PRECIOS PRIVADO: Verificar privilegios
-                        vendedor_privilegios = await obtener_privilegios_usuario(vendedor_id)
-                        
-                        if vendedor_privilegios in ['admin', 'premium']:
-                            # Admin/Premium ven precios
-                            mensaje_vendedor = mensaje_vendedor_base + f"\n💰 **Valor venta:** $12"
-                        else:
-                            # Vendedores normales NO ven precios
-                            mensaje_vendedor = mensaje_vendedor_base
-                        
-                        await context.bot.send_photo(
-                            chat_id=int(vendedor_id),
-                            photo=qr_file,
-                            caption=mensaje_vendedor
-                        )
-                        qrs_enviados += 1
-                        print(f"📨 QR enviado a vendedor {vendedor_id} (privilegios: {vendedor_privilegios}) - Hora: {hora_venezuela}")
-                        qr_file.seek(0)
-                    else:
-                        print(f"⚠️ ID de vendedor inválido: {vendedor_id}")
+                    mensaje_enviado = await despachador.enviar(int(vendedor_id), functools.partial(
+                        context.bot.send_photo,
+                        chat_id=int(vendedor_id),
+                        photo=foto['qr'],
+                        caption=mensaje_vendedor
+                    ), PRIORIDAD_QR)
                 except Exception as e:
+                    fallos.append((vendedor_id, e))
                     print(f"❌ Error enviando QR a vendedor {vendedor_id}: {e}")
+                    return False
+            
+            # Tras la primera subida se reutiliza el file_id de Telegram
+            if mensaje_enviado and mensaje_enviado.photo:
+                foto['qr'] = mensaje_enviado.photo[-1].file_id
+            print(f"📨 QR enviado a vendedor {vendedor_id} (privilegios: {vendedor_privilegios}) - Hora: {hora_venezuela}")
+            return True
         
-        try:
-            os.remove(nombre_archivo)
-        except:
-            pass
+        # La primera entrega sube la imagen; el resto sale con su file_id, de a MAX_ENVIOS_QR_SIMULTANEOS
+        qrs_enviados = 0
+        pendientes = list(ids_validos)
+        while pendientes and qrs_enviados == 0:
+            vendedor_id = pendientes.pop(0)
+            if await enviar_qr(vendedor_id, privilegios_por_id[vendedor_id]):
+                qrs_enviados += 1
+        
+        if pendientes:
+            resultados = await asyncio.gather(*(
+                enviar_qr(vendedor_id, privilegios_por_id[vendedor_id]) for vendedor_id in pendientes
+            ))
+            qrs_enviados += sum(resultados)
+        
+        if fallos:
+            print(f"⚠️ QR no entregado a {len(fallos)} de {len(ids_validos)} vendedores: {[v for v, _ in fallos]}")
         
         return qrs_enviados > 0
                 
@@ -1351,79 +3607,83 @@ async def generar_y_enviar_qr_automatico(context: ContextTypes.DEFAULT_TYPE,
 async def procesar_compra_qr(update: Update, user_id: str, codigo_qr: str):
     """Procesa una compra desde QR único - CON NOTIFICACIÓN AL VENDEDOR"""
     try:
-        if not sheet_registro:
-            await update.message.reply_text("❌ Error del sistema.")
+        if not almacen.disponible('registro'):
+            await responder(update, "❌ Error del sistema.")
             return
         
-        limpiar_codigos_expirados()
-            
-        if codigo_qr in codigos_activos:
-            datos_qr = codigos_activos[codigo_qr]
-            
-            if datetime.now() - datos_qr['timestamp'] > timedelta(minutes=10):
-                await update.message.reply_text("❌ Este QR ha expirado.")
-                del codigos_activos[codigo_qr]
-                return
-            
-            celda = sheet_registro.find(user_id)
+        # El código se consume de inmediato: dos escaneos del mismo QR no pueden contar doble
+        datos_qr = codigos_activos.tomar(codigo_qr)
+        
+        if datos_qr:
             nombre_cliente = datos_qr.get('nombre', update.effective_user.first_name or "Cliente")
             vendedor_actual = datos_qr.get('vendedor', 'vendedor_desconocido')
             
-            if not celda:
-                first_name = update.effective_user.first_name or ""
-                last_name = update.effective_user.last_name or ""
-                username = f"@{update.effective_user.username}" if update.effective_user.username else ""
-                
-                nombre_completo = f"{first_name} {last_name}".strip()
-                if not nombre_completo or nombre_completo == " ":
-                    nombre_completo = nombre_cliente
-                
-                sheet_registro.append_row([
-                    user_id,
-                    username,
-                    nombre_completo,
-                    obtener_fecha_venezuela(),  # ✅ Hora Venezuela
-                    1,
-                    vendedor_actual
-                ])
-                
-                await update.message.reply_text(
+            try:
+                # ✅ Lectura y suma del sello serializadas por cliente
+                async with bloquear_cliente(user_id):
+                    cliente = await indice_clientes.obtener(user_id)
+                    
+                    if not cliente:
+                        first_name = update.effective_user.first_name or ""
+                        last_name = update.effective_user.last_name or ""
+                        username = f"@{update.effective_user.username}" if update.effective_user.username else ""
+                        
+                        nombre_completo = f"{first_name} {last_name}".strip()
+                        if not nombre_completo or nombre_completo == " ":
+                            nombre_completo = nombre_cliente
+                        
+                        sellos_actual = await registrar_compra_en_lote(user_id, None, vendedor_actual, [
+                            user_id,
+                            username,
+                            nombre_completo,
+                            obtener_fecha_venezuela(),  # ✅ Hora Venezuela
+                            1,
+                            vendedor_actual
+                        ])
+                    else:
+                        sellos_actual = await registrar_compra_en_lote(user_id, cliente, vendedor_actual)
+            except Exception:
+                # La compra no se guardó: el QR vuelve a quedar disponible
+                restante = QR_VALIDEZ_SEGUNDOS - (datetime.now() - datos_qr['timestamp']).total_seconds()
+                if restante > 0:
+                    codigos_activos.guardar(codigo_qr, datos_qr, ttl=restante)
+                raise
+            
+            # ✅ Primero las respuestas al cliente, luego el aviso al vendedor
+            if not cliente:
+                await responder(
+                    update,
                     "🎉 **¡Bienvenidos a la Tarjeta de Promociones de Shisha_Mgta!**\n\n"
                     "✅ Ahora participas en nuestro programa de fidelidad\n"
                     "🏺 Cada compra de arguile = 1 sello\n"
-                    "💰 10 sellos = 50% de descuento\n\n"
+                    f"💰 {SELLOS_PARA_PREMIO} sellos = 50% de descuento\n\n"
                     "📱 **Para comprar:**\n"
                     "• Usa 🛒 COMPRAS\n"
                     "• Selecciona tu vendedor\n"
                     "• ¡Escanea el QR y listo!"
                 )
-                sellos_actual = 1
-            else:
-                fila = celda.row
-                datos_actuales = sheet_registro.row_values(fila)
-                
-                while len(datos_actuales) < 6:
-                    datos_actuales.append("")
-                
-                sellos_actual = int(datos_actuales[4]) if datos_actuales[4] else 0
-                nuevos_sellos = sellos_actual + 1
-                
-                sheet_registro.update_cell(fila, 5, nuevos_sellos)
-                sheet_registro.update_cell(fila, 6, vendedor_actual)
-                sellos_actual = nuevos_sellos
             
-            try:
-                if sheet_historial:
-                    sheet_historial.append_row([
-                        user_id,
-                        obtener_fecha_hora_venezuela(),  # ✅ Hora Venezuela
-                        vendedor_actual,
-                        1,
-                        "compra_normal"
-                    ])
-                    print(f"📝 Historial guardado: {user_id} - {vendedor_actual} - Hora: {obtener_hora_venezuela()}")
-            except Exception as e:
-                print(f"⚠️ Error guardando historial: {e}")
+            if sellos_actual >= SELLOS_PARA_PREMIO:
+                await responder(
+                    update,
+                    "🎉 **¡FELICIDADES!** 🎉\n\n"
+                    f"🏺 **Has completado {SELLOS_PARA_PREMIO} compras en Shisha MGTA**\n\n"
+                    "💰 **PREMIO:** 50% DE DESCUENTO\n"
+                    "en tu próxima compra\n\n"
+                    "📱 Muestra este mensaje al hacer tu pedido\n"
+                    "¡Gracias por tu preferencia!"
+                )
+                print(f"🎉 Usuario {user_id} ganó 50% descuento - Hora: {obtener_hora_venezuela()}")
+            else:
+                await responder(
+                    update,
+                    f"✅ **Compra registrada exitosamente**\n\n"
+                    f"🏺 Shisha MGTA agradece tu compra\n\n"
+                    f"📊 **Sellos acumulados:** {sellos_actual}/{SELLOS_PARA_PREMIO}\n"
+                    f"🎯 **Te faltan:** {SELLOS_PARA_PREMIO - sellos_actual}\n"
+                    f"⏰ **Hora:** {obtener_hora_venezuela()}\n\n"
+                    f"¡Sigue disfrutando de nuestros servicios!"
+                )
             
             try:
                 if vendedor_actual != "todos los vendedores" and vendedor_actual != "vendedor_desconocido":
@@ -1433,108 +3693,97 @@ async def procesar_compra_qr(update: Update, user_id: str, codigo_qr: str):
                         f"👤 Cliente: {nombre_cliente}\n"
                         f"📱 ID: {user_id}\n"
                         f"🏺 Sello sumado: +1\n"
-                        f"📊 Total acumulado: {sellos_actual}/10 sellos\n"
-                        f"💰 Valor venta: $12\n"
+                        f"📊 Total acumulado: {sellos_actual}/{SELLOS_PARA_PREMIO} sellos\n"
+                        f"💰 Valor venta: ${PRECIO_VENTA}\n"
                         f"⏰ Hora Venezuela: {hora_actual}\n\n"
                         f"¡Venta registrada exitosamente! 🎉"
                     )
                     
-                    vendedores = await obtener_vendedores_activos()
-                    for vendedor in vendedores:
-                        if vendedor['nombre'] == vendedor_actual and vendedor['user_id'].isdigit():
-                            try:
-                                await update._bot.send_message(
-                                    chat_id=int(vendedor['user_id']),
-                                    text=mensaje_vendedor
-                                )
-                                print(f"📨 Notificación enviada al vendedor {vendedor_actual} - Hora: {hora_actual}")
-                                break
-                            except Exception as e:
-                                print(f"❌ Error enviando notificación al vendedor: {e}")
+                    await registro_vendedores.asegurar()
+                    vendedor = registro_vendedores.por_nombre.get(vendedor_actual)
+                    if vendedor and vendedor.user_id.isdigit():
+                        # Fuera del camino crítico: el handler no espera este envío
+                        despachador.enviar(int(vendedor.user_id), functools.partial(
+                            update._bot.send_message,
+                            chat_id=int(vendedor.user_id),
+                            text=mensaje_vendedor
+                        ), PRIORIDAD_NOTIFICACION, esperar=False)
+                        print(f"📨 Notificación encolada para el vendedor {vendedor_actual} - Hora: {hora_actual}")
             except Exception as e:
                 print(f"⚠️ Error enviando notificación al vendedor: {e}")
             
-            celda_actualizada = sheet_registro.find(user_id)
-            datos_actualizados = sheet_registro.row_values(celda_actualizada.row)
-            sellos_actual = int(datos_actualizados[4]) if len(datos_actualizados) > 4 and datos_actualizados[4] else 0
-            
-            if sellos_actual >= 10:
-                sheet_registro.update_cell(celda_actualizada.row, 5, 0)
-                await update.message.reply_text(
-                    "🎉 **¡FELICIDADES!** 🎉\n\n"
-                    "🏺 **Has completado 10 compras en Shisha MGTA**\n\n"
-                    "💰 **PREMIO:** 50% DE DESCUENTO\n"
-                    "en tu próxima compra\n\n"
-                    "📱 Muestra este mensaje al hacer tu pedido\n"
-                    "¡Gracias por tu preferencia!"
-                )
-                print(f"🎉 Usuario {user_id} ganó 50% descuento - Hora: {obtener_hora_venezuela()}")
-            else:
-                await update.message.reply_text(
-                    f"✅ **Compra registrada exitosamente**\n\n"
-                    f"🏺 Shisha MGTA agradece tu compra\n\n"
-                    f"📊 **Sellos acumulados:** {sellos_actual}/10\n"
-                    f"🎯 **Te faltan:** {10 - sellos_actual}\n"
-                    f"⏰ **Hora:** {obtener_hora_venezuela()}\n\n"
-                    f"¡Sigue disfrutando de nuestros servicios!"
-                )
-            
-            del codigos_activos[codigo_qr]
             print(f"✅ Compra registrada via QR para usuario {user_id} con vendedor {vendedor_actual} - Hora: {obtener_hora_venezuela()}")
             
+        elif codigos_activos.vencio(codigo_qr):
+            await responder(update, "❌ Este QR ha expirado.")
+            
         else:
-            await update.message.reply_text("❌ QR inválido o ya utilizado.")
+            await responder(update, "❌ QR inválido o ya utilizado.")
             
     except Exception as e:
         print(f"❌ Error procesando QR: {e}")
-        await update.message.reply_text("❌ Error procesando compra.")
+        await responder(update, "❌ Error procesando compra.")
 
 def limpiar_codigos_expirados():
     """Limpia códigos QR expirados"""
-    ahora = datetime.now()
-    expirados = []
+    expirados = codigos_activos.purgar()
     
-    for codigo, datos in codigos_activos.items():
-        if ahora - datos['timestamp'] > timedelta(minutes=10):
-            expirados.append(codigo)
+    if expirados:
+        print(f"🧹 Códigos expirados limpiados: {expirados} - Hora: {obtener_hora_venezuela()}")
     
-    for codigo in expirados:
-        del codigos_activos[codigo]
+    return expirados
+
+def limpiar_estados_vencidos():
+    """Limpia flujos de conversación abandonados"""
+    vencidos = estados_conversacion.purgar()
     
-    if expirados:
-        print(f"🧹 Códigos expirados limpiados: {len(expirados)} - Hora: {obtener_hora_venezuela()}")
+    if vencidos:
+        print(f"🧹 Flujos abandonados limpiados: {vencidos} - Hora: {obtener_hora_venezuela()}")
     
-    return len(expirados)
+    return vencidos
+
+async def barrer_codigos_expirados(context: ContextTypes.DEFAULT_TYPE):
+    """Tarea periódica del JobQueue que purga códigos QR y flujos vencidos"""
+    limpiar_codigos_expirados()
+    limpiar_estados_vencidos()
+
+async def barrido_codigos_sin_jobqueue():
+    """Alternativa al JobQueue cuando no está instalado el extra job-queue"""
+    while True:
+        await asyncio.sleep(BARRIDO_CODIGOS_SEGUNDOS)
+        limpiar_codigos_expirados()
+        limpiar_estados_vencidos()
 
 async def sellos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Muestra los sellos actuales del usuario"""
     user_id = str(update.effective_user.id)
     
     try:
-        if not sheet_registro:
-            await update.message.reply_text("❌ Error del sistema.")
+        if not almacen.disponible('registro'):
+            await responder(update, "❌ Error del sistema.")
             return
             
-        celda = sheet_registro.find(user_id)
-        if celda:
-            datos = sheet_registro.row_values(celda.row)
-            sellos_actual = int(datos[4]) if len(datos) > 4 and datos[4] else 0
+        cliente = await indice_clientes.obtener(user_id)
+        if cliente:
+            sellos_actual = cliente[1].sellos
             
-            await update.message.reply_text(
+            await responder(
+                update,
                 f"📊 Tu progreso en Shisha MGTA\n"
                 f"⏰ Hora: {obtener_hora_venezuela()}\n\n"
-                f"🏺 Sellos acumulados: {sellos_actual}/10\n"
-                f"🎯 Te faltan {10 - sellos_actual} sellos para tu 50% de descuento\n\n"
+                f"🏺 Sellos acumulados: {sellos_actual}/{SELLOS_PARA_PREMIO}\n"
+                f"🎯 Te faltan {SELLOS_PARA_PREMIO - sellos_actual} sellos para tu 50% de descuento\n\n"
                 f"¡Sigue comprando para ganar tu premio!"
             )
         else:
-            await update.message.reply_text(
+            await responder(
+                update,
                 "❌ No estás registrado en el programa.\n\n"
                 "Usa el botón 📝 REGISTRARME o escribe /registro"
             )
     except Exception as e:
         print(f"❌ Error en sellos: {e}")
-        await update.message.reply_text("❌ Error consultando sellos.")
+        await responder(update, "❌ Error consultando sellos.")
 
 async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Muestra información del programa"""
@@ -1547,70 +3796,92 @@ async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "3. El vendedor recibirá tu QR automáticamente\n"
         "4. Escanea el QR con tu cámara\n"
         "5. ¡Acumula 1 sello por compra!\n"
-        "6. Al llegar a 10 sellos: ¡50% DE DESCUENTO!\n\n"
+        f"6. Al llegar a {SELLOS_PARA_PREMIO} sellos: ¡50% DE DESCUENTO!\n\n"
         "🔒 **Seguridad:**\n"
         "• QR únicos por compra\n"
         "• Válidos por 10 minutos\n"
         "• Registro automático\n\n"
         "📞 **¿Preguntas?** Contacta al vendedor"
     )
-    await update.message.reply_text(mensaje)
+    await responder(update, mensaje)
+
+async def construir_pagina_historial(user_id: str, cursor=None):
+    """Arma el mensaje y los botones de una página del historial del cliente"""
+    await asegurar_historial(user_id, cursor)
+    compras, inicio, cursor = indice_historial.pagina(user_id, cursor)
+    total_compras = indice_historial.total(user_id)
+    
+    mensaje = f"📋 **TU HISTORIAL DE COMPRAS**\n⏰ Hora: {obtener_hora_venezuela()}\n\n"
+    
+    for compra in compras:
+        fecha = compra.fecha or "Fecha desconocida"
+        vendedor = compra.vendedor or "Vendedor desconocido"
+        
+        try:
+            fecha_dt = datetime.strptime(fecha, "%Y-%m-%d %H:%M:%S")
+            fecha_formateada = fecha_dt.strftime("%d/%m/%Y %H:%M")
+        except:
+            fecha_formateada = fecha
+            
+        mensaje += f"📅 {fecha_formateada} - 👤 {vendedor}\n"
+    
+    mensaje += f"\n📊 **Total de compras:** {total_compras}"
+    mensaje += f"\n🎯 **Te faltan para premio:** {SELLOS_PARA_PREMIO - (total_compras % SELLOS_PARA_PREMIO)}"
+    
+    botones = []
+    if inicio > 0:
+        botones.append(InlineKeyboardButton("◀️ Compras anteriores", callback_data=f"historial_{inicio}"))
+    if cursor < total_compras:
+        botones.append(InlineKeyboardButton("▶️ Más recientes", callback_data=f"historial_{min(cursor + COMPRAS_POR_PAGINA, total_compras)}"))
+    
+    reply_markup = InlineKeyboardMarkup([botones]) if botones else None
+    return mensaje, reply_markup
 
 async def historial_cliente(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Muestra el historial de compras del cliente"""
     user_id = str(update.effective_user.id)
     
     try:
-        if not sheet_historial:
-            await update.message.reply_text("❌ Sistema de historial no disponible.")
-            return
-            
-        todos_datos = sheet_historial.get_all_values()
-        
-        if len(todos_datos) <= 1:
-            await update.message.reply_text("📭 No tienes compras registradas aún.")
+        if not almacen.disponible('historial'):
+            await responder(update, "❌ Sistema de historial no disponible.")
             return
         
-        headers = todos_datos[0]
-        datos_historial = todos_datos[1:]
+        if not indice_historial.cargado:
+            await cargar_datos_en_memoria()
         
-        compras_cliente = [fila for fila in datos_historial if fila[0] == user_id]
-        
-        if not compras_cliente:
-            await update.message.reply_text("📭 No tienes compras registradas.")
+        if indice_historial.total(user_id) == 0:
+            await responder(update, "📭 No tienes compras registradas.")
             return
         
-        mensaje = f"📋 **TU HISTORIAL DE COMPRAS**\n⏰ Hora: {obtener_hora_venezuela()}\n\n"
-        
-        for compra in compras_cliente[-10:][::-1]:
-            fecha = compra[1] if len(compra) > 1 else "Fecha desconocida"
-            vendedor = compra[2] if len(compra) > 2 else "Vendedor desconocido"
-            
-            try:
-                fecha_dt = datetime.strptime(fecha, "%Y-%m-%d %H:%M:%S")
-                fecha_formateada = fecha_dt.strftime("%d/%m/%Y %H:%M")
-            except:
-                fecha_formateada = fecha
-                
-            mensaje += f"📅 {fecha_formateada} - 👤 {vendedor}\n"
-        
-        total_compras = len(compras_cliente)
-        mensaje += f"\n📊 **Total de compras:** {total_compras}"
-        mensaje += f"\n🎯 **Te faltan para premio:** {10 - (total_compras % 10)}"
-        
-        await update.message.reply_text(mensaje)
+        mensaje, reply_markup = await construir_pagina_historial(user_id)
+        await responder(update, mensaje, reply_markup=reply_markup)
         print(f"📋 {user_id} consultó su historial de compras - Hora: {obtener_hora_venezuela()}")
         
     except Exception as e:
         print(f"❌ Error en historial: {e}")
-        await update.message.reply_text("❌ Error obteniendo historial.")
+        await responder(update, "❌ Error obteniendo historial.")
+
+async def manejar_paginas_historial(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Maneja los botones de paginación del historial"""
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = str(query.from_user.id)
+    
+    try:
+        cursor = int(query.data.replace('historial_', ''))
+        mensaje, reply_markup = await construir_pagina_historial(user_id, cursor)
+        await editar(query, mensaje, reply_markup=reply_markup)
+    except Exception as e:
+        print(f"❌ Error paginando historial: {e}")
+        await editar(query, "❌ Error obteniendo historial.")
 
 async def listar_vendedores(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Lista todos los vendedores - SOLO ADMIN - CORREGIDO DEFINITIVAMENTE"""
     user_id = str(update.effective_user.id)
     
     if not await es_admin(user_id):
-        await update.message.reply_text("❌ Solo el administrador puede usar este comando.")
+        await responder(update, "❌ Solo el administrador puede usar este comando.")
         return
     
     try:
@@ -1621,7 +3892,7 @@ async def listar_vendedores(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # ✅ CORRECCIÓN: Verificar que vendedores sea una lista
         if not isinstance(vendedores, list):
             print(f"❌ Error: vendedores no es una lista, es: {type(vendedores)} - {vendedores}")
-            await update.message.reply_text("❌ Error: Datos de vendedores corruptos.")
+            await responder(update, "❌ Error: Datos de vendedores corruptos.")
             return
         
         print(f"📊 Vendedores obtenidos: {len(vendedores)} - Tipo: {type(vendedores)}")
@@ -1632,13 +3903,13 @@ async def listar_vendedores(update: Update, context: ContextTypes.DEFAULT_TYPE):
             mensaje = f"👥 **VENDEDORES ACTIVOS**\n⏰ Hora: {obtener_hora_venezuela()}\n"
             for i, vendedor in enumerate(vendedores, 1):
                 # ✅ CORRECCIÓN: Verificar estructura del vendedor
-                if not isinstance(vendedor, dict):
-                    print(f"❌ Vendedor {i} no es dict: {type(vendedor)} - {vendedor}")
+                if not isinstance(vendedor, Vendedor):
+                    print(f"❌ Vendedor {i} no es válido: {type(vendedor)} - {vendedor}")
                     continue
                     
-                user_id_vendedor = vendedor.get('user_id', 'Sin ID')
-                nombre_vendedor = vendedor.get('nombre', 'Sin nombre')
-                privilegios_vendedor = vendedor.get('privilegios', 'normal')
+                user_id_vendedor = vendedor.user_id
+                nombre_vendedor = vendedor.nombre
+                privilegios_vendedor = vendedor.privilegios
                 
                 privilegios_emoji = "👑" if user_id_vendedor == ADMIN_ID else ("🌟" if privilegios_vendedor == 'premium' else "👤")
                 es_admin_str = " (Admin)" if user_id_vendedor == ADMIN_ID else ""
@@ -1648,8 +3919,8 @@ async def listar_vendedores(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # ✅ CORRECCIÓN CRÍTICA: Solo calcular estadísticas si hay vendedores y CORREGIR el error de len()
         if vendedores:
             total_general = len(vendedores)
-            vendedores_normales = len([v for v in vendedores if v.get('user_id') != ADMIN_ID and v.get('privilegios') == 'normal'])
-            vendedores_premium = len([v for v in vendedores if v.get('user_id') != ADMIN_ID and v.get('privilegios') == 'premium'])
+            vendedores_normales = len([v for v in vendedores if v.user_id != ADMIN_ID and v.privilegios == 'normal'])
+            vendedores_premium = len([v for v in vendedores if v.user_id != ADMIN_ID and v.privilegios == 'premium'])
             total_eliminables = vendedores_normales + vendedores_premium  # ✅ CORREGIDO: solo suma, NO usar len()
             
             mensaje += f"\n📊 **Total en sistema:** {total_general} vendedores"
@@ -1660,56 +3931,42 @@ async def listar_vendedores(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if total_eliminables > 0:
                 mensaje += f"\n🚫 **Disponibles para eliminar:** {total_eliminables} vendedores"
         
-        await update.message.reply_text(mensaje)
+        await responder(update, mensaje)
         print(f"✅ Lista de vendedores enviada correctamente - Total: {len(vendedores)}")
         
     except Exception as e:
         print(f"❌ Error listando vendedores: {e}")
         print(f"📋 Traceback completo: {traceback.format_exc()}")
-        await update.message.reply_text("❌ Error listando vendedores.")
+        await responder(update, "❌ Error listando vendedores.")
 
-async def generar_ranking_detallado():
-    """🏆 GENERA RANKING DETALLADO DE VENDEDORES"""
+async def generar_ranking_detallado(instantanea=None):
+    """🏆 GENERA RANKING DETALLADO DE VENDEDORES (de la ventana de la instantánea, si tiene)"""
     try:
-        if not sheet_historial or not sheet_vendedores:
+        if not almacen.disponible('historial') or not almacen.disponible('vendedores'):
             return "📊 RANKING VENDEDORES\n❌ No hay datos disponibles"
         
-        await forzar_actualizacion_cache()
-        vendedores_activos = await obtener_vendedores_activos()
-        nombres_vendedores_activos = [v['nombre'] for v in vendedores_activos]
+        if instantanea is None:
+            instantanea = await tomar_instantanea()
         
-        datos_historial = sheet_historial.get_all_values()
+        nombres_vendedores_activos = {v.nombre for v in instantanea.vendedores_activos}
         
-        if len(datos_historial) <= 1:
+        if instantanea.ventas_ventana == 0:
+            if instantanea.ventana:
+                return f"📊 RANKING VENDEDORES\n📭 No hay ventas en {instantanea.ventana[0]}"
             return "📊 RANKING VENDEDORES\n📭 No hay ventas registradas"
         
         stats_vendedores = {}
         
-        for venta in datos_historial[1:]:
-            if len(venta) > 2 and venta[2]:
-                vendedor = venta[2]
-                if vendedor in nombres_vendedores_activos:
-                    if vendedor not in stats_vendedores:
-                        stats_vendedores[vendedor] = {
-                            'ventas': 0,
-                            'clientes_unicos': set(),
-                            'ultima_venta': venta[1] if len(venta) > 1 else '',
-                            'total_sellos': 0
-                        }
-                    
-                    stats_vendedores[vendedor]['ventas'] += 1
-                    if len(venta) > 0 and venta[0]:
-                        stats_vendedores[vendedor]['clientes_unicos'].add(venta[0])
-        
-        datos_registro = sheet_registro.get_all_values()
-        if len(datos_registro) > 1:
-            for cliente in datos_registro[1:]:
-                if len(cliente) > 5 and cliente[5] in stats_vendedores:
-                    if len(cliente) > 4 and cliente[4]:
-                        try:
-                            stats_vendedores[cliente[5]]['total_sellos'] += int(cliente[4])
-                        except:
-                            pass
+        for vendedor, ventas in instantanea.ventas_por_vendedor.items():
+            if vendedor in nombres_vendedores_activos and ventas['ventas'] > 0:
+                clientes = instantanea.clientes_por_vendedor.get(vendedor, {})
+                stats_vendedores[vendedor] = {
+                    'ventas': ventas['ventas'],
+                    'ingreso': ventas['ingreso'],
+                    'clientes_unicos': ventas['clientes_unicos'],
+                    'ultima_venta': ventas['ultima_venta'],
+                    'total_sellos': clientes.get('sellos', 0)
+                }
         
         ranking_ordenado = sorted(stats_vendedores.items(), 
                                 key=lambda x: x[1]['ventas'], 
@@ -1718,14 +3975,17 @@ async def generar_ranking_detallado():
         if not ranking_ordenado:
             return "📊 RANKING VENDEDORES\n📭 No hay ventas de vendedores activos"
         
-        mensaje_ranking = f"🏆 TOP VENDEDORES ACTIVOS\n⏰ Hora: {obtener_hora_venezuela()}\n\n"
+        mensaje_ranking = f"🏆 TOP VENDEDORES ACTIVOS\n"
+        if instantanea.ventana:
+            mensaje_ranking += f"📅 {instantanea.ventana[0]}\n"
+        mensaje_ranking += f"⏰ Hora: {instantanea.tomada[11:]}\n\n"
         
         emojis_podio = ["🥇", "🥈", "🥉", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣", "🔟"]
         
         for i, (vendedor, stats) in enumerate(ranking_ordenado[:10]):
             emoji = emojis_podio[i] if i < len(emojis_podio) else f"{i+1}."
             ventas = stats['ventas']
-            clientes_unicos = len(stats['clientes_unicos'])
+            clientes_unicos = stats['clientes_unicos']
             sellos = stats['total_sellos']
             
             eficiencia = (ventas / clientes_unicos) if clientes_unicos > 0 else 0
@@ -1736,10 +3996,11 @@ async def generar_ranking_detallado():
                 f"👥 {clientes_unicos} clientes\n"
                 f"   🏷️ {sellos} sellos | "
                 f"📊 {eficiencia:.1f} vta/cli\n"
-                f"   💰 ${ventas * 12:,} ingresos\n\n"
+                f"   💰 ${stats['ingreso']:,} ingresos\n\n"
             )
         
         total_ventas_ranking = sum(stats['ventas'] for stats in stats_vendedores.values())
+        total_ingreso_ranking = sum(stats['ingreso'] for stats in stats_vendedores.values())
         total_vendedores_ranking = len(stats_vendedores)
         promedio_ventas = total_ventas_ranking / total_vendedores_ranking if total_vendedores_ranking > 0 else 0
         
@@ -1747,72 +4008,61 @@ async def generar_ranking_detallado():
         mensaje_ranking += f"• Total ventas: {total_ventas_ranking}\n"
         mensaje_ranking += f"• Vendedores activos: {total_vendedores_ranking}\n"
         mensaje_ranking += f"• Promedio: {promedio_ventas:.1f} ventas/vendedor\n"
-        mensaje_ranking += f"• Ingresos totales: ${total_ventas_ranking * 12:,}\n"
+        mensaje_ranking += f"• Ingresos totales: ${total_ingreso_ranking:,}\n"
         
         if ranking_ordenado:
             mejor_vendedor = ranking_ordenado[0]
-            mensaje_ranking += f"• 🏅 Mejor: {mejor_vendedor[0]} ({mejor_vendedor[1]['ventas']} ventas = ${mejor_vendedor[1]['ventas'] * 12:,})"
+            mensaje_ranking += f"• 🏅 Mejor: {mejor_vendedor[0]} ({mejor_vendedor[1]['ventas']} ventas = ${mejor_vendedor[1]['ingreso']:,})"
         
         return mensaje_ranking
         
     except Exception as e:
         return f"📊 RANKING VENDEDORES\n❌ Error: {str(e)}"
 
-async def obtener_estadisticas_completas():
+async def obtener_estadisticas_completas(instantanea=None):
     """📊 ESTADÍSTICAS COMPLETAS DEL SISTEMA"""
     try:
-        if not sheet_registro or not sheet_vendedores or not sheet_historial:
+        if not almacen.disponible('registro') or not almacen.disponible('vendedores') or not almacen.disponible('historial'):
             return "❌ Error de conexión con Google Sheets"
         
-        await forzar_actualizacion_cache()
-        
-        datos_registro = sheet_registro.get_all_values()
-        datos_vendedores = sheet_vendedores.get_all_values()
-        datos_historial = sheet_historial.get_all_values()
+        if instantanea is None:
+            instantanea = await tomar_instantanea()
         
-        total_clientes = len(datos_registro) - 1 if len(datos_registro) > 1 else 0
-        total_ventas = len(datos_historial) - 1 if len(datos_historial) > 1 else 0
+        total_clientes = instantanea.total_clientes
+        total_ventas = instantanea.total_ventas
         
-        vendedores_activos = await obtener_vendedores_activos()
+        vendedores_activos = instantanea.vendedores_activos
         total_vendedores = len(vendedores_activos)
         
         activos_count = total_vendedores
-        vendedores_normales = len([v for v in vendedores_activos if v['privilegios'] == 'normal' and v['user_id'] != ADMIN_ID])
-        vendedores_premium = len([v for v in vendedores_activos if v['privilegios'] == 'premium'])
-        
-        ranking_simple = await generar_ranking_detallado()
-        
-        total_sellos = 0
-        clientes_con_sellos = 0
-        clientes_cerca_premio = 0
-        hoy = obtener_fecha_venezuela()  # ✅ Hora Venezuela
-        clientes_nuevos_hoy = 0
-        ventas_hoy = 0
-        
-        if len(datos_registro) > 1:
-            for cliente in datos_registro[1:]:
-                if len(cliente) > 4 and cliente[4]:
-                    try:
-                        sellos_cliente = int(cliente[4])
-                        total_sellos += sellos_cliente
-                        if sellos_cliente > 0:
-                            clientes_con_sellos += 1
-                        if 7 <= sellos_cliente <= 9:
-                            clientes_cerca_premio += 1
-                    except:
-                        pass
-                
-                if len(cliente) > 3 and cliente[3] == hoy:
-                    clientes_nuevos_hoy += 1
-        
-        if len(datos_historial) > 1:
-            for venta in datos_historial[1:]:
-                if len(venta) > 1 and venta[1].startswith(hoy):
-                    ventas_hoy += 1
+        vendedores_normales = len([v for v in vendedores_activos if v.privilegios == 'normal' and v.user_id != ADMIN_ID])
+        vendedores_premium = len([v for v in vendedores_activos if v.privilegios == 'premium'])
+        
+        ranking_simple = await generar_ranking_detallado(instantanea)
+        
+        total_sellos = instantanea.total_sellos
+        clientes_con_sellos = instantanea.clientes_con_sellos
+        clientes_cerca_premio = instantanea.clientes_cerca_premio
+        clientes_nuevos_hoy = instantanea.clientes_nuevos_hoy
+        ventas_hoy = instantanea.ventas_hoy
+        
+        seccion_ventana = ""
+        if instantanea.ventana:
+            etiqueta, desde, hasta = instantanea.ventana
+            ventas_ventana = instantanea.ventas_por_vendedor.values()
+            ingreso_ventana = sum(datos['ingreso'] for datos in ventas_ventana)
+            dias = (datetime.strptime(hasta, '%Y-%m-%d') - datetime.strptime(desde, '%Y-%m-%d')).days + 1
+            seccion_ventana = (
+                f"\n📅 VENTAS {etiqueta.upper()}\n"
+                f"• Ventas: {instantanea.ventas_ventana}\n"
+                f"• Ingresos: ${ingreso_ventana:,}\n"
+                f"• Clientes atendidos: {sum(datos['clientes_unicos'] for datos in ventas_ventana)}\n"
+                f"• Promedio: {instantanea.ventas_ventana / dias:.1f} ventas/día\n"
+            )
         
         estadisticas = f"""
 🏆 ESTADÍSTICAS COMPLETAS - SHISHA MGTA
-⏰ Hora Venezuela: {obtener_hora_venezuela()}
+⏰ Hora Venezuela: {instantanea.tomada[11:]}
 
 👥 CLIENTES
 • Total registrados: {total_clientes}
@@ -1825,8 +4075,8 @@ async def obtener_estadisticas_completas():
 • Total sellos: {total_sellos}
 • Ventas totales: {total_ventas}
 • Ventas hoy: {ventas_hoy}
-• Ingresos estimados: ${total_ventas * 12:,}
-
+• Ingresos estimados: ${total_ventas * PRECIO_VENTA:,}
+{seccion_ventana}
 👨‍💼 VENDEDORES
 • Total en sistema: {total_vendedores}
 • Activos: {activos_count}
@@ -1837,7 +4087,7 @@ async def obtener_estadisticas_completas():
 
 🔮 PROYECCIONES
 • Premios próximos: {clientes_cerca_premio} clientes
-• Ingreso/día: ${(ventas_hoy * 12):,}
+• Ingreso/día: ${(ventas_hoy * PRECIO_VENTA):,}
 • Ritmo: {ventas_hoy} ventas/hoy
 """
         
@@ -1846,10 +4096,458 @@ async def obtener_estadisticas_completas():
     except Exception as e:
         return f"❌ Error obteniendo estadísticas: {str(e)}"
 
+# Rol del usuario resuelto una vez por update
+ROLES_VENDEDOR = ('premium', 'normal')
+
+async def resolver_rol(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Resuelve el rol del usuario y lo guarda en el contexto del update (grupo -1)
+
+    Se borra y se vuelve a resolver con cada update: un cambio en la hoja de
+    vendedores se aplica en el siguiente mensaje.
+    """
+    context.rol = None
+    if update.effective_user:
+        await rol_de(update, context)
+
+async def rol_de(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    """Devuelve el rol ya resuelto para este update: admin, premium, normal o cliente"""
+    rol = getattr(context, 'rol', None)
+    if rol is None:
+        user_id = str(update.effective_user.id)
+        if user_id == ADMIN_ID:
+            rol = 'admin'
+        else:
+            rol = await obtener_privilegios_usuario(user_id)
+            if rol not in ('cliente',) + ROLES_VENDEDOR:
+                rol = 'normal'
+        context.rol = rol
+    return rol
+
+async def iniciar_agregar_vendedor_normal(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await exigir_admin(update, "❌ Solo administradores pueden agregar vendedores."):
+        return
+    iniciar_flujo(update.effective_user.id, 'agregar_vendedor', premium=False)
+    await responder(
+        update,
+        "👤 **AGREGAR VENDEDOR NORMAL**\n\n"
+        "📱 **Envía el ID y nombre del vendedor:**\n"
+        "`123456789 Nombre_Apellido`"
+    )
+
+async def iniciar_agregar_vendedor_premium(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await exigir_admin(update, "❌ Solo administradores pueden agregar vendedores."):
+        return
+    iniciar_flujo(update.effective_user.id, 'agregar_vendedor', premium=True)
+    await responder(
+        update,
+        "🌟 **AGREGAR VENDEDOR PREMIUM**\n\n"
+        "📱 **Envía el ID y nombre del vendedor:**\n"
+        "`123456789 Nombre_Apellido`"
+    )
+
+async def iniciar_agregar_cliente(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await exigir_admin(update, "❌ Solo administradores pueden agregar clientes."):
+        return
+    iniciar_flujo(update.effective_user.id, 'agregar_cliente')
+    await responder(
+        update,
+        "➕ **AGREGAR CLIENTE**\n\n"
+        "📱 **Envía el ID y nombre del cliente:**\n"
+        "`123456789 Nombre Cliente`"
+    )
+
+async def iniciar_eliminar_cliente(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await exigir_admin(update, "❌ Solo administradores pueden eliminar clientes."):
+        return
+    iniciar_flujo(update.effective_user.id, 'eliminar_cliente')
+    await responder(
+        update,
+        "🚫 **ELIMINAR CLIENTE**\n\n"
+        "📱 **Envía el ID del cliente a eliminar:**\n"
+        "`123456789`"
+    )
+
+async def boton_eliminar_vendedor(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await exigir_admin(update, "❌ Solo administradores pueden eliminar vendedores."):
+        return
+    await mostrar_lista_eliminar_vendedor(update)
+
+async def boton_ver_clientes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await rol_de(update, context) == 'admin':
+        await mostrar_clientes_admin(update)
+    else:
+        await mostrar_clientes_vendedor(update, str(update.effective_user.id))
+
+async def boton_mis_ventas(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await mostrar_mis_ventas(update, str(update.effective_user.id))
+
+async def boton_estadisticas(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Una sola foto para el mensaje y para la hoja: mismos números en ambos
+    instantanea = await tomar_instantanea()
+    estadisticas = await obtener_estadisticas_completas(instantanea)
+    await responder(update, estadisticas)
+    
+    # ✅ GUARDAR en la hoja después de responder
+    await guardar_estadisticas_en_sheet(instantanea)
+
+async def boton_ranking(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    ranking = await generar_ranking_detallado()
+    await responder(update, ranking)
+
+async def boton_actualizar_cache(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await exigir_admin(update, "❌ Solo el administrador puede actualizar el cache."):
+        return
+    await forzar_actualizacion_cache()
+    await cargar_datos_en_memoria()
+    await responder(update, f"✅ **Cache actualizado correctamente**\n\nLos datos ahora están sincronizados con Google Sheets.\n⏰ Hora: {obtener_hora_venezuela()}")
+
+# Botón -> (acción, mensaje si el rol no tiene permiso)
+BOTONES = {
+    "👤 AGREGAR VENDEDOR NORMAL": (iniciar_agregar_vendedor_normal, "❌ Solo administradores pueden agregar vendedores."),
+    "🌟 AGREGAR VENDEDOR PREMIUM": (iniciar_agregar_vendedor_premium, "❌ Solo administradores pueden agregar vendedores."),
+    "🚫 ELIMINAR VENDEDOR": (boton_eliminar_vendedor, "❌ Solo administradores pueden eliminar vendedores."),
+    "📋 LISTAR VENDEDORES": (listar_vendedores, "❌ Solo administradores pueden ver la lista de vendedores."),
+    "👥 VER CLIENTES": (boton_ver_clientes, "❌ Solo vendedores y administradores pueden ver clientes."),
+    "➕ AGREGAR CLIENTE": (iniciar_agregar_cliente, "❌ Solo administradores pueden agregar clientes."),
+    "🚫 ELIMINAR CLIENTE": (iniciar_eliminar_cliente, "❌ Solo administradores pueden eliminar clientes."),
+    "💰 MIS VENTAS": (boton_mis_ventas, "❌ Solo vendedores y administradores pueden ver ventas."),
+    "📊 ESTADÍSTICAS": (boton_estadisticas, "❌ Solo administradores y vendedores premium pueden ver estadísticas."),
+    "🏆 RANKING VENDEDORES": (boton_ranking, "❌ Solo administradores y vendedores premium pueden ver rankings."),
+    "🛒 COMPRAS": (solicitar_compra, None),
+    "🛒 COMPRAR AHORA": (solicitar_compra, None),
+    "📊 MIS SELLOS": (sellos, None),
+    "📋 MI HISTORIAL": (historial_cliente, None),
+    "ℹ️ INFORMACIÓN": (info, None),
+    "📝 REGISTRARME": (registro_directo, None),
+    "📞 CONTACTAR": (manejar_contacto, None),
+    "📞 CONTACTAR ADMIN": (manejar_contacto, None),
+    "🔄 ACTUALIZAR CACHE": (boton_actualizar_cache, "❌ Solo el administrador puede actualizar el cache."),
+    "🏠 INICIO": (start, None),
+}
+
+# Flujo pendiente -> handler que procesa el siguiente texto
+PROCESADORES_FLUJO = {
+    'agregar_vendedor': procesar_agregar_vendedor_rapido,
+    'agregar_cliente': procesar_agregar_cliente,
+    'eliminar_cliente': procesar_eliminar_cliente,
+}
+
+# Rol -> botones permitidos (los botones de cliente están abiertos a todos)
+BOTONES_CLIENTE = frozenset(texto for texto, (_, denegado) in BOTONES.items() if denegado is None)
+BOTONES_VENDEDOR = BOTONES_CLIENTE | {"👥 VER CLIENTES", "💰 MIS VENTAS"}
+PERMISOS_POR_ROL = {
+    'admin': frozenset(BOTONES),
+    'premium': BOTONES_VENDEDOR | {"📊 ESTADÍSTICAS", "🏆 RANKING VENDEDORES"},
+    'normal': BOTONES_VENDEDOR,
+    'cliente': BOTONES_CLIENTE,
+}
+
+async def manejar_botones_avanzados(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Maneja los botones del menú"""
+    texto = update.message.text
+    user_id = str(update.effective_user.id)
+    rol = await rol_de(update, context)
+    
+    boton = BOTONES.get(texto)
+    estado = flujo_activo(user_id)
+    if boton:
+        # Pulsar otro botón abandona cualquier captura de texto pendiente
+        if estado and estado['flujo'] in FLUJOS_TEXTO:
+            terminar_flujo(user_id)
+        accion, denegado = boton
+        if texto in PERMISOS_POR_ROL[rol]:
+            await accion(update, context)
+        else:
+            await responder(update, denegado)
+    elif estado and estado['flujo'] in PROCESADORES_FLUJO:
+        await PROCESADORES_FLUJO[estado['flujo']](update, context)
+    else:
+        await start(update, context)
+
+USO_VENTANA = "📅 Uso: /{comando} [hoy | semana | mes | rango AAAA-MM-DD AAAA-MM-DD]"
+
+async def ventana_de_comando(update: Update, context: ContextTypes.DEFAULT_TYPE, boton, comando):
+    """Permiso del botón equivalente y ventana de los argumentos: (permitido, ventana)"""
+    if boton not in PERMISOS_POR_ROL[await rol_de(update, context)]:
+        await responder(update, BOTONES[boton][1])
+        return False, None
+    try:
+        return True, parsear_ventana(context.args)
+    except ValueError:
+        await responder(update, USO_VENTANA.format(comando=comando))
+        return False, None
+
+async def comando_estadisticas(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/estadisticas [ventana]: sin ventana es el botón de siempre (y guarda la hoja)"""
+    permitido, ventana = await ventana_de_comando(update, context, "📊 ESTADÍSTICAS", 'estadisticas')
+    if not permitido:
+        return
+    if ventana is None:
+        await boton_estadisticas(update, context)
+        return
+    instantanea = await tomar_instantanea(ventana)
+    await responder(update, await obtener_estadisticas_completas(instantanea))
+
+async def comando_ranking(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/ranking [ventana]"""
+    permitido, ventana = await ventana_de_comando(update, context, "🏆 RANKING VENDEDORES", 'ranking')
+    if not permitido:
+        return
+    instantanea = await tomar_instantanea(ventana)
+    await responder(update, await generar_ranking_detallado(instantanea))
+
+async def comando_metricas(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Muestra las métricas del bot (solo admin)"""
+    if not await exigir_admin(update, "❌ Solo el administrador puede usar este comando."):
+        return
+    await responder(update, metricas.texto())
+
+async def servir_metricas(reader, writer):
+    """Responde GET /metrics en formato Prometheus"""
+    try:
+        encabezado = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=10)
+        partes = encabezado.decode('latin-1').split(' ')
+        if len(partes) > 1 and partes[0] == 'GET' and partes[1].split('?', 1)[0] == '/metrics':
+            estado, cuerpo = '200 OK', metricas.prometheus().encode()
+        else:
+            estado, cuerpo = '404 Not Found', b''
+        writer.write(
+            f"HTTP/1.1 {estado}\r\n"
+            f"Content-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(cuerpo)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + cuerpo
+        )
+        await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
+
+async def iniciar_servidor_metricas(application):
+    """Levanta el endpoint de Prometheus si METRICAS_PUERTO está configurado"""
+    if METRICAS_PUERTO:
+        application.bot_data['servidor_metricas'] = await asyncio.start_server(servir_metricas, '0.0.0.0', METRICAS_PUERTO)
+        print(f"📈 Métricas Prometheus en :{METRICAS_PUERTO}/metrics - Hora: {obtener_hora_venezuela()}")
+
+async def calentar_datos():
+    """Carga el espejo de clientes, el historial y el cache de vendedores en segundo plano"""
+    inicio = time.perf_counter()
+    await cargar_datos_en_memoria()
+    try:
+        await registro_vendedores.asegurar()
+    except Exception as e:
+        print(f"⚠️ No se pudo precargar el cache de vendedores: {e}")
+    print(f"🔥 Datos en memoria listos en {time.perf_counter() - inicio:.1f}s - Hora: {obtener_hora_venezuela()}")
+
+async def precargar_datos(application):
+    """Conecta las hojas y deja la carga pesada en segundo plano
+
+    Antes de atender mensajes solo se esperan los metadatos del libro y los
+    encabezados; los índices en memoria se construyen con el bot ya en marcha.
+    """
+    await conectar_google_sheets()
+    await almacen.iniciar()
+    programar_carga_datos()
+    application.bot_data['calentamiento'] = asyncio.create_task(calentar_datos())
+    await iniciar_servidor_metricas(application)
+    
+    if application.job_queue:
+        application.job_queue.run_repeating(barrer_codigos_expirados, interval=BARRIDO_CODIGOS_SEGUNDOS,
+                                            first=BARRIDO_CODIGOS_SEGUNDOS, name='barrido_codigos')
+    else:
+        application.bot_data['barrido_codigos'] = asyncio.create_task(barrido_codigos_sin_jobqueue())
+
+async def detener_servicios(application):
+    """Detiene el barrido sin JobQueue y vacía la cola de salida (post_stop: el bot aún puede enviar)"""
+    barrido = application.bot_data.pop('barrido_codigos', None)
+    if barrido:
+        barrido.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await barrido
+    await despachador.detener()
+
+def crear_aplicacion(token=TOKEN, peticiones=None):
+    """Application con los ganchos de arranque y cierre; peticiones reemplaza el cliente HTTP (pruebas)"""
+    constructor = (
+        ApplicationBuilder()
+        .token(token)
+        .concurrent_updates(MAX_UPDATES_CONCURRENTES)
+        .post_init(precargar_datos)
+        .post_stop(detener_servicios)
+    )
+    if peticiones:
+        constructor = constructor.request(peticiones).get_updates_request(peticiones)
+    return constructor.build()
+
+async def cerrar_aplicacion(application):
+    """Cierre en el mismo orden que run_polling: stop, post_stop, shutdown y post_shutdown
+
+    La cola de salida se vacía en post_stop; tras shutdown() el bot ya no puede enviar.
+    """
+    if application.running:
+        await application.stop()
+    if application.post_stop:
+        await application.post_stop(application)
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+# Entrega de updates: polling largo (por defecto) o webhook con receptor HTTP propio
+MODO_ENTREGA = os.getenv('MODO_ENTREGA', 'polling').lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_RUTA = '/' + os.getenv('WEBHOOK_RUTA', 'telegram').strip('/')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PUERTO = int(os.getenv('WEBHOOK_PUERTO', os.getenv('PORT', '8443')))
+# Sin secreto configurado se genera uno por arranque: el webhook nunca queda sin autenticar
+WEBHOOK_SECRETO = os.getenv('WEBHOOK_SECRETO', '') or secrets.token_urlsafe(32)
+POLLING_TIMEOUT = int(os.getenv('POLLING_TIMEOUT', '30'))
+MAX_CUERPO_WEBHOOK = 1024 * 1024
+
+ESTADOS_HTTP = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+                405: 'Method Not Allowed', 413: 'Payload Too Large'}
+
+class ReceptorWebhook:
+    """Servidor HTTP mínimo (asyncio) que recibe updates de Telegram.
+
+    POST WEBHOOK_RUTA exige la cabecera X-Telegram-Bot-Api-Secret-Token y
+    encola el update en application.update_queue; GET /health responde el
+    estado del bot. procesar() no depende del socket, así que se puede probar
+    con POSTs simulados.
+    """
+
+    def __init__(self, application, ruta=WEBHOOK_RUTA, secreto=WEBHOOK_SECRETO):
+        if not secreto:
+            raise ValueError("El webhook necesita un secreto para autenticar a Telegram")
+        self.application = application
+        self.ruta = ruta
+        self.secreto = secreto
+        self.servidor = None
+        self.recibidos = 0
+        self.rechazados = 0
+
+    async def procesar(self, metodo, ruta, cabeceras, cuerpo):
+        """Atiende una petición ya parseada y devuelve (estado, respuesta)"""
+        ruta = ruta.split('?', 1)[0]
+        if ruta == '/health':
+            if metodo != 'GET':
+                return 405, {'ok': False}
+            return 200, {
+                'ok': True,
+                'modo': 'webhook',
+                'pendientes': self.application.update_queue.qsize(),
+                'recibidos': self.recibidos,
+                'rechazados': self.rechazados
+            }
+        
+        if ruta != self.ruta:
+            return 404, {'ok': False}
+        if metodo != 'POST':
+            return 405, {'ok': False}
+        
+        token = cabeceras.get('x-telegram-bot-api-secret-token', '')
+        if not hmac.compare_digest(token.encode(), self.secreto.encode()):
+            self.rechazados += 1
+            print(f"🚫 Webhook rechazado: secreto inválido - Hora: {obtener_hora_venezuela()}")
+            return 403, {'ok': False}
+        
+        try:
+            update = Update.de_json(json.loads(cuerpo), self.application.bot)
+        except Exception as e:
+            print(f"⚠️ Webhook con cuerpo inválido: {e}")
+            return 400, {'ok': False}
+        
+        await self.application.update_queue.put(update)
+        self.recibidos += 1
+        return 200, {'ok': True}
+
+    async def _atender(self, reader, writer):
+        try:
+            while True:
+                try:
+                    encabezado = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=60)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                    break
+                
+                lineas = encabezado.decode('latin-1').split('\r\n')
+                partes = lineas[0].split(' ')
+                if len(partes) < 2:
+                    break
+                metodo, ruta = partes[0].upper(), partes[1]
+                cabeceras = {}
+                for linea in lineas[1:]:
+                    if ':' in linea:
+                        clave, valor = linea.split(':', 1)
+                        cabeceras[clave.strip().lower()] = valor.strip()
+                
+                largo = int(cabeceras.get('content-length', '0') or 0)
+                if largo > MAX_CUERPO_WEBHOOK:
+                    estado, respuesta = 413, {'ok': False}
+                    cuerpo = None
+                else:
+                    cuerpo = await reader.readexactly(largo) if largo else b''
+                    estado, respuesta = await self.procesar(metodo, ruta, cabeceras, cuerpo)
+                
+                datos = json.dumps(respuesta).encode()
+                cerrar = cuerpo is None or cabeceras.get('connection', '').lower() == 'close'
+                writer.write(
+                    f"HTTP/1.1 {estado} {ESTADOS_HTTP.get(estado, '')}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(datos)}\r\n"
+                    f"Connection: {'close' if cerrar else 'keep-alive'}\r\n\r\n".encode() + datos
+                )
+                await writer.drain()
+                if cerrar:
+                    break
+        except Exception as e:
+            print(f"⚠️ Error en conexión webhook: {e}")
+        finally:
+            writer.close()
+
+    async def iniciar(self, host=WEBHOOK_HOST, puerto=WEBHOOK_PUERTO):
+        self.servidor = await asyncio.start_server(self._atender, host, puerto)
+        print(f"🌐 Webhook escuchando en {host}:{puerto}{self.ruta} - Hora: {obtener_hora_venezuela()}")
+
+    async def detener(self):
+        if self.servidor:
+            self.servidor.close()
+            await self.servidor.wait_closed()
+            self.servidor = None
+
+async def ejecutar_webhook(application):
+    """Ciclo de vida del bot en modo webhook con el receptor propio"""
+    receptor = ReceptorWebhook(application)
+    detener = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for senal in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(senal, detener.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.bot.set_webhook(
+        url=f"{WEBHOOK_URL}{WEBHOOK_RUTA}",
+        secret_token=receptor.secreto,
+        allowed_updates=Update.ALL_TYPES,
+        drop_pending_updates=True
+    )
+    await application.start()
+    await receptor.iniciar()
+    
+    try:
+        await detener.wait()
+    finally:
+        print(f"🛑 Deteniendo webhook - Hora: {obtener_hora_venezuela()}")
+        await receptor.detener()
+        await cerrar_aplicacion(application)
+
 # HANDLERS PRINCIPALES
 if __name__ == "__main__":
-    app = ApplicationBuilder().token(TOKEN).build()
+    app = crear_aplicacion()
     
+    app.add_handler(TypeHandler(Update, resolver_rol), group=-1)
     app.add_handler(CommandHandler('start', start))
     app.add_handler(CommandHandler('registro', registro_directo))
     app.add_handler(CommandHandler('compras', solicitar_compra))
@@ -1871,7 +4569,16 @@ if __name__ == "__main__":
     app.add_handler(CommandHandler('info', info))
     
     app.add_handler(CommandHandler('historial', historial_cliente))
-    app.add_handler(CommandHandler('ranking', generar_ranking_detallado))
+    app.add_handler(CallbackQueryHandler(manejar_paginas_historial, pattern='^historial_'))
+    app.add_handler(CallbackQueryHandler(manejar_paginas_clientes, pattern='^listado_'))
+    app.add_handler(CommandHandler('ranking', comando_ranking))
+    app.add_handler(CommandHandler('estadisticas', comando_estadisticas))
+    app.add_handler(CommandHandler('metrics', comando_metricas))
+    
+    # ✅ Instrumentar todos los handlers registrados
+    for grupo in app.handlers.values():
+        for handler in grupo:
+            handler.callback = medir(handler.callback)
     
     print("🚀 Shisha MGTA Bot - INICIADO CON TODAS LAS CORRECCIONES")
     print(f"✅ CORRECCIONES IMPLEMENTADAS - Hora Venezuela: {obtener_hora_venezuela()}")
@@ -1892,9 +4599,16 @@ if __name__ == "__main__":
     print("─" * 50)
     
     # ✅ ESTRUCTURA CORREGIDA: Ejecución continua simple
-    print(f"🔄 Iniciando bot - Hora Venezuela: {obtener_hora_venezuela()}")
-    app.run_polling(
-        drop_pending_updates=True,
-        allowed_updates=None,
-        poll_interval=2.0
-    )
+    print(f"🔄 Iniciando bot ({MODO_ENTREGA}) - Hora Venezuela: {obtener_hora_venezuela()}")
+    if MODO_ENTREGA == 'webhook' and WEBHOOK_URL:
+        asyncio.run(ejecutar_webhook(app))
+    else:
+        if MODO_ENTREGA == 'webhook':
+            print("⚠️ WEBHOOK_URL no configurada, usando polling largo")
+        # Long polling: Telegram retiene la petición hasta que llega un update
+        app.run_polling(
+            drop_pending_updates=True,
+            allowed_updates=Update.ALL_TYPES,
+            poll_interval=0.0,
+            timeout=POLLING_TIMEOUT
+        )